@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Micro-benchmark of file hashing (ezfetcher.utils.filehexdigest): digest algorithms,
+block reads vs mmap, against the 8 kB md5 reads filehexdigest used before.
+Files are hashed from the page cache (they are read once before timing), so this
+measures the cpu cost; on a NAS, the larger reads also save network round trips.
+
+    python -m benchmarks.digest_bench [--files 20] [--mb 2] [--algorithms md5 sha1 sha256 blake2b]
+
+For whole-directory throughput (with the process pool), use:
+    python -m ezfetcher.digest_index <directory> --workers N [--algorithm blake2b] [--verify]
+
+"""
+
+import os
+import time
+import hashlib
+import argparse
+import tempfile
+
+from ezfetcher.utils import filehexdigest
+
+
+def legacy_filehexdigest(filepath, digesttype='md5'):
+    """ filehexdigest before: 128*block_size (8 kB for md5) reads. """
+    m = hashlib.new(digesttype)
+    with open(filepath, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(128*m.block_size), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def throughput(func, paths, nbytes, repeat=3):
+    """ Return best throughput (MB/s) of func over all paths. """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            func(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return nbytes / 1024**2 / best
+
+
+def main(argv=None):
+    """ Run the micro-benchmark. """
+    parser = argparse.ArgumentParser(description="Micro-benchmark of file hashing.")
+    parser.add_argument('--files', type=int, default=20, help="Number of files.")
+    parser.add_argument('--mb', type=int, default=2, help="Size of each file (MB).")
+    parser.add_argument('--algorithms', nargs='+', default=['md5', 'sha1', 'sha256', 'blake2b'])
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="ezfetcher-digest-bench-") as directory:
+        paths = []
+        for i in range(args.files):
+            path = os.path.join(directory, "%s.pdf" % i)
+            with open(path, 'wb') as fd:
+                fd.write(os.urandom(args.mb * 1024**2))
+            paths.append(path)
+        nbytes = args.files * args.mb * 1024**2
+        for path in paths:
+            legacy_filehexdigest(path)
+        print("%-10s %12s %12s %12s" % ("algorithm", "8kB MB/s", "1MB MB/s", "mmap MB/s"))
+        for algorithm in args.algorithms:
+            assert filehexdigest(paths[0], algorithm) == legacy_filehexdigest(paths[0], algorithm) \
+                == filehexdigest(paths[0], algorithm, use_mmap=True)
+            print("%-10s %12.0f %12.0f %12.0f" % (
+                algorithm,
+                throughput(lambda path: legacy_filehexdigest(path, algorithm), paths, nbytes),
+                throughput(lambda path: filehexdigest(path, algorithm), paths, nbytes),
+                throughput(lambda path: filehexdigest(path, algorithm, use_mmap=True), paths, nbytes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Local stand-ins for a publisher, a host-rewriting EzProxy and SAML/CAS login servers.
+
+All hosts are served by a single threaded HTTP server on 127.0.0.1, and requests are
+dispatched on the Host header:
+
+    <publisher>.ezproxy.localhost:<port>    Proxied publisher: landing pages /article/<n> and pdfs /pdf/<n>.pdf.
+                                            Requests without a valid session cookie are redirected to login.
+    login.ezproxy.localhost:<port>          EzProxy login endpoints (sets the 'ezproxy' session cookie),
+                                            and the /_bench/stats and /_bench/expire control endpoints.
+    idp.localhost:<port>                    SAML discovery, IdP login and SP assertion consumer (like AU_lib).
+    cas.localhost:<port>                    CAS login form (like HUID).
+
+The SAML flow follows the steps of the AU_lib adaptor:
+    GET  /disco?return=..               discovery page (login host, where EzClient hands over to the adaptor)
+    GET  /disco?return=..&idp=..        -> 302 /login?AuthState=..
+    POST /login (AuthState, username, password)  -> form with SAMLResponse, posting to /acs
+    POST /acs (SAMLResponse)            -> form with SAMLResponse and RelayState, posting to the EzProxy
+    POST login.ezproxy/Shibboleth.sso/SAML2/POST  -> session cookie, 302 to the original url
+The CAS flow follows the steps of the HUID adaptor:
+    GET  /cas/login?service=..          login form with hidden lt/execution fields
+    POST /cas/login?service=..          -> 302 to service (the EzProxy login url) with a ticket
+    GET  login.ezproxy/login?url=..&ticket=..     -> session cookie, 302 to the original url
+
+*.localhost names do not resolve everywhere, so clients should call install_localhost_resolver().
+
+"""
+
+import sys
+import json
+import time
+import socket
+import random
+import base64
+import hashlib
+import secrets
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl, urlencode, quote
+import logging
+logger = logging.getLogger(__name__)
+
+
+PROXY_SUFFIX = ".ezproxy.localhost"
+USERNAME = "bench"
+PASSWORD = "bench"
+_FILLER = random.Random(0).randbytes(64*1024)
+
+
+def install_localhost_resolver():
+    """ Make socket.getaddrinfo resolve all *.localhost names to 127.0.0.1. """
+    getaddrinfo = socket.getaddrinfo
+    if getattr(getaddrinfo, 'resolves_localhost', False):
+        return
+
+    def localhost_getaddrinfo(host, *args, **kwargs):
+        if isinstance(host, bytes):
+            host = host.decode('ascii')
+        if host and host.rstrip('.').endswith('.localhost'):
+            host = '127.0.0.1'
+        return getaddrinfo(host, *args, **kwargs)
+    localhost_getaddrinfo.resolves_localhost = True
+    socket.getaddrinfo = localhost_getaddrinfo
+
+
+def pdf_parts(n, size):
+    """ Return (header, filler length, trailer) of (fake) pdf number n, with total size about <size>. """
+    header = b"%%PDF-1.4\n%% Benchmark article %d\n" % n
+    trailer = b"\n%%EOF\n"
+    return header, max(0, size - len(header) - len(trailer)), trailer
+
+
+def pdf_length(n, size):
+    """ Length of pdf number n. """
+    header, filler_length, trailer = pdf_parts(n, size)
+    return len(header) + filler_length + len(trailer)
+
+
+def pdf_chunks(n, size):
+    """ Generate the bytes of pdf number n. """
+    header, remaining, trailer = pdf_parts(n, size)
+    yield header
+    while remaining > 0:
+        chunk = _FILLER[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+    yield trailer
+
+
+def autosubmit_form(action, fields):
+    """ Html page with a (javascript auto-submitted) form posting hidden fields to action. """
+    inputs = "\n".join('    <input type="hidden" name="%s" value="%s" />' % kv for kv in fields.items())
+    return ('<html><body onload="document.forms[0].submit()">\n'
+            '<form method="post" action="%s">\n%s\n    <input type="submit" value="Submit" />\n'
+            '</form>\n</body></html>\n' % (action, inputs))
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    """ Threading HTTP server that does not print tracebacks for connections reset by clients. """
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeServers(object):
+    """
+    Publisher, EzProxy and login servers on a single local port.
+    <pdf_size> and <landing_size> are the (approximate) sizes of pdfs and landing pages in bytes,
+    <latency> is the time (seconds) before each publisher response, <login_latency> before
+    each login server response. Sessions expire after <session_ttl> seconds (None: never).
+    <login_flow> is 'saml' (AU_lib-like) or 'cas' (HUID-like). If <meta_link> is False, landing
+    pages have no citation_pdf_url meta tag, and the pdf link must be found with pdf_href_regex.
+    """
+
+    def __init__(self, port=0, pdf_size=1024*1024, landing_size=100*1024, latency=0.0, login_latency=0.0,
+                 session_ttl=None, login_flow='saml', meta_link=True):
+        self.pdf_size = pdf_size
+        self.landing_size = landing_size
+        self.latency = latency
+        self.login_latency = login_latency
+        self.session_ttl = session_ttl
+        self.login_flow = login_flow
+        self.meta_link = meta_link
+        self.sessions = {}      # token -> time of login
+        self.states = {}        # AuthState / ticket -> original url
+        self.stats = {'requests': 0, 'logins': 0, 'login_redirects': 0, 'pdf_bytes': 0}
+        self._lock = threading.Lock()
+        self.httpd = QuietHTTPServer(('127.0.0.1', port), FakeRequestHandler)
+        self.httpd.fake = self
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    def start(self):
+        """ Start serving in a background thread. """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info("Fake servers listening on 127.0.0.1:%s", self.port)
+        return self
+
+    def stop(self):
+        """ Stop serving. """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def host(self, name):
+        """ Return netloc (with port) for host <name>, e.g. 'idp.localhost'. """
+        return "%s:%s" % (name, self.port)
+
+    @property
+    def login_host(self):
+        """ Netloc where EzClient is redirected when login is required (the login adaptor's domain). """
+        return self.host('idp.localhost' if self.login_flow == 'saml' else 'cas.localhost')
+
+    @property
+    def proxy_url_fmt(self):
+        """ proxy_url_fmt for the fake EzProxy. """
+        return "http://{netloc}%s:%s{path}" % (PROXY_SUFFIX, self.port)
+
+    def article_url(self, n, publisher="www.publisher.test"):
+        """ Return (un-proxied) landing page url of article n. """
+        return "http://%s/article/%s" % (publisher, n)
+
+    def count(self, key, n=1):
+        """ Increment stats counter. """
+        with self._lock:
+            self.stats[key] += n
+
+    def new_session(self):
+        """ Create and return a new session token. """
+        token = secrets.token_hex(16)
+        with self._lock:
+            self.sessions[token] = time.monotonic()
+            self.stats['logins'] += 1
+        return token
+
+    def session_valid(self, token):
+        """ Whether session token is valid (and not expired). """
+        with self._lock:
+            started = self.sessions.get(token)
+        if started is None:
+            return False
+        return self.session_ttl is None or time.monotonic() - started < self.session_ttl
+
+    def expire_sessions(self):
+        """ Expire all sessions, forcing clients to log in again. """
+        with self._lock:
+            self.sessions.clear()
+
+    def new_state(self, url):
+        """ Store url under a new random state token, and return the token. """
+        state = secrets.token_urlsafe(16)
+        with self._lock:
+            self.states[state] = url
+        return state
+
+    def pop_state(self, state):
+        """ Return (and forget) the url stored for state token (or None). """
+        with self._lock:
+            return self.states.pop(state, None)
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    """ Dispatches requests to the fake publisher, proxy and login servers by Host header. """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    @property
+    def fake(self):
+        """ The FakeServers instance. """
+        return self.server.fake
+
+    def send(self, status, body=b'', content_type="text/html; charset=utf-8", headers=None):
+        """ Send a complete response. """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def redirect(self, location, headers=None):
+        """ Send a 302 redirect to location. """
+        self.send(302, headers=dict(headers or {}, Location=location))
+
+    def read_form(self):
+        """ Read url-encoded POST body as a dict. """
+        length = int(self.headers.get('Content-Length') or 0)
+        return dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+
+    def cookie(self, name):
+        """ Return value of request cookie <name> (or None). """
+        for part in (self.headers.get('Cookie') or '').split(';'):
+            key, _, value = part.strip().partition('=')
+            if key == name:
+                return value
+        return None
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def dispatch(self):
+        """ Dispatch request by host. """
+        host = (self.headers.get('Host') or '').split(':')[0].lower()
+        parsed = urlparse(self.path)
+        if not parsed.path.startswith('/_bench/'):
+            self.fake.count('requests')
+        query = dict(parse_qsl(parsed.query))
+        try:
+            if host == 'login' + PROXY_SUFFIX:
+                self.ezproxy_login(parsed.path, query)
+            elif host.endswith(PROXY_SUFFIX):
+                self.proxy(host[:-len(PROXY_SUFFIX)], parsed.path, query)
+            elif host == 'idp.localhost':
+                time.sleep(self.fake.login_latency)
+                self.saml(parsed.path, query)
+            elif host == 'cas.localhost':
+                time.sleep(self.fake.login_latency)
+                self.cas(parsed.path, query)
+            else:
+                self.send(404, "Unknown host: %s" % host)
+        except ConnectionError:
+            pass
+
+    ## EzProxy:
+
+    def proxy(self, publisher, path, query):
+        """ Serve publisher content if the session cookie is valid, otherwise redirect to login. """
+        fake = self.fake
+        original_url = "http://%s%s%s" % (self.headers['Host'], path, "?" + urlencode(query) if query else "")
+        if not fake.session_valid(self.cookie('ezproxy')):
+            fake.count('login_redirects')
+            if fake.login_flow == 'saml':
+                self.redirect("http://%s/disco?%s" % (fake.host('idp.localhost'), urlencode({'return': original_url})))
+            else:
+                service = "http://%s/login?%s" % (fake.host('login' + PROXY_SUFFIX), urlencode({'url': original_url}))
+                self.redirect("http://%s/cas/login?%s" % (fake.host('cas.localhost'), urlencode({'service': service})))
+            return
+        time.sleep(fake.latency)
+        if path.startswith('/article/'):
+            self.landing_page(path.rsplit('/', 1)[-1])
+        elif path.startswith('/pdf/') and path.endswith('.pdf'):
+            self.pdf(path.rsplit('/', 1)[-1][:-len('.pdf')])
+        else:
+            self.send(404, "Not found: %s (publisher %s)" % (path, publisher))
+
+    def landing_page(self, n):
+        """ Send landing page for article n. """
+        pdf_url = "http://%s/pdf/%s.pdf" % (self.headers['Host'], n)
+        head = '<html><head><title>Article %s</title>\n' % n
+        if self.fake.meta_link:
+            head += '<meta name="citation_pdf_url" content="%s">\n' % pdf_url
+        head += '<script>\n'
+        tail = '</script></head>\n<body><h1>Article %s</h1>\n<a class="pdf" href="/pdf/%s.pdf">Download PDF</a>\n' \
+               '</body></html>\n' % (n, n)
+        # Landing pages are mostly inline javascript:
+        padding = max(0, self.fake.landing_size - len(head) - len(tail))
+        line = "var x = 'lorem ipsum dolor sit amet consectetur adipiscing elit';\n"
+        body = head + line * (padding // len(line)) + tail
+        self.send(200, body)
+
+    def pdf(self, n):
+        """ Stream pdf number n. """
+        try:
+            n = int(n)
+        except ValueError:
+            self.send(404, "Not found")
+            return
+        length = pdf_length(n, self.fake.pdf_size)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", '"%s"' % hashlib.md5(b"%d-%d" % (n, length)).hexdigest())
+        self.end_headers()
+        for chunk in pdf_chunks(n, self.fake.pdf_size):
+            self.wfile.write(chunk)
+        self.fake.count('pdf_bytes', length)
+
+    def ezproxy_login(self, path, query):
+        """ EzProxy login endpoints: SAML2 POST and CAS ticket validation, plus benchmark control endpoints. """
+        fake = self.fake
+        if path == '/_bench/stats':
+            self.send(200, json.dumps(fake.stats), content_type="application/json")
+        elif path == '/_bench/expire':
+            fake.expire_sessions()
+            self.send(200, "Sessions expired")
+        elif path == '/Shibboleth.sso/SAML2/POST' and self.command == 'POST':
+            form = self.read_form()
+            url = fake.pop_state(form.get('RelayState', ''))
+            if not url or not form.get('SAMLResponse'):
+                self.send(403, "Invalid SAML response")
+                return
+            self.login_redirect(url)
+        elif path == '/login':
+            if not query.get('url') or fake.pop_state(query.get('ticket', '')) != 'cas':
+                self.send(403, "Invalid CAS ticket")
+                return
+            self.login_redirect(query['url'])
+        else:
+            self.send(404, "Not found")
+
+    def login_redirect(self, url):
+        """ Start a new session and redirect to url. """
+        token = self.fake.new_session()
+        self.redirect(url, headers={'Set-Cookie': "ezproxy=%s; Domain=%s; Path=/" % (token, PROXY_SUFFIX)})
+
+    ## SAML (AU_lib-like):
+
+    def saml(self, path, query):
+        """ SAML discovery, IdP and SP endpoints. """
+        fake = self.fake
+        if path == '/disco':
+            if not query.get('return'):
+                self.send(400, "Missing return url")
+            elif not query.get('idp'):
+                self.send(200, '<html><body><form method="get" action="/disco">\n'
+                               '<input type="hidden" name="return" value="%s" />\n'
+                               '<input type="submit" name="idp" value="Library" />\n'
+                               '</form></body></html>\n' % query['return'])
+            else:
+                state = fake.new_state(query['return'])
+                self.redirect("http://%s/login?%s" % (fake.host('idp.localhost'), urlencode({'AuthState': state})))
+        elif path == '/login' and self.command == 'GET':
+            self.send(200, '<html><body><form name="loginform" method="post" action="?">\n'
+                           '<input type="text" name="username" value="" />\n'
+                           '<input type="password" name="password" value="" />\n'
+                           '</form></body></html>\n')
+        elif path == '/login':
+            form = self.read_form()
+            if (form.get('username'), form.get('password')) != (USERNAME, PASSWORD) or \
+                    form.get('AuthState') not in fake.states:
+                self.send(403, "Login failed")
+                return
+            # Signed assertions are a few kB of base64:
+            assertion = base64.b64encode(secrets.token_bytes(6*1024)).decode('ascii')
+            self.send(200, autosubmit_form("http://%s/acs" % fake.host('idp.localhost'),
+                                           {'SAMLResponse': assertion, 'RelayState': form['AuthState']}))
+        elif path == '/acs' and self.command == 'POST':
+            form = self.read_form()
+            if not form.get('SAMLResponse') or form.get('RelayState') not in fake.states:
+                self.send(403, "Invalid SAML response")
+                return
+            assertion = base64.b64encode(secrets.token_bytes(6*1024)).decode('ascii')
+            self.send(200, autosubmit_form("http://%s/Shibboleth.sso/SAML2/POST" % fake.host('login' + PROXY_SUFFIX),
+                                           {'SAMLResponse': assertion, 'RelayState': form['RelayState']}))
+        else:
+            self.send(404, "Not found")
+
+    ## CAS (HUID-like):
+
+    def cas(self, path, query):
+        """ CAS login form and credential submission. """
+        fake = self.fake
+        if path != '/cas/login' or not query.get('service'):
+            self.send(404, "Not found")
+        elif self.command == 'GET':
+            lt = fake.new_state('lt')
+            self.send(200, '<html><body>\n<form id="fm1" action="/cas/login?service=%s" method="post">\n'
+                           '<input id="username" name="username" type="text" value="" />\n'
+                           '<input id="password" name="password" type="password" value="" />\n'
+                           '<input type="submit" name="_eventId_submit" value="Login" />\n'
+                           '<input type="hidden" name="lt" value="%s" />\n'
+                           '<input type="hidden" name="execution" value="e1s1" />\n'
+                           '</form>\n</body></html>\n' % (quote(query['service'], safe=''), lt))
+        else:
+            form = self.read_form()
+            if (form.get('username'), form.get('password')) != (USERNAME, PASSWORD) or \
+                    fake.pop_state(form.get('lt', '')) != 'lt' or form.get('_eventId_submit') != 'Login':
+                self.send(403, "Login failed")
+                return
+            ticket = fake.new_state('cas')
+            self.redirect(query['service'] + "&" + urlencode({'ticket': ticket}))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Micro-benchmark of the login form parser (ezfetcher.login_adaptors.form_parser),
+against the ad hoc regexes the login adaptors used before, on real-sized pages:
+
+    saml_post       IdP -> SP auto-submit page with a signed SAMLResponse (base64, ~<saml-kb> kB)
+    saml_relay      SP -> EzProxy auto-submit page with SAMLResponse and RelayState
+    cas_login       CAS login page (HUID-like) with hidden fields
+each wrapped in <page-kb> kB of typical IdP page markup (inline css/javascript).
+
+    python -m benchmarks.form_parser_bench [--saml-kb 12] [--page-kb 60] [--number 200]
+
+"""
+
+import os
+import re
+import base64
+import timeit
+import argparse
+
+from ezfetcher.login_adaptors.form_parser import find_form
+
+
+## The regexes the adaptors used before:
+
+def legacy_cas_fields(html):
+    """ HUID_lib.get_form_inputfields: DOTALL form regex, then an input regex over the form. """
+    form_html = re.compile(r"<form.*?</form>", flags=re.DOTALL).search(html).group()
+    input_regex = re.compile(r'<input[^<>]*?name="(?P<name>[^"]*)"[^<>]*?value="(?P<value>[^"]*)"[^<>]*?/>',
+                             flags=re.DOTALL+re.MULTILINE)
+    return dict(input_regex.findall(form_html))
+
+
+def legacy_saml_response(html):
+    """ AU_lib.parse_saml_response (note: the character class misses '/' and '=' of base64). """
+    return {'SAMLResponse': re.search(r'name="SAMLResponse" value="([\w\+]*)"', html).group(1)}
+
+
+def legacy_saml_relay(html):
+    """ AU_lib.parse_saml_2. """
+    m = re.search(r'name="SAMLResponse" value="([\w\+=]*)".*name="RelayState" value="([^\s^"]*)"', html)
+    return {'SAMLResponse': m.group(1), 'RelayState': m.group(2)}
+
+
+def filler(kb):
+    """ Return about kb kB of page markup: css, and javascript with html snippets in strings. """
+    block = ('<style>.login-box { margin: 0 auto; width: 320px; } .idp-logo > img { max-width: 100%; }</style>\n'
+             '<script>var tpl = "<div class=\\"notice\\">Please log in</div>"; if (a < b && c > d) { go(); }\n'
+             'function go() { document.querySelectorAll("input").forEach(function (el) { el.value = ""; }); }\n'
+             '</script>\n<div class="footer"><a href="/help">Help</a> | <a href="/privacy">Privacy</a></div>\n')
+    return block * max(1, kb * 1024 // len(block))
+
+
+def saml_value(kb):
+    """ Return a base64 SAMLResponse of about kb kB (with '+', '/' and '=' padding). """
+    return base64.b64encode(os.urandom(kb * 1024 * 3 // 4 + 1)).decode('ascii')
+
+
+def make_pages(saml_kb, page_kb):
+    """ Return dict of page name -> (html, expected fields). """
+    head, tail = filler(page_kb // 2), filler(page_kb // 2)
+    saml, relay = saml_value(saml_kb), "ezp.2aHR0cDovL3d3dy5uYXR1cmUuY29tL25hdHVyZS9qb3VybmFsL3Y0NDA"
+    pages = {}
+    fields = {'SAMLResponse': saml}
+    pages['saml_post'] = (
+        '<html><head>%s</head><body onload="document.forms[0].submit()">\n'
+        '<form method="post" action="https://sp.example.org/module.php/saml/sp/saml2-acs.php/casserver">\n'
+        '<input type="hidden" name="SAMLResponse" value="%s" />\n<input type="submit" value="Submit" />\n'
+        '</form>\n%s</body></html>' % (head, saml, tail), fields)
+    fields = {'SAMLResponse': saml, 'RelayState': relay}
+    pages['saml_relay'] = (
+        '<html><head>%s</head><body onload="document.forms[0].submit()">\n'
+        '<form method="post" action="https://login.ezproxy.example.org/Shibboleth.sso/SAML2/POST">\n'
+        '<input type="hidden" name="SAMLResponse" value="%s" />\n<input type="hidden" name="RelayState" value="%s" />\n'
+        '<input type="submit" value="Submit" />\n</form>\n%s</body></html>' % (head, saml, relay, tail), fields)
+    fields = {'username': '', 'password': '', '_eventId_submit': 'Login', 'lt': 'LT-8650210-Tqw3elvHjAZOs12jDIMUPQ4',
+              'execution': 'e2s1', 'casPageDisplayType': 'DEFAULT'}
+    pages['cas_login'] = (
+        '<html><head>%s</head><body>\n<form id="fm1" action="/cas/login?service=https%%3A%%2F%%2Fexample.org" '
+        'method="post">\n<input id="username" name="username" type="text" value="" size="40"/>\n'
+        '<input id="password" name="password" type="password" value="" size="40"/>\n'
+        '<input type="submit" name="_eventId_submit" value="Login"/>\n'
+        '<input type="hidden" name="lt" value="LT-8650210-Tqw3elvHjAZOs12jDIMUPQ4" />\n'
+        '<input type="hidden" name="execution" value="e2s1" />\n'
+        '<input type="hidden" name="casPageDisplayType" value="DEFAULT" />\n</form>\n%s</body></html>'
+        % (head, tail), fields)
+    return pages
+
+
+LEGACY = {'saml_post': legacy_saml_response, 'saml_relay': legacy_saml_relay, 'cas_login': legacy_cas_fields}
+
+
+def legacy_fields(name, html):
+    """ Extract the fields of page <name> with the legacy regexes (None if they fail). """
+    try:
+        return LEGACY[name](html)
+    except AttributeError:
+        return None
+
+
+def new_fields(name, html):
+    """ Extract the fields of page <name> with the form parser. """
+    form = find_form(html, field='SAMLResponse') if name.startswith('saml') else find_form(html)
+    return form.fields
+
+
+def best_time(func, number, repeat=5):
+    """ Return best time per call (seconds) of func. """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main(argv=None):
+    """ Run the micro-benchmark. """
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the login form parser.")
+    parser.add_argument('--saml-kb', type=int, default=12, help="Size of the SAMLResponse value (kB).")
+    parser.add_argument('--page-kb', type=int, default=60, help="Size of the surrounding page markup (kB).")
+    parser.add_argument('--number', type=int, default=200, help="Calls per timing.")
+    args = parser.parse_args(argv)
+    pages = make_pages(args.saml_kb, args.page_kb)
+    print("%-12s %8s %12s %12s %10s  %s" % ("page", "kB", "legacy us", "parser us", "parser MB/s", "legacy correct"))
+    for name, (html, expected) in pages.items():
+        fields = new_fields(name, html)
+        assert all(fields.get(key) == value for key, value in expected.items()), "Parser got wrong fields: %s" % name
+        legacy = legacy_fields(name, html)
+        legacy_ok = legacy is not None and all(legacy.get(key) == value for key, value in expected.items())
+        t_legacy = best_time(lambda: legacy_fields(name, html), args.number)
+        t_new = best_time(lambda: new_fields(name, html), args.number)
+        print("%-12s %8.1f %12.1f %12.1f %10.1f  %s" % (name, len(html) / 1024, t_legacy * 1e6, t_new * 1e6,
+                                                        len(html) / t_new / 1024**2, legacy_ok))
+
+
+if __name__ == '__main__':
+    main()
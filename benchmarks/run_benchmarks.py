@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Offline benchmarks of ezfetcher against the local fake servers in fake_servers.py.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --scenarios batch,login_expiry --pdf-size 5000000 --latency 0.05
+    python -m benchmarks.run_benchmarks --json before.json
+    python -m benchmarks.run_benchmarks --baseline before.json     # exit status 1 on regressions
+
+Scenarios:
+    single          fetch_pdf() for one url after the other, with a logged-in client.
+    batch           pdffetcher.fetch_pdfs() with a thread pool.
+    async           async_ezclient.fetch_pdfs() (requires aiohttp).
+    login_expiry    Like batch, but all sessions are expired just before the run,
+                    so every worker is redirected to the login page at once.
+
+Each scenario runs in its own python process (so peak RSS is per scenario),
+and reports throughput, p50/p99 latency per url, peak RSS and the number of logins.
+
+"""
+
+import os
+import io
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from urllib.parse import urlparse, parse_qsl
+import logging
+logger = logging.getLogger(__name__)
+
+from ezfetcher.login_adaptors.form_parser import find_form
+from .fake_servers import FakeServers, install_localhost_resolver, USERNAME, PASSWORD
+
+SCENARIOS = ('single', 'batch', 'async', 'login_expiry')
+
+
+def fake_au_login(s, url, url_is_loginpage=None, html=None, r=None, config=None):
+    """
+    Login adaptor for the fake SAML login flow, taking the same steps as AU_lib_login
+    (which has the statsbiblioteket.dk urls hard-coded).
+    """
+    if r is not None:
+        url = r.url
+    # Select login method:
+    params = dict(parse_qsl(urlparse(url).query), idp="Library")
+    r = s.get(url.split('?')[0], params=params)
+    # Submit library credentials:
+    formdata = dict(parse_qsl(urlparse(r.url).query), username=config['username'], password=config['password'])
+    r = s.post(r.url.split('?')[0], data=formdata)
+    # Transfer the two SAML responses:
+    for _ in range(2):
+        form = find_form(r.text, field='SAMLResponse')
+        r = s.post(form.action_url(r.url), data=form.fields)
+    return r
+
+
+def percentile(values, p):
+    """ Return the p'th percentile (0-100) of values (nearest rank). """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process, in MB. """
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB on Linux:
+    return maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def bench_config(args, download_dir):
+    """ Return ezfetcher config for the fake servers. """
+    return {
+        'proxy_url_fmt': "http://{netloc}.ezproxy.localhost:%s{path}" % args.port,
+        'pdf_download_dir': download_dir,
+        'pdf_open_after_download': False,
+        'cookies_persist_after_login': False,
+        'pdf_href_regex': r'<a [^>]*?href="([^\s"]+\.pdf)"',
+        'pdf_batch_workers': args.workers,
+        'ezclient_async_limit': args.workers,
+        'pdf_async_concurrency': args.workers,
+    }
+
+
+def set_login_adaptor(ezclient, args):
+    """ Make ezclient log in to the fake servers' login flow. """
+    credentials = {'prompt': 'never', 'username': USERNAME, 'password': PASSWORD}
+    if args.login_flow == 'saml':
+        ezclient.set_login_adaptor(func=fake_au_login, domain=["idp.localhost:%s" % args.port], config=credentials)
+    else:
+        from ezfetcher.login_adaptors import HUID_login
+        ezclient.set_login_adaptor(func=HUID_login, domain=["cas.localhost:%s" % args.port], config=credentials)
+
+
+def server_stats(args):
+    """ Return the fake servers' stats. """
+    import requests
+    return requests.get("http://login.ezproxy.localhost:%s/_bench/stats" % args.port).json()
+
+
+def expire_sessions(args):
+    """ Expire all sessions on the fake servers. """
+    import requests
+    requests.get("http://login.ezproxy.localhost:%s/_bench/expire" % args.port).raise_for_status()
+
+
+def run_scenario(scenario, args):
+    """
+    Run benchmark scenario (in this process) and return results dict.
+    Fake servers must be running on args.port.
+    """
+    install_localhost_resolver()
+    from ezfetcher.ezclient import EzClient
+    from ezfetcher import pdffetcher
+    urls = ["http://www.publisher.test/article/%s" % n for n in range(1, args.n + 1)]
+    with tempfile.TemporaryDirectory(prefix="ezfetcher-bench-") as download_dir:
+        config = bench_config(args, download_dir)
+        # ezfetcher is rather chatty on stdout:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if scenario == 'async':
+                from ezfetcher import async_ezclient
+                import asyncio
+
+                async def run():
+                    async with async_ezclient.AsyncEzClient(config) as client:
+                        set_login_adaptor(client.sync_client, args)
+                        # Log in before timing:
+                        await async_ezclient.fetch_pdfs(["http://www.publisher.test/article/0"], config, client)
+                        stats_before = server_stats(args)
+                        start = time.perf_counter()
+                        manifest = await async_ezclient.fetch_pdfs(urls, config, client)
+                        return manifest, time.perf_counter() - start, stats_before
+                manifest, wall, stats_before = asyncio.run(run())
+            else:
+                ezclient = EzClient(config)
+                set_login_adaptor(ezclient, args)
+                # Log in before timing:
+                pdffetcher.fetch_pdf("http://www.publisher.test/article/0", config, ezclient=ezclient)
+                if scenario == 'login_expiry':
+                    expire_sessions(args)
+                stats_before = server_stats(args)
+                start = time.perf_counter()
+                if scenario == 'single':
+                    manifest = []
+                    for url in urls:
+                        t0 = time.perf_counter()
+                        filepath = pdffetcher.fetch_pdf(url, config, ezclient=ezclient)
+                        manifest.append({'url': url, 'status': 'ok' if filepath else 'failed',
+                                         'elapsed': time.perf_counter() - t0})
+                else:
+                    manifest = pdffetcher.fetch_pdfs(urls, config, ezclient=ezclient, max_workers=args.workers)
+                wall = time.perf_counter() - start
+        stats_after = server_stats(args)
+    latencies = [entry['elapsed'] for entry in manifest if entry.get('elapsed') is not None]
+    n_ok = sum(1 for entry in manifest if entry['status'] == 'ok')
+    return {
+        'scenario': scenario,
+        'n': len(urls),
+        'ok': n_ok,
+        'wall_s': wall,
+        'urls_per_s': len(urls) / wall if wall else None,
+        'mb_per_s': n_ok * args.pdf_size / 1024**2 / wall if wall else None,
+        'p50_s': percentile(latencies, 50),
+        'p99_s': percentile(latencies, 99),
+        'peak_rss_mb': peak_rss_mb(),
+        'requests': stats_after['requests'] - stats_before['requests'],
+        'logins': stats_after['logins'] - stats_before['logins'],
+    }
+
+
+def run_child(scenario, args):
+    """ Run scenario in a new python process, returning the results dict. """
+    argv = [sys.executable, "-m", "benchmarks.run_benchmarks", "--child", scenario, "--port", str(args.port),
+            "--n", str(args.n), "--workers", str(args.workers), "--pdf-size", str(args.pdf_size),
+            "--login-flow", args.login_flow]
+    p = subprocess.run(argv, stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       universal_newlines=True)
+    if p.returncode != 0:
+        return {'scenario': scenario, 'error': "exit status %s" % p.returncode}
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+
+def print_results(results):
+    """ Print results as a table. """
+    columns = ('scenario', 'n', 'ok', 'urls_per_s', 'mb_per_s', 'p50_s', 'p99_s', 'peak_rss_mb', 'requests', 'logins')
+    print(" ".join("%12s" % column for column in columns))
+    for result in results:
+        if 'error' in result:
+            print("%12s  ERROR: %s" % (result['scenario'], result['error']))
+            continue
+        print(" ".join(("%12.3f" % result[column]) if isinstance(result[column], float) else
+                       ("%12s" % result[column]) for column in columns))
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare results with baseline results. A scenario has regressed if throughput is more than
+    <tolerance> (fraction) lower, or p99 latency or peak RSS is more than <tolerance> higher.
+    Returns list of regression descriptions.
+    """
+    baseline = {result['scenario']: result for result in baseline if 'error' not in result}
+    regressions = []
+    for result in results:
+        base = baseline.get(result['scenario'])
+        if base is None or 'error' in result:
+            continue
+        if result['urls_per_s'] < base['urls_per_s'] * (1 - tolerance):
+            regressions.append("%s: throughput %.2f -> %.2f urls/s"
+                               % (result['scenario'], base['urls_per_s'], result['urls_per_s']))
+        for key in ('p99_s', 'peak_rss_mb'):
+            if base.get(key) and result.get(key) and result[key] > base[key] * (1 + tolerance):
+                regressions.append("%s: %s %.3f -> %.3f" % (result['scenario'], key, base[key], result[key]))
+    return regressions
+
+
+def get_argparser():
+    """ Return argument parser. """
+    parser = argparse.ArgumentParser(description="Offline ezfetcher benchmarks against local fake servers.")
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS),
+                        help="Comma-separated scenarios to run (default: %(default)s).")
+    parser.add_argument('--n', type=int, default=50, help="Number of urls per scenario (default: %(default)s).")
+    parser.add_argument('--workers', type=int, default=8, help="Concurrent downloads in batch scenarios.")
+    parser.add_argument('--pdf-size', type=int, default=1024*1024, help="Pdf size in bytes.")
+    parser.add_argument('--landing-size', type=int, default=100*1024, help="Landing page size in bytes.")
+    parser.add_argument('--latency', type=float, default=0.02, help="Publisher response latency (seconds).")
+    parser.add_argument('--login-latency', type=float, default=0.05, help="Login server response latency (seconds).")
+    parser.add_argument('--login-flow', choices=('saml', 'cas'), default='saml',
+                        help="Fake login flow: 'saml' (like AU_lib) or 'cas' (like HUID).")
+    parser.add_argument('--no-meta-link', action='store_true',
+                        help="Landing pages without citation_pdf_url meta tag (pdf link found by regex).")
+    parser.add_argument('--json', help="Save results to this json file.")
+    parser.add_argument('--baseline', help="Compare with results in this json file; exit status 1 on regressions.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative regression (default: 0.2).")
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    """ Start fake servers and run benchmark scenarios. """
+    args = get_argparser().parse_args(argv)
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args)))
+        return
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            raise ValueError("Unknown scenario: %s (available: %s)" % (scenario, ", ".join(SCENARIOS)))
+    with FakeServers(pdf_size=args.pdf_size, landing_size=args.landing_size, latency=args.latency,
+                     login_latency=args.login_latency, login_flow=args.login_flow,
+                     meta_link=not args.no_meta_link) as servers:
+        args.port = servers.port
+        results = []
+        for scenario in scenarios:
+            print("Running scenario '%s'..." % scenario)
+            results.append(run_child(scenario, args))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(results, fd, indent=2)
+        print("Results saved to", args.json)
+    if args.baseline:
+        with open(args.baseline) as fd:
+            regressions = compare(results, json.load(fd), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
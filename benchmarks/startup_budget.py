@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Startup time budget for the command line interface (python -m ezfetcher).
+
+Checks, in fresh python processes, that:
+ * `python -m ezfetcher --help` and
+ * a cache-hit fetch (pdf saved less than pdf_max_age seconds ago)
+finish within the budget (default 100 ms, median of --repeat runs), and that
+neither imports requests, the login adaptors, pdb or the cookie snatcher.
+
+    python -m benchmarks.startup_budget [--budget 0.1] [--repeat 5]
+
+Exits with status 1 if the budget is exceeded.
+
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+URL = "http://www.publisher.test/article/1"
+PDF_URL = "http://www.publisher.test/pdf/1.pdf"
+# Modules that must not be imported for --help and cache hits:
+HEAVY_MODULES = ('requests', 'ezfetcher.ezclient', 'ezfetcher.login_adaptors.AU_lib',
+                 'ezfetcher.login_adaptors.HUID_lib', 'pdb', 'ezfetcher.lib')
+
+# Run the cli, then report heavy modules that were imported (on stderr):
+CHECK_IMPORTS = """
+import sys
+from ezfetcher.cli import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+sys.stderr.write("IMPORTED: %s\\n" % ",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def prepare_cache_hit(directory):
+    """ Create a download dir with a saved pdf, digest index and resolution cache. Returns config file path. """
+    from ezfetcher.digest_index import DigestIndex
+    from ezfetcher.resolution_cache import ResolutionCache
+    pdf_dir = os.path.join(directory, "pdfs")
+    os.makedirs(pdf_dir)
+    filepath = os.path.join(pdf_dir, "1.pdf")
+    with open(filepath, 'wb') as fd:
+        fd.write(b"%PDF-1.4\n" + os.urandom(100*1024) + b"\n%%EOF\n")
+    with DigestIndex(os.path.join(pdf_dir, ".ezfetcher_digests.sqlite")) as index:
+        index.get_digest(filepath)
+        index.set_validators(PDF_URL, filepath, {'ETag': '"1"'})
+    cache = ResolutionCache(os.path.join(directory, "resolutions.sqlite"))
+    cache.put([URL], PDF_URL)
+    cache.close()
+    configfile = os.path.join(directory, "config.yaml")
+    with open(configfile, 'w') as fd:
+        fd.write("pdf_download_dir: %s\n" % pdf_dir)
+        fd.write("pdf_digest_index: True\n")
+        fd.write("pdf_resolution_cache: %s\n" % os.path.join(directory, "resolutions.sqlite"))
+        fd.write("pdf_max_age: 3600\n")
+        fd.write("pdf_open_after_download: False\n")
+    return configfile
+
+
+def time_command(argv, repeat):
+    """ Run argv <repeat> times, returning (median wall time, stdout and stderr of the last run). """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        p = subprocess.run(argv, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), p.stdout, p.stderr
+
+
+def imported_heavy_modules(cli_args):
+    """ Return list of heavy modules imported when running the cli with cli_args. """
+    code = CHECK_IMPORTS.format(heavy=HEAVY_MODULES)
+    p = subprocess.run([sys.executable, "-c", code] + cli_args, cwd=ROOT,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    for line in p.stderr.splitlines():
+        if line.startswith("IMPORTED:"):
+            return [m for m in line[len("IMPORTED:"):].strip().split(",") if m]
+    raise RuntimeError("Could not run cli: %s" % p.stderr)
+
+
+def main(argv=None):
+    """ Check the startup time budget. """
+    parser = argparse.ArgumentParser(description="Check startup time budget of the ezfetcher cli.")
+    parser.add_argument('--budget', type=float, default=0.1, help="Max seconds (default: %(default)s).")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per command (median is used).")
+    args = parser.parse_args(argv)
+    sys.path.insert(0, ROOT)
+    failures = []
+    baseline, _, _ = time_command([sys.executable, "-c", "pass"], args.repeat)
+    print("Bare python startup: %.1f ms" % (baseline * 1000))
+    with tempfile.TemporaryDirectory(prefix="ezfetcher-startup-") as directory:
+        configfile = prepare_cache_hit(directory)
+        checks = [("--help", ["--help"]),
+                  ("cache-hit fetch", [URL, "--configfile", configfile])]
+        for name, cli_args in checks:
+            elapsed, stdout, _ = time_command([sys.executable, "-m", "ezfetcher"] + cli_args, args.repeat)
+            heavy = imported_heavy_modules(cli_args)
+            ok = elapsed < args.budget and not heavy
+            print("%-16s %6.1f ms  %s%s" % (name, elapsed * 1000, "OK" if ok else "FAIL",
+                                            "  (imported: %s)" % ", ".join(heavy) if heavy else ""))
+            if name == "cache-hit fetch" and "1.pdf" not in stdout:
+                print("  Cache hit expected, got:\n", stdout)
+                ok = False
+            if not ok:
+                failures.append(name)
+    if failures:
+        print("Startup budget of %.0f ms exceeded (or heavy imports) for: %s" % (args.budget * 1000, ", ".join(failures)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+
+"""
+
+Run the pdffetcher command line interface with:  python -m ezfetcher <url>
+
+"""
+
+from .cli import main
+
+main()
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+asyncio counterpart to EzClient, using aiohttp.
+
+Many landing-page and pdf requests can be in flight on a single event loop:
+
+    async with AsyncEzClient(config) as client:
+        manifest = await fetch_pdfs(urls, config, client)
+
+Config keys are the same as for EzClient (proxy_url_fmt, ezclient_headers, cookies, etc).
+Login is still done by the (blocking, requests-based) login adaptors. These are run
+by an internal EzClient in a worker thread, and cookies are copied between the two
+cookie jars before and after the login. The internal EzClient's per-host scheduler
+(ezclient_rate_limits), retry policy and circuit breakers apply to the async requests too.
+
+Responses are returned as FetchedResponse objects, which have the parts of the
+requests.Response interface used by pdffetcher (url, headers, content, text, iter_content),
+so e.g. pdffetcher.save_file can be used unchanged. Html pages (and error responses) are
+read into memory; other bodies are sniffed from their first chunk, and pdfs are streamed
+to a temporary file in the download directory, which save_file renames into place.
+
+"""
+
+import os
+import time
+import asyncio
+import functools
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse
+import aiohttp
+import logging
+logger = logging.getLogger(__name__)
+
+from .ezclient import EzClient
+from .errors import FetchFailed, http_failure
+from .pdffetcher import extract_pdf_href, resolve_pdf_href, save_file, get_pdf_download_dir, get_digest_index
+from .pdffetcher import get_href_selector, make_temp_file, duplicate_entry
+from .pdffetcher import is_pdf_response
+from .content_sniff import sniff_response, needs_sniffing, sniff_content
+from .coalesce import canonical_key
+from .resolution_cache import get_resolution_cache, resolution_keys, requested_url, deproxy_url
+
+
+class FetchedResponse(object):
+    """
+    A fully-read response, with the parts of the requests.Response interface used by ezfetcher.
+    The body is either in memory (<content>), or, for pdfs, in the temporary file <body_path>
+    (see AsyncEzClient._get). save_file renames the latter into place instead of copying it;
+    otherwise it is removed when the response is closed.
+    """
+
+    def __init__(self, url, status_code, headers, content, encoding=None, history=None, body_path=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self._content = content
+        self.encoding = encoding
+        self.history = history or []
+        self.body_path = body_path
+
+    @property
+    def content(self):
+        """ Return the response body (read from body_path, if the body was streamed to a file). """
+        if self.body_path is None:
+            return self._content
+        with open(self.body_path, 'rb') as fd:
+            return fd.read()
+
+    @property
+    def text(self):
+        """ Return content decoded as text. """
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def iter_content(self, chunk_size=1):
+        """ Iterate over content in chunks of chunk_size bytes. """
+        if self.body_path is None:
+            for start in range(0, len(self._content), chunk_size):
+                yield self._content[start:start+chunk_size]
+            return
+        with open(self.body_path, 'rb') as fd:
+            yield from iter(lambda: fd.read(chunk_size), b'')
+
+    def close(self):
+        """ Remove the body's temporary file (unless save_file has renamed it into place). """
+        if self.body_path is not None and os.path.exists(self.body_path):
+            os.remove(self.body_path)
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def __repr__(self):
+        return "<FetchedResponse [%s]>" % self.status_code
+
+    @classmethod
+    def from_aiohttp(cls, r, content, body_path=None):
+        """ Create from an aiohttp ClientResponse whose body has been read (to content or body_path). """
+        return cls(str(r.url), r.status, r.headers, content, encoding=r.get_encoding() if content else None,
+                   history=[str(h.url) for h in r.history], body_path=body_path)
+
+    @classmethod
+    def from_requests(cls, r):
+        """ Create from a requests Response. """
+        return cls(r.url, r.status_code, r.headers, r.content, encoding=r.encoding,
+                   history=[h.url for h in r.history])
+
+
+def requests_to_simplecookie(cookiejar):
+    """ Convert a requests (http.cookiejar) cookie jar to a SimpleCookie, keeping domain and path. """
+    simple = SimpleCookie()
+    for cookie in cookiejar:
+        simple[cookie.name] = cookie.value
+        if cookie.domain:
+            simple[cookie.name]['domain'] = cookie.domain
+        simple[cookie.name]['path'] = cookie.path or '/'
+    return simple
+
+
+class AsyncEzClient(object):
+    """
+    asyncio version of EzClient, able to route requests through a configured ezproxy.
+    Use as an async context manager, or call open() and close() yourself.
+    """
+
+    def __init__(self, config=None, headers=None, cookies=None, config_filepath=None, limit=None):
+        """
+        Args are the same as for EzClient.
+        <limit> is the maximum number of simultaneous connections
+        (default: config key 'ezclient_async_limit', or 100).
+        """
+        # The sync client takes care of config, headers, cookie files and login adaptor:
+        self.sync_client = EzClient(config, headers=headers, cookies=cookies, config_filepath=config_filepath)
+        self.config = self.sync_client.config
+        # Shared with the sync client, so limits and circuits also count its (login) requests:
+        self.scheduler = self.sync_client.scheduler
+        self.retry_policy = self.sync_client.retry_policy
+        self.circuit_breaker = self.sync_client.circuit_breaker
+        self.limit = limit or self.config.get('ezclient_async_limit', 100)
+        self.session = None
+        self._login_lock = None
+
+    # Proxy logic is shared with EzClient:
+    use_proxy = EzClient.use_proxy
+    proxy_rewriter = EzClient.proxy_rewriter
+    deproxy = EzClient.deproxy
+    ensure_proxy = EzClient.ensure_proxy
+
+    @property
+    def login_hostname(self):
+        """ Return login hostname(s) of the login adaptor. """
+        return self.sync_client.login_hostname
+
+    async def open(self):
+        """ Create the aiohttp session (must be called from within the event loop). """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit)
+            self.session = aiohttp.ClientSession(headers=dict(self.sync_client.headers), connector=connector)
+            self.session.cookie_jar.update_cookies(requests_to_simplecookie(self.sync_client.cookies))
+            self._login_lock = asyncio.Lock()
+        return self.session
+
+    async def close(self):
+        """ Close the aiohttp session, and the sync client (see EzClient.close). """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.sync_client.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def copy_cookies_to_sync_client(self):
+        """ Copy cookies from the aiohttp cookie jar to the sync client's session. """
+        for morsel in self.session.cookie_jar:
+            self.sync_client.cookies.set(morsel.key, morsel.value,
+                                         domain=morsel['domain'], path=morsel['path'] or '/')
+
+    def copy_cookies_from_sync_client(self):
+        """ Copy cookies from the sync client's session to the aiohttp cookie jar. """
+        self.session.cookie_jar.update_cookies(requests_to_simplecookie(self.sync_client.cookies))
+
+    async def login_after_redirect(self, response, generation=None, url=None):
+        """
+        Log in using the login adaptor, after having been redirected to the login page.
+        Only one login runs at a time, and the login adaptor runs in a worker thread.
+        If another task has logged in since <generation>, the original request for <url>
+        is simply retried with the fresh cookies instead.
+        """
+        async with self._login_lock:
+            if generation is None or generation == self.sync_client.login_generation:
+                print("Redirect to login page detected, attempting login...")
+                self.copy_cookies_to_sync_client()
+                loop = asyncio.get_running_loop()
+                try:
+                    r = await loop.run_in_executor(None, functools.partial(
+                        self.sync_client.login_after_redirect, response))
+                finally:
+                    self.sync_client.login_generation += 1
+                self.copy_cookies_from_sync_client()
+                return FetchedResponse.from_requests(r) if r is not None else r
+        logger.info("Login was done by another task, retrying %s", url)
+        return await self._get(url)
+
+    async def _get(self, url):
+        """
+        Get (proxied) url and read the response (see _get_once), retrying connection errors,
+        timeouts and retryable status codes according to the retry policy (as EzClient.send).
+        Requests to hosts whose circuit breaker is open fail immediately with CircuitOpenError.
+        """
+        host = urlparse(self.deproxy(url)).netloc
+        attempt = 0
+        while True:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.check(host)
+            try:
+                r = await self._get_once(url)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_failure(host)
+                if self.retry_policy is None or attempt >= self.retry_policy.max_retries:
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                logger.warning("%s getting %s, retrying in %.1f s...", type(e).__name__, url, delay)
+            except Exception:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_failure(host)
+                raise
+            except BaseException:
+                # E.g. the task was cancelled:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.release(host)
+                raise
+            else:
+                if self.retry_policy is None or not self.retry_policy.is_retryable_status(r.status_code):
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.record_success(host)
+                    return r
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_failure(host)
+                if attempt >= self.retry_policy.max_retries:
+                    return r
+                delay = self.retry_policy.delay(attempt, r)
+                logger.warning("Got %s from %s, retrying in %.1f s...", r.status_code, url, delay)
+                r.close()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _get_once(self, url):
+        """
+        Get (proxied) url and read the response, within the per-host limits of the scheduler (if any).
+        Html and error responses are read into memory. Other responses are sniffed from their
+        first chunk: html is read into memory, a non-pdf is not read further (unless config
+        'pdf_sniff_content' is False), and a pdf is streamed to a temporary file in the download
+        directory, so memory use does not depend on the size of the pdf.
+        """
+        if self.scheduler is None:
+            return await self._read(url)
+        release = await self.scheduler.acquire_async(url)
+        try:
+            return await self._read(url)
+        finally:
+            release()
+
+    async def _read(self, url):
+        """ Get url and read the response, see _get_once. """
+        session = await self.open()
+        chunk_size = self.config.get('pdf_download_chunk_size', 64*1024)
+        async with session.get(url) as r:
+            if r.status >= 300 or 'html' in r.headers.get('Content-Type', ''):
+                content = await r.read()
+                logger.debug("- %s bytes obtained from %s", len(content), url)
+                return FetchedResponse.from_aiohttp(r, content)
+            chunks = r.content.iter_chunked(chunk_size)
+            first = b''
+            async for chunk in chunks:
+                first = chunk
+                break
+            kind = sniff_content(first)
+            if kind == 'html':
+                return FetchedResponse.from_aiohttp(r, first + await r.read())
+            if kind == 'other' and self.config.get('pdf_sniff_content', True):
+                # Will be rejected by sniffing anyway; don't download the rest:
+                return FetchedResponse.from_aiohttp(r, first)
+            fd, body_path = make_temp_file(get_pdf_download_dir(self.config))
+            nbytes = len(first)
+            try:
+                with os.fdopen(fd, 'wb') as fileobj:
+                    fileobj.write(first)
+                    async for chunk in chunks:
+                        fileobj.write(chunk)
+                        nbytes += len(chunk)
+            except BaseException:
+                os.remove(body_path)
+                raise
+            logger.debug("- %s bytes streamed from %s to %s", nbytes, url, body_path)
+            return FetchedResponse.from_aiohttp(r, None, body_path=body_path)
+
+    async def get(self, url):
+        """ Get url """
+        url = self.ensure_proxy(url)
+        await self.open()
+        logger.info("Getting %s", url)
+        generation = self.sync_client.login_generation
+        response = await self._get(url)
+        if self.sync_client.is_login_redirect(response):
+            response = await self.login_after_redirect(response, generation, url)
+        return response
+
+
+async def get_pdf_response(url, client, pdf_href_regex, recursions=4, r=None, sniff=True, selector_callback=None):
+    """
+    Traverse url and responses recursively to get a PDF (async version of pdffetcher.get_pdf_response).
+    Responses are read completely, so sniffing (see content_sniff) only keeps non-pdfs from being saved.
+    Raises FetchFailed if no pdf is found.
+    """
+    if recursions < 1:
+        raise FetchFailed("Too many landing pages (recursions maxed out) before reaching a pdf: %s" % url)
+    if r is None:
+        r = await client.get(url)
+    kind = 'html' if 'html' in r.headers.get('Content-Type', '') else 'pdf'
+    if kind == 'pdf' and sniff and needs_sniffing(r):
+        kind = sniff_response(r)
+        if kind == 'other':
+            r.close()
+            raise FetchFailed("Response from %s (Content-Type: %s) is not a pdf"
+                              % (r.url, r.headers.get('Content-Type')))
+    if kind == 'html':
+        print("Response is html, trying to extract pdf url...")
+        pdf_href = extract_pdf_href(r, pdf_href_regex=pdf_href_regex, selector_callback=selector_callback)
+        if not pdf_href:
+            if client.sync_client.is_login_redirect(r):
+                raise FetchFailed("Login failed, still on the login page: %s" % r.url, retryable=True)
+            if not r:
+                raise http_failure(r)
+            raise FetchFailed("No pdf link found in html from %s" % r.url)
+        url = resolve_pdf_href(url, pdf_href)
+        print("New PDF URL:", url)
+        return await get_pdf_response(url, client, pdf_href_regex, recursions=recursions-1, sniff=sniff,
+                                      selector_callback=selector_callback)
+    else:
+        # Assume we have a pdf:
+        return r
+
+
+async def resolve_pdf_response(url, client, pdf_href_regex, config, resolution_cache=None, metadata=None):
+    """
+    Get pdf response for landing page url, using resolution_cache if given
+    (async version of pdffetcher.resolve_pdf_response).
+    """
+    sniff = config.get('pdf_sniff_content', True)
+    selector = get_href_selector(config)
+    if resolution_cache is None:
+        return await get_pdf_response(url, client, pdf_href_regex, sniff=sniff, selector_callback=selector)
+    keys = resolution_keys(url, config, metadata)
+    cached_url = resolution_cache.get(keys)
+    if cached_url:
+        print("Using cached pdf url:", cached_url)
+        response = await client.get(cached_url)
+        if is_pdf_response(response) and not (sniff and needs_sniffing(response) and sniff_response(response) != 'pdf'):
+            return response
+        print("Cached pdf url failed (%s), resolving from landing page..." % response)
+        response.close()
+        resolution_cache.invalidate(keys)
+    response = await get_pdf_response(url, client, pdf_href_regex, sniff=sniff, selector_callback=selector)
+    if is_pdf_response(response):
+        resolution_cache.put(keys, deproxy_url(requested_url(response), config))
+    return response
+
+
+async def fetch_pdf(url, config, client, metadata=None, digest_index=None, resolution_cache=None,
+                    raise_failures=False):
+    """
+    Fetch pdf from url using AsyncEzClient <client>. Returns the saved filepath.
+    Saving is done in a worker thread to avoid blocking the event loop.
+    As with pdffetcher.fetch_pdf, None is returned if no pdf could be fetched,
+    or FetchFailed is raised if raise_failures is True.
+    """
+    try:
+        response = await resolve_pdf_response(url, client, config.get('pdf_href_regex'), config,
+                                              resolution_cache, metadata=metadata)
+        if response is None:
+            raise FetchFailed("No pdf found at %s" % url)
+        if not response:
+            response.close()
+            raise http_failure(response)
+        loop = asyncio.get_running_loop()
+        savedir = get_pdf_download_dir(config)
+        return await loop.run_in_executor(None, functools.partial(
+            save_file, response, savedir, overwrite=config.get('pdf_overwrite', 'check_digest'),
+            metadata=metadata, chunk_size=config.get('pdf_download_chunk_size', 64*1024), digest_index=digest_index,
+            check_pdf=config.get('pdf_sniff_content', True), digesttype=config.get('pdf_digest_algorithm')))
+    except FetchFailed as e:
+        if raise_failures:
+            raise
+        print("Failed to get pdf from url %s: %s" % (url, e))
+        return None
+
+
+async def fetch_pdfs(urls, config, client=None, max_concurrent=None):
+    """
+    Fetch pdfs from multiple urls concurrently on the running event loop.
+    Returns a manifest list in the same format as pdffetcher.fetch_pdfs.
+    As with pdffetcher.fetch_pdfs, urls for the same article are only fetched once
+    (unless config 'pdf_coalesce_duplicates' is False).
+    """
+    if max_concurrent is None:
+        max_concurrent = config.get('pdf_async_concurrency', 100)
+    semaphore = asyncio.Semaphore(max_concurrent)
+    # Prompting for a pdf link would block the event loop:
+    config = dict(config, pdf_href_select='first')
+    digest_index = get_digest_index(config)
+    resolution_cache = get_resolution_cache(config)
+    # canonical key -> task fetching the first url with that key (the event loop makes check-and-set atomic):
+    inflight = {} if config.get('pdf_coalesce_duplicates', True) else None
+
+    async def fetch_entry(url):
+        """ Fetch a single url, returning a manifest entry. """
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                filepath = await fetch_pdf(url, config, client, digest_index=digest_index,
+                                           resolution_cache=resolution_cache, raise_failures=True)
+            except FetchFailed as e:
+                return {'url': url, 'status': 'failed', 'filepath': None, 'error': e.reason, 'duplicate_of': None,
+                        'elapsed': time.perf_counter() - start}
+            except Exception as e:  # pylint: disable=W0703
+                logger.exception("Error fetching pdf from %s", url)
+                return {'url': url, 'status': 'error', 'filepath': None, 'error': repr(e), 'duplicate_of': None,
+                        'elapsed': time.perf_counter() - start}
+        return {'url': url, 'status': 'ok' if filepath else 'failed', 'filepath': filepath, 'error': None,
+                'duplicate_of': None, 'elapsed': time.perf_counter() - start}
+
+    async def fetch_one(url):
+        """ Fetch url, or share the fetch of the same article (see coalesce.canonical_key). """
+        if inflight is None:
+            return await fetch_entry(url)
+        start = time.perf_counter()
+        key = canonical_key(url, config)
+        task = inflight.get(key)
+        if task is None:
+            task = inflight[key] = asyncio.ensure_future(fetch_entry(url))
+            return await task
+        logger.debug("Sharing fetch in flight for %s", key)
+        return duplicate_entry(await asyncio.shield(task), url, start)
+
+    try:
+        if client is None:
+            async with AsyncEzClient(config) as client:
+                return await asyncio.gather(*[fetch_one(url) for url in urls])
+        return await asyncio.gather(*[fetch_one(url) for url in urls])
+    finally:
+        if digest_index is not None:
+            digest_index.close()
+        if resolution_cache is not None:
+            resolution_cache.close()
+
+
+def run_batch(urls, config):
+    """ Run fetch_pdfs on a new event loop; for use from synchronous code. """
+    return asyncio.run(fetch_pdfs(list(urls), config))
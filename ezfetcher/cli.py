@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Fast-starting command line interface for pdffetcher:
+
+    python -m ezfetcher <url>
+    python -m ezfetcher --batch urls.txt --manifest manifest.json
+    python -m ezfetcher --batch urls.txt --queue harvest.sqlite     # Resumable (see job_queue)
+
+Only argparse and a few small modules are imported up front. requests, the
+login adaptors, the cookie snatcher and yaml are imported when they are needed,
+i.e. after the arguments have been parsed (so --help is instant), and not at all
+when the pdf for url was saved less than 'pdf_max_age' seconds ago (a cache hit).
+
+"""
+
+import argparse
+import logging
+logger = logging.getLogger(__name__)
+
+from .utils import get_config, init_logging, open_pdf
+
+
+def get_argparser():
+    """ Get argument parser. """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url', nargs='?', help="The URL to download pdf from.")
+    parser.add_argument('--batch', metavar="FILE",
+                        help="Fetch all URLs listed in FILE (one per line). Use '-' to read URLs from stdin.")
+    parser.add_argument('--workers', type=int, dest='pdf_batch_workers',
+                        help="Number of concurrent downloads in batch mode.")
+    parser.add_argument('--async', action="store_true", dest='pdf_batch_async', default=None,
+                        help="Use the asyncio fetch engine (requires aiohttp) in batch mode.")
+    parser.add_argument('--manifest', metavar="FILE",
+                        help="Write batch result manifest (json) to this file (default: stdout, "
+                             "in which case progress messages go to stderr).")
+    parser.add_argument('--queue', metavar="FILE",
+                        help="Durable job queue file for batch mode. Urls from --batch are added to the queue, "
+                             "and an interrupted run is resumed by running again (with or without --batch).")
+    parser.add_argument('--daemon', action="store_true", dest='use_daemon', default=None,
+                        help="Fetch with the running fetch daemon (python -m ezfetcher.daemon serve), "
+                             "falling back to fetching in-process if it is not running.")
+    parser.add_argument('--pdf_download_dir', help="Download pdf to this directory.")
+    parser.add_argument('--proxy_url_fmt',
+                        help="How to proxy rewrite the url. E.g. 'http://{netloc}.lib.university.edu/{path}")
+    parser.add_argument('--open_pdf', dest='pdf_open_after_download', action="store_true", default=None,
+                        help="Open pdf after download.")
+    parser.add_argument('--no-open_pdf', action="store_false", dest="pdf_open_after_download",
+                        help="Do not open pdf after download.")
+    parser.add_argument('--cookies_snatch_from', help="Snatch cookies from this browser (only Chrome supported).")
+    parser.add_argument('--cookie_snatch_keys', nargs='*', metavar="KEY", help="Download pdf to this directory.")
+    parser.add_argument('--cookie_snatch_domain', help="Domain to extract browser cookies for.")
+
+    parser.add_argument('--configfile', help="Load this config file.")
+
+    # testing and logging config:
+    parser.add_argument('--loglevel', help="Logging level.")
+    parser.add_argument('--testing', action="store_true", help="Enable testing mode.")
+
+    return parser
+
+
+def get_args(parser=None, argv=None):
+    """ Get args from command line. """
+    if parser is None:
+        parser = get_argparser()
+    return parser.parse_args(argv)
+
+
+def cached_pdf(url, config):
+    """
+    Return path of the pdf saved from url if it is fresh according to 'pdf_max_age' (see
+    resolution_cache.fresh_pdf_path), otherwise None. Does not import requests.
+    """
+    if not config.get('pdf_max_age'):
+        return None
+    from .digest_index import get_digest_index
+    from .resolution_cache import get_resolution_cache, fresh_pdf_path
+    digest_index = get_digest_index(config)
+    if digest_index is None:
+        return None
+    resolution_cache = get_resolution_cache(config)
+    try:
+        return fresh_pdf_path(url, config, digest_index, resolution_cache)
+    finally:
+        digest_index.close()
+        if resolution_cache is not None:
+            resolution_cache.close()
+
+
+def main(argv=None, extras=None):
+    """ Invoked from command line or tests... """
+    argns = get_args(None, argv) # get_args(parser, argv)
+    logger.debug("argns.__dict__: %s", argns.__dict__)
+    kwargs = {k: v for k, v in argns.__dict__.items() if v is not None}
+    if extras:
+        kwargs.update(extras)
+    url = kwargs.pop('url', None)
+    batchfile = kwargs.pop('batch', None)
+    manifest_filepath = kwargs.pop('manifest', None)
+    queue_filepath = kwargs.pop('queue', None)
+    logger.debug("kwargs: %s", kwargs)
+    config = get_config(kwargs, kwargs.pop('configfile', None))
+    logger.debug("config: %s", config)
+    init_logging(kwargs)
+
+    if url == 'test':
+        from .pdffetcher import test
+        test(kwargs)
+        return
+
+    if batchfile or queue_filepath:
+        from .pdffetcher import main_batch
+        main_batch(config, batchfile, manifest_filepath, queue_filepath)
+        return
+    if not url:
+        get_argparser().error("Either url, --batch or --queue must be given.")
+
+    filepath = cached_pdf(url, config)
+    if filepath:
+        print("Pdf was downloaded less than %s seconds ago: %s" % (config['pdf_max_age'], filepath))
+        open_pdf(filepath, config)
+        return filepath
+
+    if config.get('use_daemon'):
+        from .daemon import fetch_with_daemon, DaemonError
+        try:
+            filepath = fetch_with_daemon(url, config)
+        except (OSError, DaemonError) as e:
+            print("Fetch daemon is not available (%s), fetching in-process..." % e)
+        else:
+            if filepath:
+                print("Pdf saved by daemon:", filepath)
+                open_pdf(filepath, config)
+            return filepath
+
+    from .pdffetcher import fetch_pdf
+    return fetch_pdf(url, config)
+
+
+if __name__ == '__main__':
+    main()
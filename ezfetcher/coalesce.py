@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Coalescing of duplicate fetches.
+
+Batch inputs often list the same article several times: as a DOI link, the publisher's
+url, an already-proxied url, a mobile variant, with tracking parameters, etc.
+canonical_key() maps all of these to the same key:
+    'doi:<doi>'             if the DOI is known (metadata, doi.org link, or /doi/... in the path),
+    '//<host><path>?<query>' otherwise: the de-proxied url normalized with canonical_url().
+
+A SingleFlight then makes concurrent fetches with the same key share one fetch in flight:
+the first caller does the fetch, the others wait for it and get the same result (i.e.
+the same saved path). With remember=True (batch runs), completed results are kept, so
+duplicates later in the batch are not fetched again either.
+
+Disable with config:
+    pdf_coalesce_duplicates: False
+Extra tracking query parameters to ignore:
+    pdf_tracking_params: [source, origin]
+
+"""
+
+import threading
+from concurrent.futures import Future
+import logging
+logger = logging.getLogger(__name__)
+
+from .url_proxy_utils import doi_from_url, doi_from_path, canonical_url
+from .resolution_cache import deproxy_url
+
+
+def canonical_key(url, config, metadata=None):
+    """ Return the key identifying the article at url (see module docstring). """
+    url = deproxy_url(url, config)
+    doi = (metadata or {}).get('doi') or doi_from_url(url) or doi_from_path(url)
+    if doi:
+        return 'doi:' + doi.lower()
+    return canonical_url(url, config.get('pdf_tracking_params') or ())
+
+
+class SingleFlight(object):
+    """
+    Run at most one call per key at a time; concurrent callers with the same key
+    wait for that call and share its result (or exception).
+    If remember is True, results are kept, and later callers get them without a new call.
+    Can be shared between threads.
+    """
+
+    def __init__(self, remember=False):
+        self.remember = remember
+        self.coalesced = 0      # Number of calls that were served by another call's result
+        self._calls = {}        # key -> Future
+        self._lock = threading.Lock()
+
+    def prime(self, key, result):
+        """ Record result for key, as if it was returned by a call. """
+        future = Future()
+        future.set_result(result)
+        with self._lock:
+            self._calls[key] = future
+
+    def forget(self, key):
+        """ Forget the remembered result for key (if its call is done), so the next caller calls again. """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None and future.done():
+                del self._calls[key]
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Return (result, shared): the result of func(*args, **kwargs), or of the call in flight
+        (or remembered) for key, in which case shared is True.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            owner = future is None
+            if owner:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            logger.debug("Sharing fetch in flight for %s", key)
+            return future.result(), True
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            if not self.remember:
+                with self._lock:
+                    del self._calls[key]
+        return result, False
+
+
+def get_single_flight(config, remember=False):
+    """ Return SingleFlight, or None if disabled by config key 'pdf_coalesce_duplicates'. """
+    if not config.get('pdf_coalesce_duplicates', True):
+        return None
+    return SingleFlight(remember=remember)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Content sniffing of (streamed) responses, so we do not trust Content-Type alone.
+
+Publishers regularly serve html error pages, javascript challenges and paywall notices
+as application/octet-stream (or even application/pdf). So before a "pdf" response is
+downloaded, the first bytes of the body are read (peek_response) and checked:
+    'pdf'       %PDF- within the first 1024 bytes (where pdf readers accept it),
+    'html'      the body starts with a html tag (mislabelled html; extract the pdf link from it),
+    'other'     anything else (aborted).
+The rest of the body is only read if it is a pdf. When the download is complete, the
+last 1024 bytes are checked for the %%EOF marker (see TailTracker), which catches
+truncated pdfs.
+
+Disable with config:
+    pdf_sniff_content: False
+
+"""
+
+import itertools
+import logging
+logger = logging.getLogger(__name__)
+
+
+PDF_MAGIC = b'%PDF-'
+PDF_EOF = b'%%EOF'
+# Pdf readers accept the header (and trailer) anywhere within the first (last) 1024 bytes:
+SNIFF_LENGTH = 1024
+HTML_MARKERS = (b'<!doctype html', b'<html', b'<head', b'<body', b'<script', b'<meta', b'<title',
+                b'<div', b'<p', b'<!--', b'<?xml')
+
+
+def sniff_content(head):
+    """ Return 'pdf', 'html' or 'other' for the first bytes of a response body. """
+    if PDF_MAGIC in head[:SNIFF_LENGTH]:
+        return 'pdf'
+    start = head[:SNIFF_LENGTH].lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if start.startswith(HTML_MARKERS):
+        return 'html'
+    return 'other'
+
+
+def peek_response(response, nbytes=SNIFF_LENGTH, chunk_size=16*1024):
+    """
+    Read and return (at least) the first nbytes of the (streamed) response body.
+    The response's iter_content() is replaced, so the body can still be read from the start.
+    """
+    chunks = response.iter_content(chunk_size)
+    head = []
+    n = 0
+    for chunk in chunks:
+        head.append(chunk)
+        n += len(chunk)
+        if n >= nbytes:
+            break
+
+    def iter_content(chunk_size=1, decode_unicode=False):  # pylint: disable=W0613
+        """ Iterate over the peeked chunks, then the rest of the body. """
+        return itertools.chain(head, chunks)
+    response.iter_content = iter_content
+    return b''.join(head)
+
+
+def sniff_response(response):
+    """ Return 'pdf', 'html' or 'other' for response, peeking at the start of its body (see peek_response). """
+    kind = sniff_content(peek_response(response))
+    logger.debug("Response from %s (Content-Type: %s) sniffed as %s",
+                 response.url, response.headers.get('Content-Type'), kind)
+    return kind
+
+
+def needs_sniffing(response):
+    """ Whether response has a body starting at the beginning of the file (i.e. not 206 Partial Content or 304). """
+    return bool(response) and response.status_code not in (204, 206, 304)
+
+
+class TailTracker(object):
+    """ Pass chunks through, keeping the last <size> bytes in self.tail. """
+
+    def __init__(self, chunks, size=SNIFF_LENGTH):
+        self.chunks = chunks
+        self.size = size
+        self.tail = b''
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.tail = (self.tail + chunk[-self.size:])[-self.size:]
+            yield chunk
+
+    def has_pdf_eof(self):
+        """ Whether the tail has the pdf %%EOF marker. """
+        return PDF_EOF in self.tail
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Incremental (sqlite) cookie persistence, as an alternative to pickling the whole cookie jar.
+
+Only cookies that have changed since the last load/save are written, and expired
+cookies are dropped when loading. The database uses WAL journaling and a busy timeout,
+so several fetcher processes can share the same cookie file.
+
+Enable with config:
+    cookies_filepath: ~/.config/ezfetcher/cookies.sqlite
+    cookies_backend: sqlite
+
+"""
+
+import os
+import time
+import json
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+from requests.cookies import create_cookie
+
+
+def cookie_key(cookie):
+    """ Return (domain, path, name) key identifying cookie. """
+    return (cookie.domain, cookie.path, cookie.name)
+
+
+def cookie_state(cookie):
+    """ Return tuple of the persisted cookie attributes (except the key). """
+    return (cookie.value, cookie.expires, bool(cookie.secure), bool(cookie.discard),
+            json.dumps(cookie._rest, sort_keys=True))  # pylint: disable=W0212
+
+
+class SqliteCookieStore(object):
+    """
+    Cookie store backed by sqlite, which writes only changed cookies.
+    Safe to share between threads and processes.
+    """
+
+    def __init__(self, filepath, timeout=30):
+        self.filepath = os.path.expanduser(filepath)
+        self._lock = threading.Lock()
+        # Persisted state of cookies as last loaded/saved by this store:
+        self._known = {}
+        self.conn = sqlite3.connect(self.filepath, timeout=timeout, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS cookies ("
+                              "domain TEXT, path TEXT, name TEXT, value TEXT, expires INTEGER, "
+                              "secure INTEGER, discard INTEGER, rest TEXT, "
+                              "PRIMARY KEY (domain, path, name))")
+
+    def close(self):
+        """ Close the database connection. """
+        self.conn.close()
+
+    def load(self, cookiejar):
+        """
+        Load all unexpired cookies into cookiejar, deleting expired cookies from the store.
+        Returns the number of cookies loaded.
+        """
+        now = int(time.time())
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM cookies WHERE expires IS NOT NULL AND expires <= ?", (now,))
+            rows = self.conn.execute("SELECT domain, path, name, value, expires, secure, discard, rest "
+                                     "FROM cookies").fetchall()
+        for domain, path, name, value, expires, secure, discard, rest in rows:
+            cookie = create_cookie(name, value, domain=domain, path=path, expires=expires,
+                                   secure=bool(secure), discard=bool(discard), rest=json.loads(rest or '{}'))
+            cookiejar.set_cookie(cookie)
+            self._known[cookie_key(cookie)] = cookie_state(cookie)
+        logger.debug("%s cookies loaded from %s", len(rows), self.filepath)
+        return len(rows)
+
+    def save(self, cookiejar):
+        """
+        Save cookies that have changed (or been removed) since the last load/save.
+        Returns the number of cookies written or deleted.
+        """
+        current = {cookie_key(cookie): cookie_state(cookie) for cookie in cookiejar}
+        with self._lock:
+            changed = [key + state for key, state in current.items() if self._known.get(key) != state]
+            removed = [key for key in self._known if key not in current]
+            if changed or removed:
+                with self.conn:
+                    self.conn.executemany("INSERT OR REPLACE INTO cookies "
+                                          "(domain, path, name, value, expires, secure, discard, rest) "
+                                          "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", changed)
+                    self.conn.executemany("DELETE FROM cookies WHERE domain = ? AND path = ? AND name = ?",
+                                          removed)
+            self._known = current
+        logger.debug("%s cookies written, %s deleted in %s", len(changed), len(removed), self.filepath)
+        return len(changed) + len(removed)
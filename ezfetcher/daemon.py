@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Long-running fetch daemon, keeping a warm EzClient (connection pools, cookies and login).
+
+Start the daemon with:
+    python -m ezfetcher.daemon serve
+and fetch pdfs through it with the thin client:
+    python -m ezfetcher.daemon fetch <url>          # Prints the saved path
+    python -m ezfetcher.daemon batch urls.txt       # Prints the manifest
+    python -m ezfetcher.daemon status
+    python -m ezfetcher.daemon stop
+or with `python -m ezfetcher --daemon <url>`, which falls back to fetching in-process
+if the daemon is not running.
+
+The daemon listens on a Unix socket (config 'daemon_socket', default ~/.cache/ezfetcher/daemon.sock,
+only accessible by the user), or on localhost HTTP if 'daemon_port' is set. Any local process
+(and any web page in a browser) can connect to a localhost port, so in HTTP mode every request
+must carry the daemon's secret token (header X-Ezfetcher-Token), which the daemon writes to a file
+only the user can read (config 'daemon_token_file', default ~/.cache/ezfetcher/daemon.token).
+The API is JSON over HTTP (POST requests must have Content-Type: application/json):
+    POST /fetch     {"url": <url>, "metadata": {..}, "config": {"pdf_max_age": ..}}  -> manifest entry
+    POST /batch     {"urls": [<url>, ..], "config": {..}}  -> manifest (list of entries)
+    GET  /status    -> uptime, number of jobs, login generation, etc.
+    POST /shutdown
+Per-job config overrides are limited to ALLOWED_OVERRIDES; in particular, clients cannot choose
+where files are saved. The daemon never opens pdfs; the client does that (if configured to)
+when it gets the path back.
+Concurrent jobs for the same article (see coalesce.canonical_key) share one fetch in flight,
+and duplicates within a batch are only fetched once.
+
+Note that the daemon cannot prompt for login credentials, so the login config should use
+'prompt: never' (see ezclient_login_config).
+
+This module only imports the standard library until the daemon is started,
+so the client commands start fast.
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import hmac
+import secrets
+import argparse
+import threading
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+logger = logging.getLogger(__name__)
+
+from .utils import get_config, init_logging, open_pdf, read_urls
+
+DEFAULT_SOCKET = os.path.join('~', '.cache', 'ezfetcher', 'daemon.sock')
+DEFAULT_TOKEN_FILE = os.path.join('~', '.cache', 'ezfetcher', 'daemon.token')
+TOKEN_HEADER = 'X-Ezfetcher-Token'
+# Config keys clients may override per job (none of them affect where files are written):
+ALLOWED_OVERRIDES = frozenset(('pdf_max_age', 'pdf_conditional_get', 'pdf_sniff_content', 'pdf_href_regex',
+                               'pdf_tracking_params'))
+
+
+def get_daemon_address(config):
+    """ Return ('tcp', (host, port)) if config 'daemon_port' is set, otherwise ('unix', socket path). """
+    if config.get('daemon_port'):
+        return 'tcp', (config.get('daemon_host', '127.0.0.1'), int(config['daemon_port']))
+    return 'unix', os.path.expanduser(config.get('daemon_socket') or DEFAULT_SOCKET)
+
+
+def get_token_filepath(config):
+    """ Return path of the file with the daemon's secret token (used in HTTP mode). """
+    return os.path.expanduser(config.get('daemon_token_file') or DEFAULT_TOKEN_FILE)
+
+
+def write_token(filepath):
+    """ Create a new random token, write it to filepath (readable only by the user), and return it. """
+    token = secrets.token_urlsafe(32)
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(token)
+    return token
+
+
+def read_token(filepath):
+    """ Return the daemon token from filepath, or None if there is none. """
+    try:
+        with open(filepath) as fp:
+            return fp.read().strip() or None
+    except OSError:
+        return None
+
+
+class FetchDaemon(object):
+    """
+    Fetches pdfs with a single, long-lived EzClient (shared by all jobs), digest index and
+    resolution cache. At most <workers> jobs (default: config 'pdf_batch_workers') run at once.
+    """
+
+    def __init__(self, config, workers=None):
+        # The daemon never opens pdfs or prompts the user:
+        self.config = dict(config, pdf_open_after_download=False, pdf_href_select='first')
+        self.workers = workers or self.config.get('pdf_batch_workers', 4)
+        self.ezclient = None
+        self.digest_index = None
+        self.resolution_cache = None
+        self.semaphore = threading.BoundedSemaphore(self.workers)
+        self.started = time.time()
+        self.stats = {'jobs': 0, 'ok': 0, 'failed': 0, 'error': 0, 'active': 0, 'coalesced': 0}
+        self._lock = threading.Lock()
+        # Overrides (json) -> SingleFlight, if coalescing is enabled:
+        self.flights = {} if self.config.get('pdf_coalesce_duplicates', True) else None
+        self.server = None
+        self.token = None       # Secret token required from clients in HTTP mode
+
+    def open(self):
+        """ Create the EzClient, digest index and resolution cache. """
+        from .pdffetcher import get_ezclient, get_digest_index, get_resolution_cache
+        if self.ezclient is None:
+            self.ezclient = get_ezclient(self.config)
+            self.digest_index = get_digest_index(self.config)
+            self.resolution_cache = get_resolution_cache(self.config)
+        return self
+
+    def close(self):
+        """ Close digest index and resolution cache, and save cookies. """
+        if self.ezclient is not None:
+            if self.ezclient.cookies_filepath:
+                self.ezclient.save_cookies()
+            self.ezclient.close()
+        for db in (self.digest_index, self.resolution_cache):
+            if db is not None:
+                db.close()
+
+    def job_overrides(self, overrides=None):
+        """ Return the overrides that are allowed for a job (see ALLOWED_OVERRIDES). """
+        if not isinstance(overrides, dict):
+            return {}
+        ignored = set(overrides) - ALLOWED_OVERRIDES
+        if ignored:
+            logger.warning("Ignoring config overrides not allowed for daemon jobs: %s", ", ".join(sorted(ignored)))
+        return {key: value for key, value in overrides.items() if key in ALLOWED_OVERRIDES}
+
+    def job_config(self, overrides=None):
+        """ Return config for a job, with (allowed) overrides. """
+        overrides = self.job_overrides(overrides)
+        return dict(self.config, **overrides) if overrides else self.config
+
+    def flight(self, overrides=None):
+        """ Return the SingleFlight for jobs with (allowed) overrides, or None if coalescing is disabled. """
+        from .coalesce import SingleFlight
+        if self.flights is None:
+            return None
+        key = json.dumps(self.job_overrides(overrides), sort_keys=True)
+        with self._lock:
+            if key not in self.flights:
+                self.flights[key] = SingleFlight()
+            return self.flights[key]
+
+    def fetch(self, url, metadata=None, overrides=None):
+        """ Fetch pdf from url, returning a manifest entry. A fetch of the same article in flight is shared. """
+        from .pdffetcher import duplicate_entry
+        from .coalesce import canonical_key
+        self.open()
+        config = self.job_config(overrides)
+        flight = self.flight(overrides)
+        if flight is None:
+            return self.fetch_one(url, config, metadata)
+        start = time.perf_counter()
+        entry, shared = flight.do(canonical_key(url, config, metadata), self.fetch_one, url, config, metadata)
+        if not shared:
+            return entry
+        with self._lock:
+            self.stats['coalesced'] += 1
+        return duplicate_entry(entry, url, start)
+
+    def fetch_one(self, url, config, metadata=None):
+        """ Fetch pdf from url with job config, returning a manifest entry. """
+        from .pdffetcher import fetch_manifest_entry
+        with self.semaphore:
+            with self._lock:
+                self.stats['active'] += 1
+            try:
+                entry = fetch_manifest_entry(url, config, self.ezclient, metadata=metadata,
+                                             digest_index=self.digest_index, resolution_cache=self.resolution_cache)
+            finally:
+                with self._lock:
+                    self.stats['active'] -= 1
+        with self._lock:
+            self.stats['jobs'] += 1
+            self.stats[entry['status']] += 1
+        return entry
+
+    def fetch_many(self, urls, overrides=None):
+        """ Fetch pdfs from urls concurrently, returning the manifest. Duplicates are only fetched once. """
+        from concurrent.futures import ThreadPoolExecutor
+        from .pdffetcher import duplicate_entry
+        from .coalesce import canonical_key, SingleFlight
+        self.open()
+        config = self.job_config(overrides)
+        batch = SingleFlight(remember=True) if self.flights is not None else None
+
+        def fetch(url):
+            """ Fetch url, or return the entry of a duplicate earlier in the batch. """
+            if batch is None:
+                return self.fetch(url, overrides=overrides)
+            start = time.perf_counter()
+            entry, shared = batch.do(canonical_key(url, config), self.fetch, url, overrides=overrides)
+            if not shared:
+                return entry
+            with self._lock:
+                self.stats['coalesced'] += 1
+            return duplicate_entry(entry, url, start)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(fetch, urls))
+
+    def status(self):
+        """ Return status dict. """
+        with self._lock:
+            status = dict(self.stats)
+        status.update(pid=os.getpid(), uptime=time.time() - self.started, workers=self.workers,
+                      login_generation=self.ezclient.login_generation if self.ezclient is not None else None)
+        return status
+
+    def serve(self, address=None):
+        """ Serve requests on address (see get_daemon_address) until shutdown. """
+        kind, address = address or get_daemon_address(self.config)
+        self.open()
+        if kind == 'unix':
+            if os.path.exists(address):
+                if DaemonClient(('unix', address)).is_running():
+                    raise RuntimeError("A daemon is already listening on %s" % address)
+                os.remove(address)
+            os.makedirs(os.path.dirname(address) or '.', exist_ok=True)
+            self.server = UnixHTTPServer(address, DaemonRequestHandler)
+            os.chmod(address, 0o600)
+        else:
+            token_filepath = get_token_filepath(self.config)
+            self.token = write_token(token_filepath)
+            self.server = ThreadingHTTPServer(address, DaemonRequestHandler)
+        self.server.daemon = self
+        print("ezfetcher daemon (pid %s) listening on %s" % (os.getpid(), address))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            if kind == 'unix' and os.path.exists(address):
+                os.remove(address)
+            if self.token is not None and read_token(token_filepath) == self.token:
+                os.remove(token_filepath)
+            self.close()
+        print("ezfetcher daemon stopped.")
+
+    def shutdown(self):
+        """ Stop serving (from another thread). """
+        if self.server is not None:
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ HTTP server handling each request in a new thread. """
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP server on a Unix socket, handling each request in a new thread. """
+    daemon_threads = True
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """ JSON API of the fetch daemon. """
+
+    def address_string(self):
+        # Unix socket clients have no address:
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        logger.info("%s - %s", self.address_string(), format % args)
+
+    def send_json(self, obj, status=200):
+        """ Send obj as json response. """
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        """ Read json request body. """
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+
+    def authorized(self):
+        """ Whether the request has the daemon's token (if one is required); sends 403 if not. """
+        token = self.server.daemon.token
+        if token is None or hmac.compare_digest(self.headers.get(TOKEN_HEADER) or '', token):
+            return True
+        self.send_json({'error': "Missing or invalid %s header" % TOKEN_HEADER}, 403)
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path == '/status':
+            self.send_json(self.server.daemon.status())
+        else:
+            self.send_json({'error': "Not found: %s" % self.path}, 404)
+
+    def do_POST(self):
+        daemon = self.server.daemon
+        if not self.authorized():
+            return
+        # Browsers can send cross-origin text/plain and form posts without a preflight, but not json:
+        content_type = (self.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self.send_json({'error': "Content-Type must be application/json"}, 415)
+            return
+        try:
+            job = self.read_json()
+        except ValueError as e:
+            self.send_json({'error': "Invalid json: %s" % e}, 400)
+            return
+        if not isinstance(job, dict):
+            self.send_json({'error': "Request body must be a json object"}, 400)
+            return
+        if self.path == '/fetch' and job.get('url'):
+            self.send_json(daemon.fetch(job['url'], metadata=job.get('metadata'), overrides=job.get('config')))
+        elif self.path == '/batch' and isinstance(job.get('urls'), list):
+            self.send_json(daemon.fetch_many(job['urls'], overrides=job.get('config')))
+        elif self.path == '/shutdown':
+            self.send_json({'status': 'shutting down'})
+            daemon.shutdown()
+        else:
+            self.send_json({'error': "Invalid request: %s" % self.path}, 400)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTPConnection over a Unix socket. """
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class DaemonError(Exception):
+    """ The daemon answered, but with an error status or an invalid (non-json) response. """
+    pass
+
+
+class DaemonClient(object):
+    """ Thin client submitting jobs to a running FetchDaemon. """
+
+    def __init__(self, address, timeout=None, token=None):
+        self.kind, self.address = address
+        self.timeout = timeout
+        self.token = token
+
+    def request(self, method, path, obj=None):
+        """
+        Send request, returning the decoded json response. Raises OSError if the daemon is not running,
+        and DaemonError if it responds with an error, or not like a daemon (e.g. a stale or foreign server).
+        """
+        if self.kind == 'unix':
+            conn = UnixHTTPConnection(self.address, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(*self.address, timeout=self.timeout)
+        try:
+            body = json.dumps(obj).encode('utf-8') if obj is not None else None
+            headers = {'Content-Type': 'application/json'}
+            if self.token:
+                headers[TOKEN_HEADER] = self.token
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except http.client.HTTPException as e:
+            raise DaemonError("Invalid response from daemon: %r" % e)
+        finally:
+            conn.close()
+        try:
+            result = json.loads(data.decode('utf-8'))
+        except ValueError:
+            raise DaemonError("Daemon error %s: response is not json: %r" % (response.status, data[:100]))
+        if response.status != 200:
+            error = result.get('error') if isinstance(result, dict) else result
+            raise DaemonError("Daemon error %s: %s" % (response.status, error))
+        return result
+
+    def is_running(self):
+        """ Whether the daemon is listening. """
+        try:
+            self.status()
+            return True
+        except (OSError, DaemonError):
+            return False
+
+    def fetch(self, url, metadata=None, config=None):
+        """ Fetch pdf from url with the daemon and return the manifest entry (incl. filepath). """
+        return self.request('POST', '/fetch', {'url': url, 'metadata': metadata, 'config': config})
+
+    def batch(self, urls, config=None):
+        """ Fetch pdfs from urls with the daemon and return the manifest. """
+        return self.request('POST', '/batch', {'urls': list(urls), 'config': config})
+
+    def status(self):
+        """ Return daemon status. """
+        return self.request('GET', '/status')
+
+    def shutdown(self):
+        """ Stop the daemon. """
+        return self.request('POST', '/shutdown', {})
+
+
+def get_client(config):
+    """ Return DaemonClient for the daemon address in config (with the daemon's token, in HTTP mode). """
+    address = get_daemon_address(config)
+    token = read_token(get_token_filepath(config)) if address[0] == 'tcp' else None
+    return DaemonClient(address, timeout=config.get('daemon_timeout', 600), token=token)
+
+
+def job_overrides(config):
+    """ Return the config keys to pass along with jobs (see ALLOWED_OVERRIDES). """
+    return {key: value for key, value in config.items() if key in ALLOWED_OVERRIDES}
+
+
+def fetch_with_daemon(url, config):
+    """
+    Fetch pdf from url with the running daemon, returning the saved path (or None).
+    Raises OSError if the daemon is not running, and DaemonError if it does not work.
+    """
+    entry = get_client(config).fetch(url, config=job_overrides(config))
+    if not isinstance(entry, dict) or 'status' not in entry:
+        raise DaemonError("Invalid manifest entry from daemon: %r" % (entry,))
+    if entry['status'] != 'ok':
+        print("Daemon could not fetch %s: %s" % (url, entry['error'] or entry['status']))
+        return None
+    return entry['filepath']
+
+
+def main(argv=None):
+    """ Run the daemon, or submit a job to it. """
+    parser = argparse.ArgumentParser(description="Fetch daemon keeping a warm, logged-in EzClient session.")
+    parser.add_argument('command', choices=('serve', 'fetch', 'batch', 'status', 'stop'))
+    parser.add_argument('target', nargs='?', help="Url (fetch) or file with urls, '-' for stdin (batch).")
+    parser.add_argument('--socket', dest='daemon_socket', help="Unix socket path (default: %s)." % DEFAULT_SOCKET)
+    parser.add_argument('--port', type=int, dest='daemon_port', help="Use localhost HTTP on this port instead.")
+    parser.add_argument('--workers', type=int, dest='pdf_batch_workers', help="Number of concurrent downloads.")
+    parser.add_argument('--configfile', help="Load this config file.")
+    parser.add_argument('--loglevel', help="Logging level.")
+    argns = parser.parse_args(argv)
+    kwargs = {k: v for k, v in vars(argns).items() if v is not None}
+    command, target = kwargs.pop('command'), kwargs.pop('target', None)
+    config = get_config(kwargs, kwargs.pop('configfile', None))
+    if command == 'serve':
+        init_logging(kwargs)
+        FetchDaemon(config).serve()
+        return
+    client = get_client(config)
+    try:
+        if command == 'fetch':
+            if not target:
+                parser.error("fetch requires a url.")
+            filepath = fetch_with_daemon(target, config)
+            if not filepath:
+                sys.exit(1)
+            print(filepath)
+            open_pdf(filepath, config)
+        elif command == 'batch':
+            if not target:
+                parser.error("batch requires a file with urls.")
+            if target == '-':
+                urls = read_urls(sys.stdin)
+            else:
+                with open(os.path.expanduser(target)) as fd:
+                    urls = read_urls(fd)
+            json.dump(client.batch(urls, config=job_overrides(config)), sys.stdout, indent=2)
+            print()
+        elif command == 'status':
+            print(json.dumps(client.status(), indent=2))
+        elif command == 'stop':
+            client.shutdown()
+            print("Daemon stopping.")
+    except OSError as e:
+        print("Could not connect to ezfetcher daemon at %s (%s). Start it with: python -m ezfetcher.daemon serve"
+              % (client.address, e))
+        sys.exit(2)
+    except DaemonError as e:
+        print("The ezfetcher daemon at %s failed (%s). Restart it with: python -m ezfetcher.daemon stop/serve"
+              % (client.address, e))
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
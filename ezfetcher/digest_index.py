@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Persistent (sqlite) index of file digests in the pdf download directory.
+
+The index maps path -> (size, mtime, digest), so a file only has to be hashed
+again if its size or mtime has changed. It is also indexed by digest, so we can
+check whether we already have a pdf (under any name) before saving it.
+Additionally, the HTTP validators (ETag, Last-Modified) of the response each file
+was downloaded from are stored by url, so the file can be re-validated with a
+conditional GET instead of being downloaded again.
+
+The digest algorithm (config 'pdf_digest_algorithm', default md5; sha256 is about twice as
+fast on cpus with SHA extensions, blake2b on 64-bit cpus without) is recorded in the index. If an index is opened with another
+algorithm, its digests are dropped, and files are re-hashed as they are needed. If no algorithm
+is given, the index keeps the one it has (md5 for new indexes).
+
+Usage:
+    index = DigestIndex("~/Downloads/.ezfetcher_digests.sqlite", algorithm='blake2b')
+    index.get_digest(filepath)      # Cached digest (hashes file only if new/changed)
+    index.find_by_digest(digest)    # List of (existing) paths with this digest
+    index.scan(directory)           # Add/update all files in directory, hashing them in a process pool
+
+Build, update or verify the index from the command line with:
+    python -m ezfetcher.digest_index <directory> [--algorithm blake2b] [--workers 8] [--verify]
+
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import argparse
+import itertools
+import logging
+logger = logging.getLogger(__name__)
+
+from .utils import filehexdigest, get_pdf_download_dir, get_config, DEFAULT_DIGEST
+
+DEFAULT_INDEX_FILENAME = ".ezfetcher_digests.sqlite"
+
+
+class DigestIndex(object):
+    """
+    Persistent index of path -> (size, mtime, digest) and digest -> paths.
+    Can be shared between threads.
+    """
+
+    def __init__(self, filepath, algorithm=None):
+        if algorithm is not None and algorithm not in hashlib.algorithms_available:
+            raise ValueError("Unknown digest algorithm: %r" % algorithm)
+        self.filepath = os.path.expanduser(filepath)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filepath, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                              "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_digest ON files (digest)")
+            # HTTP validators of the response each file was saved from, for conditional GET:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS validators ("
+                              "url TEXT PRIMARY KEY, path TEXT, etag TEXT, last_modified TEXT, "
+                              "content_length INTEGER, validated REAL)")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(validators)")]
+            if 'validated' not in columns:
+                # Index created by an older version:
+                self.conn.execute("ALTER TABLE validators ADD COLUMN validated REAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'algorithm'").fetchone()
+            # Indexes created by older versions have md5 digests:
+            indexed_algorithm = row[0] if row else DEFAULT_DIGEST
+            if algorithm is None:
+                algorithm = indexed_algorithm
+            elif (indexed_algorithm != algorithm
+                  and self.conn.execute("SELECT 1 FROM files LIMIT 1").fetchone()):
+                # (New and empty indexes have no digests to drop.)
+                logger.warning("Digest index %s has %s digests; dropping them to use %s.",
+                               self.filepath, indexed_algorithm, algorithm)
+                self.conn.execute("DELETE FROM files")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('algorithm', ?)", (algorithm,))
+        self.algorithm = algorithm
+
+    def close(self):
+        """ Close the database connection. """
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, path, digest, stat=None):
+        """ Add/update path with digest. Size and mtime are taken from <stat> (default: os.stat(path)). """
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files (path, size, mtime, digest) VALUES (?, ?, ?, ?)",
+                              (path, stat.st_size, stat.st_mtime_ns, digest))
+
+    def add_many(self, rows):
+        """ Add/update (path, size, mtime_ns, digest) rows in a single transaction. """
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO files (path, size, mtime, digest) VALUES (?, ?, ?, ?)",
+                                  [(os.path.abspath(path), size, mtime, digest) for path, size, mtime, digest in rows])
+
+    def remove(self, path):
+        """ Remove path from the index. """
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(path),))
+
+    def lookup(self, path, stat=None):
+        """
+        Return the indexed digest of path, if the file's size and mtime still match the index.
+        Otherwise returns None.
+        """
+        path = os.path.abspath(path)
+        if stat is None:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+        with self._lock:
+            row = self.conn.execute("SELECT size, mtime, digest FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        return None
+
+    def get_digest(self, path):
+        """
+        Return digest of file at path, using the index if the file is unchanged.
+        New or changed files are hashed and added to the index.
+        Returns None (and removes path from index) if the file does not exist.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.remove(path)
+            return None
+        digest = self.lookup(path, stat=stat)
+        if digest is None:
+            logger.debug("Hashing new/changed file %s", path)
+            digest = filehexdigest(path, self.algorithm)
+            self.add(path, digest, stat=stat)
+        return digest
+
+    def find_by_digest(self, digest):
+        """
+        Return list of indexed paths with the given digest.
+        Paths that no longer exist or have changed on disk are pruned from the index.
+        """
+        with self._lock:
+            rows = self.conn.execute("SELECT path FROM files WHERE digest = ?", (digest,)).fetchall()
+        paths = []
+        for (path,) in rows:
+            if self.lookup(path) == digest:
+                paths.append(path)
+            elif not os.path.exists(path):
+                self.remove(path)
+        return paths
+
+    def set_validators(self, url, path, headers):
+        """
+        Store the validators (ETag, Last-Modified, Content-Length) from response headers
+        for the file at path, saved from url (now).
+        """
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        content_length = headers.get('Content-Length')
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO validators "
+                              "(url, path, etag, last_modified, content_length, validated) VALUES (?, ?, ?, ?, ?, ?)",
+                              (url, os.path.abspath(path), etag, last_modified,
+                               int(content_length) if content_length else None, time.time()))
+
+    def mark_validated(self, url):
+        """ Record that the file saved from url has been re-validated (e.g. by a 304 response) now. """
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE validators SET validated = ? WHERE url = ?", (time.time(), url))
+
+    def get_validators(self, url):
+        """
+        Return dict with path, etag, last_modified, content_length and validated (time) stored for url,
+        or None if there are no validators for url, or the file has been changed or deleted since.
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT path, etag, last_modified, content_length, validated FROM validators "
+                                    "WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        if self.lookup(row[0]) is None:
+            # File no longer exists or has changed on disk:
+            return None
+        return dict(zip(('path', 'etag', 'last_modified', 'content_length', 'validated'), row))
+
+    def fresh_path(self, url, max_age):
+        """ Return path of the file saved from url, if it was saved or re-validated less than max_age seconds ago. """
+        validators = self.get_validators(url)
+        if validators and validators['validated'] and time.time() - validators['validated'] < max_age:
+            return validators['path']
+        return None
+
+    def conditional_headers(self, url):
+        """ Return If-None-Match/If-Modified-Since request headers for url (empty if no validators). """
+        validators = self.get_validators(url)
+        headers = {}
+        if validators:
+            if validators['etag']:
+                headers['If-None-Match'] = validators['etag']
+            if validators['last_modified']:
+                headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def scan(self, directory, extensions=('.pdf',), workers=None, rehash=False, use_mmap=False, batch_size=1000):
+        """
+        Add/update all files in directory with the given extensions (None for all files),
+        and remove index entries for files in directory that no longer exist.
+        New and changed files (all files, if rehash is True) are hashed by a pool of <workers>
+        processes (default: number of cpus), and added to the index in batches of <batch_size>.
+        Returns dict with the number of files, files hashed, bytes hashed, elapsed seconds, and
+        'changed', the list of files whose digest changed although their size and mtime did not
+        (only possible with rehash, e.g. bit rot).
+        """
+        start = time.perf_counter()
+        directory = os.path.abspath(os.path.expanduser(directory))
+        with self._lock:
+            rows = self.conn.execute("SELECT path, size, mtime, digest FROM files WHERE path LIKE ?",
+                                     (os.path.join(directory, '%'),)).fetchall()
+        indexed = {row[0]: row[1:] for row in rows if os.path.dirname(row[0]) == directory}
+        seen = set()
+        todo = []   # (path, size, mtime_ns)
+        for entry in os.scandir(directory):
+            if not entry.is_file() or entry.name == os.path.basename(self.filepath):
+                continue
+            if extensions and not entry.name.lower().endswith(tuple(extensions)):
+                continue
+            seen.add(entry.path)
+            stat = entry.stat()
+            if rehash or indexed.get(entry.path, (None, None))[:2] != (stat.st_size, stat.st_mtime_ns):
+                todo.append((entry.path, stat.st_size, stat.st_mtime_ns))
+        result = {'files': len(seen), 'hashed': 0, 'bytes': 0, 'changed': [], 'errors': 0}
+        paths = [path for path, _, _ in todo]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers > 1 and len(todo) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=min(workers, len(todo)))
+            digests = executor.map(hash_file, paths, itertools.repeat(self.algorithm), itertools.repeat(use_mmap),
+                                   chunksize=max(1, min(64, len(todo) // (4*workers))))
+        else:
+            executor = None
+            digests = map(hash_file, paths, itertools.repeat(self.algorithm), itertools.repeat(use_mmap))
+        try:
+            batch = []
+            for (path, size, mtime), digest in zip(todo, digests):
+                if digest is None:
+                    result['errors'] += 1
+                    continue
+                old = indexed.get(path)
+                if old is not None and old[:2] == (size, mtime) and old[2] != digest:
+                    logger.warning("Digest of %s has changed, but its size and mtime have not!", path)
+                    result['changed'].append(path)
+                batch.append((path, size, mtime, digest))
+                result['hashed'] += 1
+                result['bytes'] += size
+                if len(batch) >= batch_size:
+                    self.add_many(batch)
+                    batch = []
+            self.add_many(batch)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        removed = [(path,) for path in indexed if path not in seen]
+        if removed:
+            with self._lock, self.conn:
+                self.conn.executemany("DELETE FROM files WHERE path = ?", removed)
+        result['elapsed'] = time.perf_counter() - start
+        logger.info("Scanned %s files in %s, %s hashed (%.1f MB) in %.1f s.", len(seen), directory,
+                    result['hashed'], result['bytes'] / 1024**2, result['elapsed'])
+        return result
+
+
+def hash_file(path, algorithm=DEFAULT_DIGEST, use_mmap=False):
+    """ Return hex digest of file at path, or None if it cannot be read (runs in DigestIndex.scan's workers). """
+    try:
+        return filehexdigest(path, algorithm, use_mmap=use_mmap)
+    except OSError as e:
+        logger.warning("Could not hash %s: %s", path, e)
+        return None
+
+
+def get_digest_index(config):
+    """
+    Return DigestIndex for the path given by config key 'pdf_digest_index', or None if not configured.
+    If the value is True, the index is placed in the pdf download directory.
+    The digest algorithm is given by config key 'pdf_digest_algorithm' (default: the one
+    recorded in the index, md5 for a new index).
+    """
+    filepath = config.get('pdf_digest_index')
+    if not filepath:
+        return None
+    if filepath is True:
+        filepath = os.path.join(get_pdf_download_dir(config), DEFAULT_INDEX_FILENAME)
+    return DigestIndex(filepath, algorithm=config.get('pdf_digest_algorithm'))
+
+
+def main(argv=None):
+    """ Build/update (or verify) digest index for a directory, and report the hashing throughput. """
+    parser = argparse.ArgumentParser(description="Build or update the digest index of a download directory.")
+    parser.add_argument('directory', help="Directory to index.")
+    parser.add_argument('--index', help="Index file (default: %s in directory)." % DEFAULT_INDEX_FILENAME)
+    parser.add_argument('--all-files', action="store_true", help="Index all files, not only pdf files.")
+    parser.add_argument('--algorithm',
+                        help="Digest algorithm, e.g. md5, sha256, blake2b (default: config 'pdf_digest_algorithm', "
+                        "else the one recorded in the index, else %s). "
+                        "Changing the algorithm of an existing index re-hashes all files." % DEFAULT_DIGEST)
+    parser.add_argument('--workers', type=int, help="Number of hashing processes (default: number of cpus).")
+    parser.add_argument('--mmap', action="store_true", help="Memory-map files instead of reading them in blocks.")
+    parser.add_argument('--verify', action="store_true",
+                        help="Re-hash all files, reporting files whose content changed without a change of mtime.")
+    argns = parser.parse_args(argv)
+    filepath = argns.index or os.path.join(argns.directory, DEFAULT_INDEX_FILENAME)
+    algorithm = argns.algorithm or get_config({}).get('pdf_digest_algorithm')
+    with DigestIndex(filepath, algorithm=algorithm) as index:
+        algorithm = index.algorithm
+        result = index.scan(argns.directory, extensions=None if argns.all_files else ('.pdf',),
+                            workers=argns.workers, rehash=argns.verify, use_mmap=argns.mmap)
+    elapsed = result['elapsed']
+    print("%s of %s files hashed (%.1f MB, %s) in %.1f s: %.1f files/s, %.1f MB/s. Index saved to %s" % (
+        result['hashed'], result['files'], result['bytes'] / 1024**2, algorithm, elapsed,
+        result['hashed'] / elapsed if elapsed else 0, result['bytes'] / 1024**2 / elapsed if elapsed else 0,
+        filepath))
+    if result['errors']:
+        print("%s files could not be read." % result['errors'])
+    if argns.verify:
+        for path in result['changed']:
+            print("CHANGED: %s" % path)
+        print("%s files changed on disk without a change of mtime." % len(result['changed']))
+
+
+if __name__ == '__main__':
+    main()
@@ -24,3 +24,25 @@ class LoginRedirectException(requests.exceptions.TooManyRedirects):
     """ Exception for when the user needs to log in again. """
     pass
 
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ Exception for fast-failed requests to a host that is currently failing. """
+    pass
+
+
+class FetchFailed(Exception):
+    """
+    No pdf could be fetched, for the given <reason> (no pdf link found, not a pdf, incomplete download, ...).
+    <retryable> is True if trying again later may succeed, e.g. for a download kept for resuming.
+    """
+
+    def __init__(self, reason, retryable=False):
+        super().__init__(reason)
+        self.reason = reason
+        self.retryable = retryable
+
+
+def http_failure(response):
+    """ Return FetchFailed for an error response (retryable for 429 Too Many Requests and 5xx). """
+    return FetchFailed("HTTP %s from %s" % (response.status_code, response.url),
+                       retryable=response.status_code == 429 or response.status_code >= 500)
@@ -61,22 +61,28 @@ SimpleSAML PHP (SSP) and EzProxy:
 """
 
 import os
+import time
+import socket
+import threading
 from requests import Session
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 from urllib.parse import urlparse
-import yaml
 import pickle
+import sqlite3
 #from six import string_types
 import logging
 logger = logging.getLogger(__name__)
 
-from .login_adaptors import login_adaptors, login_domains
-from .url_proxy_utils import url_is_proxied, proxy_url_rewrite
+from .login_adaptors import get_login_adaptor, login_domains
+from .url_proxy_utils import get_proxy_rewriter
 from .utils import save_config, load_config
-
-try:
-    from .lib.cookiesnatcher.chrome_extract import get_chrome_cookies
-except ImportError as e:
-    logger.warning("ezfetcher.ezclient: %s - cookie_snatch_from will not function.", e)
+from .cookie_store import SqliteCookieStore
+from .scheduler import get_scheduler
+from .retry import get_retry_policy, get_circuit_breaker
+from .session_refresh import get_session_refresher
+from .metrics import get_metrics, request_event
 
 __version__ = 0.1
 
@@ -91,6 +97,62 @@ def load_cookies(fd):
     return pickle.load(fd)
 
 
+class PoolAdapter(HTTPAdapter):
+    """
+    HTTPAdapter with connection pool settings and optional keep-alive control.
+    If keep_alive is False, 'Connection: close' is sent with every request.
+    If tcp_keepalive is True, SO_KEEPALIVE is enabled on the sockets,
+    so idle pooled connections are not silently dropped by firewalls.
+    """
+
+    def __init__(self, keep_alive=True, tcp_keepalive=False, **kwargs):
+        self.keep_alive = keep_alive
+        self.tcp_keepalive = tcp_keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.tcp_keepalive:
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + \
+                [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+    def add_headers(self, request, **kwargs):
+        if not self.keep_alive:
+            request.headers['Connection'] = 'close'
+
+
+class EzSession(Session):
+    """
+    Session which can route requests to adaptors by host (suffix), not only by url prefix.
+    This is needed for host-rewriting proxies, where all proxied hosts share a suffix,
+    e.g. www.nature.com.ez.statsbiblioteket.dk:2048.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.host_adapters = []  # list of (host_suffix, adapter) tuples
+
+    def mount_host(self, host_suffix, adapter):
+        """ Use adapter for all urls whose netloc ends with host_suffix. """
+        self.host_adapters = [(suffix, a) for suffix, a in self.host_adapters if suffix != host_suffix]
+        self.host_adapters.append((host_suffix, adapter))
+        # Longest (most specific) suffix first:
+        self.host_adapters.sort(key=lambda item: len(item[0]), reverse=True)
+
+    def get_adapter(self, url):
+        if self.host_adapters:
+            netloc = urlparse(url).netloc.lower()
+            for host_suffix, adapter in self.host_adapters:
+                if netloc.endswith(host_suffix):
+                    return adapter
+        return super().get_adapter(url)
+
+    def close(self):
+        for _, adapter in self.host_adapters:
+            adapter.close()
+        super().close()
+
+
 class EzClient(object):
     """
     A special session object able to route requests through a configured ezproxy.
@@ -103,7 +165,7 @@ class EzClient(object):
         found in config.
         If you want to load default config, do it afterwards...
         """
-        self.session = Session()
+        self.session = EzSession()
         # Init config:
         self.config = config if config is not None else {}
         self.config_filepath = config_filepath
@@ -114,6 +176,7 @@ class EzClient(object):
             self.session.headers.update(self.config['ezclient_headers'])
         if headers:
             self.session.headers.update(headers)
+        self.cookie_store = None  # SqliteCookieStore, if cookies_backend is 'sqlite'
         # Inject cookies in session: Note that cookies is a RequestsCookieJar, not dict.
         #self.cookies_filename = cookies_filepath or config.get('cookies_filepath')
         # cookies_filepath is now *only* present in config.
@@ -128,6 +191,21 @@ class EzClient(object):
         self.login_hostname = []
         self.login_config = {}
         self.set_login_adaptor()
+        # Single-flight login: Only one thread logs in, the others wait and retry.
+        self._login_lock = threading.Lock()
+        self.login_generation = 0  # Incremented after every login attempt
+        # Background re-login before the session expires (see session_refresh module):
+        self.session_refresher = get_session_refresher(self, self.config)
+        # Connection pools:
+        self.configure_pools()
+        # Per-host rate limits (hosts are taken from de-proxied urls):
+        self.scheduler = get_scheduler(self.config, deproxy=self.deproxy)
+        # Retries and per-host circuit breakers:
+        self.retry_policy = get_retry_policy(self.config)
+        self.circuit_breaker = get_circuit_breaker(self.config)
+        self.timeout = self.config.get('ezclient_timeout', (15, 120))
+        # Structured per-request events (see metrics module):
+        self.metrics = get_metrics(self.config)
 
         if self.config.get('ezclient_useragent'):
             self.session.headers['User-Agent'] = self.config['ezclient_useragent']
@@ -147,13 +225,60 @@ class EzClient(object):
         if login_adaptor_name is None:
             login_adaptor_name = self.config.get('ezclient_login_adaptor')
         if login_adaptor_name:
-            self.login_adaptor = login_adaptors[login_adaptor_name]
+            self.login_adaptor = get_login_adaptor(login_adaptor_name)
             self.login_hostname = login_domains.get(login_adaptor_name)
             self.login_config = self.config.get('ezclient_login_config', {}).get(login_adaptor_name)
             logger.info("Using named login_adaptor '%s'", login_adaptor_name)
         else:
             logger.info("No login_adaptor given or specified in config...")
 
+    def mount_pool(self, hosts, pool_connections=10, pool_maxsize=10, pool_block=False,
+                   keep_alive=True, tcp_keepalive=False, max_retries=0):
+        """
+        Mount a PoolAdapter with the given connection pool settings for hosts.
+        <hosts> is a host (suffix) or list of hosts, e.g. '.ez.statsbiblioteket.dk:2048'.
+        <pool_connections> is the number of per-host pools to keep,
+        <pool_maxsize> the max number of connections kept per host, and if <pool_block>
+        is True, requests wait for a free connection instead of opening extra ones.
+        """
+        adapter = PoolAdapter(keep_alive=keep_alive, tcp_keepalive=tcp_keepalive,
+                              pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              pool_block=pool_block, max_retries=max_retries)
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        for host in hosts:
+            self.session.mount_host(host.lower(), adapter)
+        return adapter
+
+    def configure_pools(self, pool_config=None):
+        """
+        Mount connection pool adapters as specified by pool_config (default: config['ezclient_pool']).
+        pool_config is a dict with optional sections 'default', 'proxy' and 'login', each a dict
+        with mount_pool() keyword arguments. 'default' applies to all http(s) urls, 'proxy' to the
+        proxy host(s) from proxy_url_fmt and 'login' to the login adaptor's host(s) plus any
+        additional 'hosts' given in the section.
+        """
+        if pool_config is None:
+            pool_config = self.config.get('ezclient_pool')
+        if not pool_config:
+            return
+        if pool_config.get('default'):
+            default = dict(pool_config['default'])
+            adapter = PoolAdapter(**default)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+        if pool_config.get('proxy') and self.proxy_rewriter and self.proxy_rewriter.netloc_suffix:
+            self.mount_pool(self.proxy_rewriter.netloc_suffix, **pool_config['proxy'])
+        if pool_config.get('login'):
+            login = dict(pool_config['login'])
+            hosts = login.pop('hosts', None) or []
+            if isinstance(hosts, str):
+                hosts = [hosts]
+            if self.login_hostname:
+                hosts += [self.login_hostname] if isinstance(self.login_hostname, str) else list(self.login_hostname)
+            if hosts:
+                self.mount_pool(hosts, **login)
+
     @property
     def headers(self):
         """ Return session headers. """
@@ -174,6 +299,27 @@ class EzClient(object):
         if cookies_filepath:
             self.config['cookies_filepath'] = cookies_filepath
 
+    @property
+    def cookies_backend(self):
+        """
+        Returns cookie persistence backend, 'pickle' or 'sqlite'.
+        Uses config key 'cookies_backend'; if not given, 'sqlite' is used for cookie
+        files with .sqlite or .db extension, and 'pickle' otherwise.
+        """
+        backend = self.config.get('cookies_backend')
+        if not backend:
+            ext = os.path.splitext(self.cookies_filepath or '')[1].lower()
+            backend = 'sqlite' if ext in ('.sqlite', '.db') else 'pickle'
+        return backend
+
+    def get_cookie_store(self, filepath):
+        """ Return SqliteCookieStore for filepath (re-using the current store if it is for the same file). """
+        if self.cookie_store is None or self.cookie_store.filepath != filepath:
+            if self.cookie_store is not None:
+                self.cookie_store.close()
+            self.cookie_store = SqliteCookieStore(filepath)
+        return self.cookie_store
+
     def save_config(self, filepath=None):
         """ Save config to file. """
         if filepath is None:
@@ -214,6 +360,11 @@ class EzClient(object):
 
     def snatch_chrome_cookie(self, cookie_keys=None, cookies_domain=None):
         """ Update cookies from Chrome's cookie database. """
+        try:
+            from .lib.cookiesnatcher.chrome_extract import get_chrome_cookies
+        except ImportError as e:
+            logger.warning("ezfetcher.ezclient: %s - cookie_snatch_from will not function.", e)
+            return None
         cookie_keys = cookie_keys or self.config['cookie_keys']
         cookies_domain = cookies_domain or self.config['cookies_domain']
         if cookie_keys and cookies_domain:
@@ -252,24 +403,161 @@ class EzClient(object):
             self.save_cookies()
         return r
 
+    @property
+    def proxy_rewriter(self):
+        """ Return ProxyRewriter for the configured proxy_url_fmt (or None). """
+        if self.config.get('proxy_url_fmt'):
+            return get_proxy_rewriter(self.config['proxy_url_fmt'])
+
+    def deproxy(self, url):
+        """ Return url with the proxy rewrite (if any) reversed. """
+        rewriter = self.proxy_rewriter
+        return rewriter.deproxy(url) if rewriter else url
+
     def ensure_proxy(self, url):
         """ Determine if proxy needs to be applied to url. """
-        if self.use_proxy(url) and not url_is_proxied(url, self.config['proxy_url_fmt']):
-            url = proxy_url_rewrite(url, self.config['proxy_url_fmt'])
+        if self.use_proxy(url):
+            url = self.proxy_rewriter.rewrite(url)
         return url
 
-    def get(self, url):
-        """ Get url """
-        url = self.ensure_proxy(url)
+    def is_login_redirect(self, response):
+        """ Whether response has been redirected to the login page. """
+        return bool(self.login_hostname) and urlparse(response.url).netloc in self.login_hostname
+
+    def login_single_flight(self, response, generation, url, **kwargs):
+        """
+        Log in after a redirect to the login page, coalescing concurrent logins:
+        If another thread has logged in since <generation> (the login_generation when
+        our request was sent), we simply wait for that login and retry the original
+        request with the fresh cookies. Otherwise we do the login ourselves,
+        while other threads wait for us.
+        """
+        with self._login_lock:
+            if self.login_generation == generation:
+                print("Redirect to login page detected, attempting login...")
+                try:
+                    r = self.login_after_redirect(response)
+                finally:
+                    self.login_generation += 1
+                if self.session_refresher is not None and r and not self.is_login_redirect(r):
+                    self.session_refresher.login_done()
+                return r
+        logger.info("Login was done by another thread, retrying %s", url)
+        response.close()
+        r = self.send(url, **kwargs)
+        if self.is_login_redirect(r):
+            logger.warning("Still redirected to login page after re-login: %s", r.url)
+        return r
+
+    def send_once(self, url, **kwargs):
+        """
+        Get (already proxied) url with session.get(), within the per-host
+        rate limits of the scheduler (if any).
+        """
+        if self.timeout:
+            kwargs.setdefault('timeout', tuple(self.timeout) if isinstance(self.timeout, list) else self.timeout)
+        if self.scheduler is None:
+            return self.session.get(url, **kwargs)
+        return self.scheduler.request(url, lambda: self.session.get(url, **kwargs))
+
+    def send(self, url, **kwargs):
+        """
+        Get (already proxied) url, retrying connection errors, timeouts and retryable
+        status codes according to the retry policy. Requests to hosts whose circuit
+        breaker is open fail immediately with CircuitOpenError.
+        """
+        host = urlparse(self.deproxy(url)).netloc
+        attempt = 0
+        while True:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.check(host)
+            try:
+                r = self.send_once(url, **kwargs)
+            except (RequestsConnectionError, Timeout) as e:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_failure(host)
+                if self.retry_policy is None or attempt >= self.retry_policy.max_retries:
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                logger.warning("%s getting %s, retrying in %.1f s...", type(e).__name__, url, delay)
+            except Exception:
+                # E.g. TooManyRedirects or ChunkedEncodingError; not retried, but must release a half-open trial:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_failure(host)
+                raise
+            except BaseException:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.release(host)
+                raise
+            else:
+                if self.retry_policy is None or not self.retry_policy.is_retryable_status(r.status_code):
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.record_success(host)
+                    return r
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record_failure(host)
+                if attempt >= self.retry_policy.max_retries:
+                    return r
+                delay = self.retry_policy.delay(attempt, r)
+                logger.warning("Got %s from %s, retrying in %.1f s...", r.status_code, url, delay)
+                r.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        """
+        Get url. Keyword arguments are passed on to session.get(),
+        e.g. use stream=True to defer downloading the response body.
+        A 'request' event is emitted to the metrics hooks (if any); for streamed
+        responses, when the response is closed.
+        """
+        start = time.perf_counter()
+        original_url, url = url, self.ensure_proxy(url)
+        # Events are only built when there is a hook to emit them to:
+        event = request_event(original_url, url, rewrite_s=time.perf_counter() - start) if self.metrics.hooks else None
         logger.info("Getting %s", url)
-        r = self.session.get(url)
-        logger.debug("- %s bytes obtained from %s", len(r.content), url)
-        parsed = urlparse(r.url)
-        if parsed.netloc in self.login_hostname:
-            print("Redirect to login page detected, attempting login...")
-            r = self.login_after_redirect(r)
+        generation = self.login_generation
+        if self.session_refresher is not None and url != original_url:
+            self.session_refresher.seen(original_url)
+        try:
+            r = self.send(url, **kwargs)
+            if kwargs.get('stream'):
+                logger.debug("- Streaming response (Content-Length: %s) from %s",
+                             r.headers.get('Content-Length'), url)
+            else:
+                logger.debug("- %s bytes obtained from %s", len(r.content), url)
+            if self.is_login_redirect(r):
+                login_start = time.perf_counter()
+                r = self.login_single_flight(r, generation, url, **kwargs)
+                if event is not None:
+                    event.update(login=True, login_s=time.perf_counter() - login_start)
+        except Exception as e:
+            if event is not None:
+                event.update(error=repr(e), elapsed_s=time.perf_counter() - start)
+                self.metrics.emit(event)
+            raise
+        if r is not None:
+            r.requested_url = url
+        if event is not None and r is not None:
+            self.metrics.track_request(r, event, start)
         return r
 
+    def close(self):
+        """
+        Stop the background session refresh (if any), close the session's connection pools,
+        and close the metrics hooks (flushing e.g. the metrics log file).
+        """
+        if self.session_refresher is not None:
+            self.session_refresher.stop()
+        self.session.close()
+        self.metrics.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def get_session_state(self):
         """
         Returns a dict that should be usable to persist/recreate session state.
@@ -296,11 +584,14 @@ class EzClient(object):
         filepath = os.path.expanduser(filepath)
         logger.info("Saving cookies to file: %s", filepath)
         try:
-            with open(filepath, 'wb') as fd:
-                save_cookies(fd, self.cookies)
+            if self.cookies_backend == 'sqlite':
+                self.get_cookie_store(filepath).save(self.cookies)
+            else:
+                with open(filepath, 'wb') as fd:
+                    save_cookies(fd, self.cookies)
             self.cookies_filepath = filepath
-        except FileNotFoundError:
-            logger.error("Could not save cookies to file: %s", filepath)
+        except (FileNotFoundError, sqlite3.OperationalError) as e:
+            logger.error("Could not save cookies to file: %s (%s)", filepath, e)
 
     def load_cookies(self, filepath=None):
         """ Saves session cookies """
@@ -310,6 +601,13 @@ class EzClient(object):
             return
         filepath = os.path.expanduser(filepath)
         logger.info("Loading cookies from file: %s", filepath)
+        if self.cookies_backend == 'sqlite':
+            try:
+                self.get_cookie_store(filepath).load(self.cookies)
+                self.cookies_filepath = filepath
+            except sqlite3.OperationalError as e:
+                logger.error("Could not load cookies from file: %s (%s)", filepath, e)
+            return
         try:
             with open(filepath, 'rb') as fd:
                 cookiejar = load_cookies(fd)
@@ -330,7 +628,8 @@ proxy_login_adaptor: AU_lib
 proxy_url_fmt: https://{netloc}.ez.statsbiblioteket.dk:2048/{path}
 ezclient_useragent: Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36
 """
-    config = yaml.load(cfg)
+    import yaml
+    config = yaml.safe_load(cfg)
     client = EzClient(config)
 
     # test_url = "http://www.nature.com.ez.statsbiblioteket.dk:2048/nature/journal/v440/n7082/full/nature04586.html"
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Durable (sqlite) job queue for large batch runs.
+
+Every url is a job with a state:
+    pending -> resolving -> downloading -> done
+                                        -> failed (with the error/reason)
+The resolved pdf url and saved filepath are recorded as well. Workers claim pending jobs
+atomically (in an immediate transaction, so several processes can share a queue file).
+If a run crashes or is interrupted, the jobs that were in flight are put back to pending
+when the queue is run again, and the run continues where it left off; done jobs are never
+fetched again. Jobs are only taken back from workers that are no longer running: each job
+records its worker (host:pid:thread), and jobs of a worker on this host are recovered if
+its process is gone. Jobs of workers on other hosts (sharing the queue file over a network
+filesystem) are only recovered after config 'pdf_queue_stale_after' seconds. Jobs for the same article (see coalesce.canonical_key) are only fetched once:
+duplicates wait for the job fetching it (or take the path of a job already done).
+Failed jobs record why they failed (no pdf link, HTTP error, login failure, ...). Failures that may
+go away (connection errors, 429/5xx responses, incomplete downloads kept for resuming) are retried
+up to config 'pdf_queue_max_attempts' times, waiting 'pdf_queue_retry_delay' seconds (doubled
+for each attempt) before retrying.
+
+Usage:
+    python -m ezfetcher --batch urls.txt --queue harvest.sqlite    # Add urls to the queue and run it
+    python -m ezfetcher --queue harvest.sqlite                     # Resume
+    python -m ezfetcher.job_queue harvest.sqlite [--retry-failed] [--manifest manifest.json]
+
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+from contextlib import contextmanager
+import logging
+logger = logging.getLogger(__name__)
+
+
+PENDING, RESOLVING, DOWNLOADING, DONE, FAILED = 'pending', 'resolving', 'downloading', 'done', 'failed'
+STATES = (PENDING, RESOLVING, DOWNLOADING, DONE, FAILED)
+IN_FLIGHT = (RESOLVING, DOWNLOADING)
+
+
+class JobQueue(object):
+    """
+    Persistent queue of url jobs. Can be shared between threads and processes.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = os.path.expanduser(filepath)
+        self._lock = threading.Lock()
+        # Autocommit mode; transactions are started explicitly (see _transaction):
+        self.conn = sqlite3.connect(self.filepath, timeout=60, check_same_thread=False, isolation_level=None)
+        with self._transaction():
+            self.conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                              "id INTEGER PRIMARY KEY, url TEXT UNIQUE, state TEXT, pdf_url TEXT, filepath TEXT, "
+                              "error TEXT, attempts INTEGER DEFAULT 0, worker TEXT, updated REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+            if 'retry_at' not in columns:
+                # Queue file from before retries were added:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN retry_at REAL")
+
+    def close(self):
+        """ Close the database connection. """
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def _transaction(self):
+        """ Immediate transaction, i.e. holding the database write lock (also across processes). """
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def add(self, urls):
+        """ Add urls as pending jobs. Urls already in the queue (in any state) are skipped. Returns number added. """
+        now = time.time()
+        with self._transaction():
+            before = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO jobs (url, state, updated) VALUES (?, ?, ?)",
+                                  [(url, PENDING, now) for url in urls])
+            return self.conn.total_changes - before
+
+    def claim(self, worker=None):
+        """
+        Atomically claim the next pending job (not waiting to be retried), setting it to resolving.
+        Returns (id, url), or None if none.
+        """
+        with self._transaction():
+            row = self.conn.execute("SELECT id, url FROM jobs WHERE state = ? AND (retry_at IS NULL OR retry_at <= ?) "
+                                    "ORDER BY id LIMIT 1", (PENDING, time.time())).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE jobs SET state = ?, worker = ?, attempts = attempts + 1, updated = ? "
+                                  "WHERE id = ?", (RESOLVING, worker, time.time(), row[0]))
+        return row
+
+    def set_state(self, job_id, state, pdf_url=None):
+        """ Set state of job (and its resolved pdf url, if given). """
+        with self._transaction():
+            self.conn.execute("UPDATE jobs SET state = ?, pdf_url = COALESCE(?, pdf_url), updated = ? WHERE id = ?",
+                              (state, pdf_url, time.time(), job_id))
+
+    def finish(self, job_id, filepath):
+        """ Mark job done, with the path of the saved pdf. """
+        with self._transaction():
+            self.conn.execute("UPDATE jobs SET state = ?, filepath = ?, error = NULL, updated = ? WHERE id = ?",
+                              (DONE, filepath, time.time(), job_id))
+
+    def fail(self, job_id, error, retryable=False, max_attempts=1, retry_delay=0):
+        """
+        Record that job failed, with the reason. If the failure is retryable and the job has been
+        attempted fewer than max_attempts times, it is put back to pending, to be retried after
+        retry_delay seconds (doubled for each previous attempt); otherwise it is marked failed.
+        Returns True if the job will be retried.
+        """
+        now = time.time()
+        with self._transaction():
+            row = self.conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            attempts = row[0] if row else 0
+            retry = retryable and attempts < max_attempts
+            retry_at = now + retry_delay * 2 ** max(attempts - 1, 0) if retry else None
+            self.conn.execute("UPDATE jobs SET state = ?, error = ?, retry_at = ?, worker = NULL, updated = ? "
+                              "WHERE id = ?", (PENDING if retry else FAILED, error, retry_at, now, job_id))
+        return retry
+
+    def next_retry(self):
+        """
+        Return number of seconds until the next pending job can be claimed (0 if one can be claimed now),
+        or None if there are no pending jobs.
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT COUNT(*), MIN(COALESCE(retry_at, 0)) FROM jobs WHERE state = ?",
+                                    (PENDING,)).fetchone()
+        if not row[0]:
+            return None
+        return max(row[1] - time.time(), 0)
+
+    def recover(self, stale_after=0):
+        """
+        Put jobs in flight (resolving/downloading) whose worker is no longer running back to
+        pending, e.g. after a crash: jobs of processes on this host that have exited, and
+        (if stale_after is non-zero) any job that has been in flight for more than stale_after
+        seconds. Returns the number of recovered jobs.
+        """
+        now = time.time()
+        with self._transaction():
+            rows = self.conn.execute("SELECT id, worker, updated FROM jobs WHERE state IN (?, ?)",
+                                     IN_FLIGHT).fetchall()
+            ids = [(job_id,) for job_id, worker, updated in rows
+                   if not worker_alive(worker) or (stale_after and updated <= now - stale_after)]
+            self.conn.executemany("UPDATE jobs SET state = ?, worker = NULL, updated = ? WHERE id = ?",
+                                  [(PENDING, now, job_id) for (job_id,) in ids])
+            return len(ids)
+
+    def retry_failed(self):
+        """ Put failed jobs back to pending (with a fresh number of attempts). Returns the number of jobs. """
+        with self._transaction():
+            cursor = self.conn.execute("UPDATE jobs SET state = ?, attempts = 0, retry_at = NULL, updated = ? "
+                                       "WHERE state = ?", (PENDING, time.time(), FAILED))
+            return cursor.rowcount
+
+    def counts(self):
+        """ Return dict with the number of jobs in each state. """
+        with self._lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(rows)
+        return counts
+
+    def manifest(self):
+        """ Return list of job dicts (url, state, pdf_url, filepath, error, attempts), in the order they were added. """
+        with self._lock:
+            rows = self.conn.execute("SELECT url, state, pdf_url, filepath, error, attempts FROM jobs "
+                                     "ORDER BY id").fetchall()
+        return [dict(zip(('url', 'state', 'pdf_url', 'filepath', 'error', 'attempts'), row)) for row in rows]
+
+
+def worker_alive(worker):
+    """
+    Whether the worker ('host:pid:thread') that claimed a job may still be running.
+    Workers on other hosts cannot be checked, and are assumed to be alive.
+    """
+    if not worker:
+        return False
+    host, _, rest = worker.partition(':')
+    pid = rest.partition(':')[0]
+    if host != socket.gethostname():
+        return True
+    if not pid.isdigit():
+        return False
+    if int(pid) == os.getpid():
+        # Our own jobs are only in flight while run_queue is running:
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process exists, but belongs to another user:
+        return True
+    return True
+
+
+def error_message(e):
+    """ Return description of exception e for the job queue: type, message and where it was raised. """
+    message = "%s: %s" % (type(e).__name__, e)
+    frames = traceback.extract_tb(e.__traceback__)
+    if frames:
+        frame = frames[-1]
+        message += " (at %s:%s in %s)" % (os.path.basename(frame.filename), frame.lineno, frame.name)
+    return message
+
+
+def failure_reason(e):
+    """ Return (reason, retryable) for exception e raised while fetching a job. """
+    from requests.exceptions import ConnectionError, Timeout  # pylint: disable=W0622
+    from .errors import FetchFailed
+    if isinstance(e, FetchFailed):
+        return e.reason, e.retryable
+    # Includes CircuitOpenError (host currently failing):
+    return error_message(e), isinstance(e, (ConnectionError, Timeout))
+
+
+def run_queue(queue, config, ezclient=None, max_workers=None, stale_after=None):
+    """
+    Fetch all pending jobs in queue using <max_workers> (default: config 'pdf_batch_workers') threads
+    sharing one EzClient. Jobs left in flight by workers that are no longer running are recovered
+    first (see JobQueue.recover; stale_after defaults to config 'pdf_queue_stale_after', 0: only
+    recover jobs of exited processes on this host).
+    Failed jobs are retried as given by config 'pdf_queue_max_attempts' and 'pdf_queue_retry_delay'
+    (see JobQueue.fail and failure_reason).
+    Ctrl-C stops claiming new jobs; press it again to abort the jobs in flight (they are retried next run).
+    Returns the queue's state counts.
+    """
+    from .pdffetcher import fetch_pdf, get_ezclient, get_digest_index, get_resolution_cache
+    from .errors import FetchFailed
+    from .coalesce import canonical_key, get_single_flight
+    if max_workers is None:
+        max_workers = config.get('pdf_batch_workers', 4)
+    if stale_after is None:
+        stale_after = config.get('pdf_queue_stale_after', 0)
+    max_attempts = config.get('pdf_queue_max_attempts', 3)
+    retry_delay = config.get('pdf_queue_retry_delay', 30)
+    n_recovered = queue.recover(stale_after)
+    if n_recovered:
+        print("Resuming %s jobs that were in flight when a previous run stopped." % n_recovered)
+    close_client = ezclient is None
+    if close_client:
+        ezclient = get_ezclient(config)
+    # Never prompt (to open pdfs or to select a pdf link) from the worker threads:
+    config = dict(config, pdf_open_after_download=False, pdf_href_select='first')
+    digest_index = get_digest_index(config)
+    resolution_cache = get_resolution_cache(config)
+    inflight = get_single_flight(config, remember=True)
+    if inflight is not None:
+        for job in queue.manifest():
+            if job['state'] == DONE:
+                inflight.prime(canonical_key(job['url'], config), job['filepath'])
+    stop = threading.Event()
+    hostname = socket.gethostname()
+
+    def work():
+        """ Claim and fetch jobs until the queue is empty (or we are stopped). """
+        worker = "%s:%s:%s" % (hostname, os.getpid(), threading.current_thread().name)
+        while not stop.is_set():
+            job = queue.claim(worker)
+            if job is None:
+                wait = queue.next_retry()
+                if wait is None:
+                    return
+                # Only jobs waiting to be retried (or claimed by other workers) are left:
+                stop.wait(min(max(wait, 0.1), 5))
+                continue
+            job_id, url = job
+
+            def progress(state, pdf_url=None, job_id=job_id):
+                """ Record job progress (e.g. downloading, with the resolved pdf url). """
+                queue.set_state(job_id, state, pdf_url)
+
+            kwargs = dict(ezclient=ezclient, digest_index=digest_index, resolution_cache=resolution_cache,
+                          progress=progress, raise_failures=True)
+            key = canonical_key(url, config) if inflight is not None else None
+            try:
+                if inflight is None:
+                    filepath = fetch_pdf(url, config, **kwargs)
+                else:
+                    filepath, _ = inflight.do(key, fetch_pdf, url, config, **kwargs)
+            except Exception as e:  # pylint: disable=W0703
+                reason, retryable = failure_reason(e)
+                if isinstance(e, FetchFailed):
+                    logger.info("Failed to fetch pdf from %s: %s", url, reason)
+                else:
+                    logger.exception("Error fetching pdf from %s", url)
+                if retryable and inflight is not None:
+                    # Don't hand the transient failure to duplicates (or to the retry):
+                    inflight.forget(key)
+                if queue.fail(job_id, reason, retryable, max_attempts, retry_delay):
+                    print("Will retry %s later: %s" % (url, reason))
+                continue
+            queue.finish(job_id, filepath)
+
+    threads = [threading.Thread(target=work, name="worker-%s" % i, daemon=True) for i in range(max_workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            print("Stopping after the downloads in flight (Ctrl-C again to abort)...")
+            stop.set()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+    finally:
+        if digest_index is not None:
+            digest_index.close()
+        if resolution_cache is not None:
+            resolution_cache.close()
+        if close_client:
+            ezclient.close()
+    return queue.counts()
+
+
+def print_counts(counts):
+    """ Print number of jobs per state. """
+    print("Jobs: " + ", ".join("%s %s" % (n, state) for state, n in counts.items()))
+
+
+def main(argv=None):
+    """ Show queue status, retry failed jobs, or write the manifest. """
+    parser = argparse.ArgumentParser(description="Inspect a batch job queue (see python -m ezfetcher --queue).")
+    parser.add_argument('queue', help="Queue file.")
+    parser.add_argument('--retry-failed', action="store_true", help="Put failed jobs back to pending.")
+    parser.add_argument('--failed', action="store_true", help="List failed jobs with the reason.")
+    parser.add_argument('--manifest', metavar="FILE", help="Write all jobs as json to this file ('-' for stdout).")
+    argns = parser.parse_args(argv)
+    if not os.path.exists(os.path.expanduser(argns.queue)):
+        parser.error("No such queue file: %s" % argns.queue)
+    with JobQueue(argns.queue) as queue:
+        if argns.failed:
+            for job in queue.manifest():
+                if job['state'] == FAILED:
+                    print("%s\t%s" % (job['url'], job['error']))
+        if argns.retry_failed:
+            print("%s failed jobs put back to pending." % queue.retry_failed())
+        if argns.manifest:
+            from .pdffetcher import save_manifest
+            save_manifest(queue.manifest(), argns.manifest)
+        print_counts(queue.counts())
+
+
+if __name__ == '__main__':
+    main()
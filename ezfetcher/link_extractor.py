@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Streaming extraction of pdf links from html landing pages.
+
+Most publishers declare the pdf url in the html head, either as
+    <meta name="citation_pdf_url" content="https://.../article.pdf">
+or as
+    <link rel="alternate" type="application/pdf" href="/article.pdf">
+These are high-signal sources, so we scan the raw response bytes chunk by chunk,
+and stop reading the response as soon as one is found. Landing pages are often
+megabytes of inline javascript, which we then never have to download or decode.
+
+If no high-signal link is found, the complete html is available from the
+extractor's data attribute, for fallback extraction with pdf_href_regex.
+
+"""
+
+import re
+import html
+import logging
+logger = logging.getLogger(__name__)
+
+
+TAG_REGEX = re.compile(rb'<(meta|link)\b([^<>]*)>', flags=re.IGNORECASE)
+ATTR_REGEX = re.compile(rb'''([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+# Unfinished tags longer than this are not kept between chunks:
+MAX_TAG_LENGTH = 4096
+
+
+def parse_attrs(attrs):
+    """ Parse tag attributes (bytes) to dict with lower-case keys and (str) values. """
+    return {m.group(1).lower().decode('ascii', errors='replace'):
+                html.unescape((m.group(2) or m.group(3) or m.group(4) or b'').decode('utf-8', errors='replace'))
+            for m in ATTR_REGEX.finditer(attrs)}
+
+
+def high_signal_pdf_href(tagname, attrs):
+    """ Return pdf href if tag is a citation_pdf_url meta tag or a pdf alternate link, otherwise None. """
+    tagname = tagname.lower()
+    if tagname == b'meta':
+        attrs = parse_attrs(attrs)
+        if attrs.get('name', '').lower() == 'citation_pdf_url' and attrs.get('content'):
+            return attrs['content'].strip()
+    elif tagname == b'link':
+        attrs = parse_attrs(attrs)
+        if 'alternate' in attrs.get('rel', '').lower().split() \
+                and attrs.get('type', '').lower().startswith('application/pdf') and attrs.get('href'):
+            return attrs['href'].strip()
+    return None
+
+
+class StreamingLinkExtractor(object):
+    """
+    Scan html bytes, fed chunk by chunk, for high-signal pdf links.
+    feed() returns the pdf href as soon as one is found (otherwise None).
+    All data fed is kept in self.chunks, for fallback extraction.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.nbytes = 0
+        self.href = None
+        self._tail = b''  # Unprocessed (possibly incomplete) tag from the previous chunk
+
+    @property
+    def data(self):
+        """ All bytes fed so far. """
+        return b''.join(self.chunks)
+
+    def feed(self, chunk):
+        """ Feed a chunk of bytes. Returns pdf href if one has been found. """
+        if self.href is not None:
+            return self.href
+        self.chunks.append(chunk)
+        self.nbytes += len(chunk)
+        buf = self._tail + chunk
+        end = 0
+        for m in TAG_REGEX.finditer(buf):
+            end = m.end()
+            href = high_signal_pdf_href(m.group(1), m.group(2))
+            if href:
+                self.href = href
+                return href
+        # Keep a possibly incomplete tag at the end of the buffer for the next chunk:
+        start = buf.rfind(b'<', end)
+        self._tail = buf[start:] if start >= 0 and len(buf) - start < MAX_TAG_LENGTH else b''
+        return None
+
+
+def extract_high_signal_href(response, chunk_size=16*1024):
+    """
+    Read response in chunks until a high-signal pdf href is found.
+    Returns (href, extractor). If href is found, the rest of the response is not read.
+    Otherwise extractor.data holds the complete body. The response is closed in either case.
+    """
+    extractor = StreamingLinkExtractor()
+    try:
+        for chunk in response.iter_content(chunk_size):
+            if extractor.feed(chunk):
+                logger.debug("High-signal pdf href found after %s bytes: %s", extractor.nbytes, extractor.href)
+                break
+    finally:
+        response.close()
+    return extractor.href, extractor
@@ -18,16 +18,15 @@
 
 # pylint: disable=C0103,W0142,W0611,C0111,C0301
 
-import re
 import requests
 from urllib.parse import urlparse, urljoin, parse_qsl
 from getpass import getpass
 import logging
-import pdb
 logger = logging.getLogger(__name__)
 
 
 from .adaptor_utils import print_history
+from .form_parser import find_form
 
 
 
@@ -77,13 +76,15 @@ def submit_lib_credentials(s, url, html=None, credentials=None):
     if not formdata:
         print("URL for AU credentials submission does not contain any query params")
         print("-- Complete url:", url)
+        import pdb
         pdb.set_trace()
 
     # Obtain credentials and add it to the formdata:
     if credentials is None or credentials.get("prompt") != "never":
         credentials = get_credentials(defaults=credentials)
     elif credentials.get("prompt") == "never":
-        credentials.pop("prompt")
+        # Copy, so the caller's login config keeps 'prompt: never' for the next login:
+        credentials = {key: value for key, value in credentials.items() if key != "prompt"}
         print("Skipping login prompt; using credentials:",
               ", ".join("%s: %s" % kv for kv in credentials.items()))
     formdata.update(credentials)
@@ -93,26 +94,37 @@ def submit_lib_credentials(s, url, html=None, credentials=None):
     return r3
 
 
-def parse_saml_response(s, html):
-    #regex = re.compile(r'name="SAMLResponse" value="(\w*)"', flags=re.DOTALL)
+def get_saml_form(html):
+    """ Return the (auto-submitting) form with the SAMLResponse. Raises AttributeError if there is none. """
+    form = find_form(html, field='SAMLResponse')
+    if form is None:
+        raise AttributeError("No SAMLResponse form found in html.")
+    return form
+
+
+def parse_saml_response(s, html, url):
+    """ Submit the SAMLResponse form in html, the page at url (to resolve relative form actions). """
     # <input type="hidden" name="SAMLResponse" value="PHN
-    m = re.search(r'name="SAMLResponse" value="([\w\+]*)"', html)
-    formdata = {'SAMLResponse': m.group(1)}
+    form = get_saml_form(html)
+    formdata = {'SAMLResponse': form.fields['SAMLResponse']}
     # <form method="post" action="https://bibliotekssystem-saml.statsbiblioteket.dk/module.php/saml/sp/saml2-acs.php/casserver">
-    action_url = "https://bibliotekssystem-saml.statsbiblioteket.dk/module.php/saml/sp/saml2-acs.php/casserver"
+    action_url = (form.action_url(url) if form.action else
+                  "https://bibliotekssystem-saml.statsbiblioteket.dk/module.php/saml/sp/saml2-acs.php/casserver")
     r4 = s.post(action_url, data=formdata)
     print_history(r4, "r4")
     return r4
 
-def parse_saml_2(s, html):
+def parse_saml_2(s, html, url):
+    """ Submit the second SAMLResponse form (with RelayState) in html, the page at url. """
     #<form method="post" action="https://login.ez.statsbiblioteket.dk:12048/Shibboleth.sso/SAML2/POST">
     # <input type="hidden" name="SAMLResponse" value="PHNhbWxwOlJl(...)
     # <input type="hidden" name="RelayState" value="ezp.2aHR0cDovL3d3dy5u(...)
     # <input type="submit" value="Submit" />
-    action = "https://login.ez.statsbiblioteket.dk:12048/Shibboleth.sso/SAML2/POST"
-    m = re.search(r'name="SAMLResponse" value="([\w\+=]*)".*name="RelayState" value="([^\s^"]*)"', html)
-    formdata = {"SAMLResponse": m.group(1),
-                "RelayState" : m.group(2)}
+    form = get_saml_form(html)
+    action = (form.action_url(url) if form.action else
+              "https://login.ez.statsbiblioteket.dk:12048/Shibboleth.sso/SAML2/POST")
+    formdata = {"SAMLResponse": form.fields['SAMLResponse'],
+                "RelayState" : form.fields.get('RelayState', '')}
     r = s.post(action, data=formdata)
     print_history(r, "r5")
     return r
@@ -143,13 +155,14 @@ def AU_lib_login(s, url, url_is_loginpage=None, html=None, r=None, config=None):
 
     # After AU lib login, you have to transfer SAMLResponses. (Usually done by javascript in browser...)
     try:
-        r = parse_saml_response(s, r.text)
+        r = parse_saml_response(s, r.text, r.url)
     except AttributeError as e:
         print("Error while trying to parse SAML response:", e)
         print("Starting pdb...")
+        import pdb
         pdb.set_trace()
-        parse_saml_response(s, r.text)
-    r = parse_saml_2(s, r.text)
+        parse_saml_response(s, r.text, r.url)
+    r = parse_saml_2(s, r.text, r.url)
     # YEAH, r now has text from nature url !!
     # Andersen DNA box:
     #url2 = "http://www.nature.com.ez.statsbiblioteket.dk:2048/nature/journal/v459/n7243/full/nature07971.html"
@@ -57,16 +57,15 @@ Login page notes:
 
 """
 
-import re
 import requests
 from urllib.parse import urlparse, urljoin, parse_qsl
 from getpass import getpass
 import logging
-import pdb
 logger = logging.getLogger(__name__)
 
 
 from .adaptor_utils import print_history
+from .form_parser import find_form
 
 
 
@@ -111,14 +110,12 @@ def get_form_inputfields(html):
          '_eventId_submit': 'Login',
          'compositeAuthenticationSourceType': 'ADID',
          'nonMobileOptionOnMobile': ''}
+    Unchecked radio buttons are left out (see form_parser.Form.fields).
     """
-    form_regex = re.compile(r"<form.*?</form>", flags=re.DOTALL)
-    form_html = form_regex.search(html).group()
-    input_regex = re.compile(r'<input[^<>]*?name="(?P<name>[^"]*)"[^<>]*?value="(?P<value>[^"]*)"[^<>]*?/>',
-                             flags=re.DOTALL+re.MULTILINE)
-    matches = input_regex.findall(form_html)
-    matches = dict(matches)
-    return matches
+    form = find_form(html)
+    if form is None:
+        raise ValueError("No login form found in html.")
+    return form.fields
 
 
 def submit_lib_credentials(s, url, html, credentials=None):
@@ -129,6 +126,7 @@ def submit_lib_credentials(s, url, html, credentials=None):
     if not action_query_params:
         print("URL for AU credentials submission does not contain any query params")
         print("-- Complete url:", url)
+        import pdb
         pdb.set_trace()
     #
     formdata = get_form_inputfields(html)
@@ -139,7 +137,8 @@ def submit_lib_credentials(s, url, html, credentials=None):
     if credentials is None or credentials.get("prompt") != "never":
         credentials = get_huid_credentials(defaults=credentials)
     elif credentials.get("prompt") == "never":
-        credentials.pop("prompt")
+        # Copy, so the caller's login config keeps 'prompt: never' for the next login:
+        credentials = {key: value for key, value in credentials.items() if key != "prompt"}
         print("Skipping login prompt; using credentials:",
               ", ".join("%s: %s" % kv for kv in credentials.items()))
     formdata.update(credentials)
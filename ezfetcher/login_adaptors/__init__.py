@@ -1,12 +1,34 @@
 
-from .AU_lib import AU_lib_login
-from .HUID_lib import HUID_login
-from . import adaptor_utils
+"""
 
-login_adaptors = {'AU_lib': AU_lib_login,
-                  'HUID': HUID_login}
+Login adaptors, by name. The adaptor modules (and their dependencies) are only
+imported when an adaptor is used, so importing ezclient stays fast.
+
+"""
+
+import importlib
+
+# Named login adaptors: name -> (module, function name):
+login_adaptor_functions = {'AU_lib': ('.AU_lib', 'AU_lib_login'),
+                           'HUID': ('.HUID_lib', 'HUID_login')}
 
 # These are hard-coded domains. If you get a redirect to one of these,
 # it is because you need to (re-)login.
 login_domains = {'AU_lib': 'bibliotekssystem-saml.statsbiblioteket.dk',
                  'HUID': 'www.pin1.harvard.edu'}
+
+
+def get_login_adaptor(name):
+    """ Import and return the named login adaptor function. """
+    module, func_name = login_adaptor_functions[name]
+    return getattr(importlib.import_module(module, __name__), func_name)
+
+
+def __getattr__(name):
+    """ Lazy module attributes: login_adaptors dict and the adaptor functions. """
+    if name == 'login_adaptors':
+        return {adaptor_name: get_login_adaptor(adaptor_name) for adaptor_name in login_adaptor_functions}
+    for module, func_name in login_adaptor_functions.values():
+        if name == func_name:
+            return getattr(importlib.import_module(module, __name__), func_name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Single-pass extraction of html forms, used by the login adaptors.
+
+Login pages (and the auto-submitting SAML pages between the identity provider and
+the proxy) are parsed in a single pass over the html: <form> tags are located with a
+literal-prefix regex search (much faster than matching tags all over the page's
+css/javascript), and within each form, one compiled tag regex visits every <input>, <button>, <textarea>,
+<select> and <option> tag once, in document order. Attribute values are matched with
+[^"]* style patterns, so large base64 values (SAMLResponse) are scanned linearly,
+without backtracking.
+
+Usage:
+    forms = parse_forms(html)               # List of Form, in document order
+    form = find_form(html, field='SAMLResponse')
+    s.post(form.action_url(r.url), data=form.fields)
+
+"""
+
+import re
+import html as htmllib
+from urllib.parse import urljoin
+
+
+# A tag we care about. The attributes part skips over quoted values (which may contain '>'),
+# and is "unrolled" (no nested quantifiers), so it cannot backtrack catastrophically:
+TAG_REGEX = re.compile(r'''<(/?)(form|input|button|textarea|select|option)\b([^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*)>''',
+                       flags=re.IGNORECASE)
+ATTR_REGEX = re.compile(r'''([\w:.-]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?''')
+END_TEXTAREA_REGEX = re.compile(r'</textarea\s*>', flags=re.IGNORECASE)
+FORM_START_REGEX = re.compile(r'<form', flags=re.IGNORECASE)
+FORM_END_REGEX = re.compile(r'</form', flags=re.IGNORECASE)
+
+
+def parse_attrs(attrs):
+    """ Parse tag attributes string to dict with lower-case keys and unescaped values ('' for bare attributes). """
+    return {name.lower(): htmllib.unescape(dquoted or squoted or unquoted)
+            for name, dquoted, squoted, unquoted in ATTR_REGEX.findall(attrs)}
+
+
+class Form(object):
+    """
+    A html form: action, method, attrs (of the form tag) and inputs, the list of
+    (name, value, type) of all named fields, hidden and submit fields included.
+    """
+
+    def __init__(self, attrs):
+        self.attrs = attrs
+        self.action = attrs.get('action', '')
+        self.method = attrs.get('method', 'get').lower()
+        self.inputs = []
+
+    def __repr__(self):
+        return "<Form %s %r with fields %s>" % (self.method, self.action, [name for name, _, _ in self.inputs])
+
+    @property
+    def fields(self):
+        """
+        Dict of field name -> value, as a browser would submit the form. Unchecked radio
+        buttons and checkboxes are left out. Unlike a browser, submit fields are included.
+        """
+        return {name: value for name, value, _ in self.inputs}
+
+    def action_url(self, base_url):
+        """ Return the (absolute) url the form is submitted to, given the url of the page. """
+        return urljoin(base_url, self.action)
+
+
+def parse_fields(form, html, pos, endpos):
+    """ Add the fields of form, whose content is html[pos:endpos], to form.inputs. """
+    select = None   # [name, value, selected] of the current <select>
+    while True:
+        m = TAG_REGEX.search(html, pos, endpos)
+        if m is None:
+            return
+        pos = m.end()
+        closing, tagname, attrs = m.group(1), m.group(2).lower(), m.group(3)
+        if tagname == 'form':
+            # Nested forms are ignored (like browsers do)
+            continue
+        if tagname == 'select':
+            if closing:
+                if select is not None and select[0] and select[1] is not None:
+                    form.inputs.append((select[0], select[1], 'select'))
+                select = None
+            else:
+                select = [parse_attrs(attrs).get('name'), None, False]
+            continue
+        if closing:
+            continue
+        attrs = parse_attrs(attrs)
+        if tagname == 'option':
+            # The selected option, or the first option if none is selected:
+            if select is not None and (select[1] is None or ('selected' in attrs and not select[2])):
+                select[1], select[2] = attrs.get('value', ''), 'selected' in attrs
+            continue
+        name = attrs.get('name')
+        if tagname == 'textarea':
+            end = END_TEXTAREA_REGEX.search(html, pos, endpos)
+            if name:
+                form.inputs.append((name, htmllib.unescape(html[pos:end.start() if end else endpos]), 'textarea'))
+            if end:
+                pos = end.end()
+            continue
+        if not name:
+            continue
+        input_type = attrs.get('type', 'submit' if tagname == 'button' else 'text').lower()
+        if input_type in ('radio', 'checkbox') and 'checked' not in attrs:
+            continue
+        if input_type in ('image', 'reset', 'file'):
+            continue
+        form.inputs.append((name, attrs.get('value', 'on' if input_type in ('radio', 'checkbox') else ''),
+                            input_type))
+
+
+def iter_forms(html):
+    """ Yield the forms in html, in document order. Fields outside of a form are ignored. """
+    pos = 0
+    while True:
+        start = FORM_START_REGEX.search(html, pos)
+        if start is None:
+            return
+        m = TAG_REGEX.match(html, start.start())
+        if m is None or m.group(2).lower() != 'form':
+            # E.g. '<formula' or an unterminated tag:
+            pos = start.end()
+            continue
+        end = FORM_END_REGEX.search(html, m.end())
+        pos = end.start() if end else len(html)
+        form = Form(parse_attrs(m.group(3)))
+        parse_fields(form, html, m.end(), pos)
+        yield form
+
+
+def parse_forms(html):
+    """ Return list of the forms in html, in document order. """
+    return list(iter_forms(html))
+
+
+def find_form(html, field=None, action=None):
+    """
+    Return the first form in html that has a field named <field> and/or whose action contains <action>,
+    or the first form if neither is given. Returns None if there is no such form.
+    The rest of the html after the form is not parsed.
+    """
+    for form in iter_forms(html):
+        if field is not None and field not in form.fields:
+            continue
+        if action is not None and action not in form.action:
+            continue
+        return form
+    return None
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Structured timing events from EzClient and fetch_pdf.
+
+Events are dicts, passed to every hook registered with Metrics.add_hook(). Two kinds are emitted:
+
+'request' events, one per EzClient.get():
+    url, proxied_url, status, final_url, redirects (list of urls in the redirect chain),
+    rewrite_s (proxy rewrite), ttfb_s (time to response headers, summed over the redirect chain),
+    transfer_s (time from response headers until the body is read; for streamed responses,
+    until the response is closed), elapsed_s, bytes, login (whether a login was triggered), login_s.
+'fetch_pdf' events, one per pdffetcher.fetch_pdf(), rolling up time per phase:
+    url, filepath, ok, elapsed_s, and phases: {landing, extract, download, hash, save} (seconds).
+
+Write all events to a JSON-lines file with config:
+    ezclient_metrics_file: ~/ezfetcher-metrics.jsonl
+
+or register your own hook:
+    ezclient.metrics.add_hook(lambda event: print(event))
+
+Summarize a metrics file with:
+    python -m ezfetcher.metrics ~/ezfetcher-metrics.jsonl
+
+"""
+
+import os
+import json
+import time
+import math
+import weakref
+import argparse
+import threading
+from contextlib import contextmanager
+import logging
+logger = logging.getLogger(__name__)
+
+
+PHASES = ('landing', 'extract', 'download', 'hash', 'save')
+
+
+class Metrics(object):
+    """ Registry of hooks receiving structured events. Thread-safe. """
+
+    def __init__(self):
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """ Register hook, a callable receiving an event dict. Returns hook. """
+        with self._lock:
+            self.hooks = self.hooks + [hook]
+        return hook
+
+    def remove_hook(self, hook):
+        """ Unregister hook. """
+        with self._lock:
+            self.hooks = [h for h in self.hooks if h is not hook]
+
+    def emit(self, event):
+        """ Pass event to all hooks. Exceptions raised by hooks are logged, not raised. """
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception:  # pylint: disable=W0703
+                logger.exception("Error in metrics hook %r", hook)
+
+    def close(self):
+        """ Close hooks that have a close() method (e.g. JsonLinesSink). """
+        for hook in self.hooks:
+            if hasattr(hook, 'close'):
+                hook.close()
+
+    def track_request(self, response, event, start):
+        """
+        Complete request event with status, redirects, timings and size from response, and emit it.
+        For streamed responses, the event is emitted when the response is closed.
+        """
+        chain = list(response.history) + [response]
+        event.update(status=response.status_code, final_url=response.url,
+                     redirects=[getattr(h, 'url', h) for h in response.history],
+                     ttfb_s=sum(h.elapsed.total_seconds() for h in chain if getattr(h, 'elapsed', None)))
+        if response.raw is None or response._content_consumed:  # pylint: disable=W0212
+            elapsed = time.perf_counter() - start
+            event.update(elapsed_s=elapsed, bytes=len(response.content or b''),
+                         transfer_s=max(0, elapsed - (event.get('rewrite_s') or 0) - event['ttfb_s']
+                                        - (event.get('login_s') or 0)))
+            self.emit(event)
+            return
+        headers_received = time.perf_counter()
+
+        def on_close(r):
+            """ Emit event when streamed response is closed. """
+            closed = time.perf_counter()
+            event.update(elapsed_s=closed - start, transfer_s=closed - headers_received,
+                         bytes=r.raw.tell() if hasattr(r.raw, 'tell') else None)
+            self.emit(event)
+        call_on_close(response, on_close)
+
+
+class JsonLinesSink(object):
+    """ Metrics hook appending events as JSON lines to a file. Thread-safe. """
+
+    def __init__(self, filepath):
+        self.filepath = os.path.expanduser(filepath)
+        self.fd = open(self.filepath, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str) + "\n"
+        with self._lock:
+            self.fd.write(line)
+            self.fd.flush()
+
+    def close(self):
+        """ Close file. """
+        with self._lock:
+            self.fd.close()
+
+
+class PhaseTimer(object):
+    """ Accumulates time spent in named phases. """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+
+    def add(self, phase, seconds):
+        """ Add seconds to phase. """
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        """ Context manager adding the time spent in the with block to phase. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    @property
+    def elapsed(self):
+        """ Seconds since the timer was created. """
+        return time.perf_counter() - self.start
+
+
+def call_on_close(response, callback):
+    """
+    Call callback(response) once, when response is closed (before actually closing it).
+    Chains any close() override already set on the response instance (e.g. by the scheduler).
+    """
+    previous = response.__dict__.get('close')
+    # Use a weak reference, so the response does not reference itself:
+    response_ref = weakref.ref(response)
+    called = []
+
+    def close():
+        """ Call callback, then close response. """
+        r = response_ref()
+        try:
+            if r is not None and not called:
+                called.append(True)
+                try:
+                    callback(r)
+                except Exception:  # pylint: disable=W0703
+                    logger.exception("Error in close callback for %s", r.url)
+        finally:
+            if previous is not None:
+                previous()
+            elif r is not None:
+                type(r).close(r)
+    response.close = close
+
+
+def request_event(url, proxied_url, rewrite_s):
+    """ Return a new (incomplete) request event. """
+    return {'event': 'request', 'time': time.time(), 'url': url, 'proxied_url': proxied_url,
+            'rewrite_s': rewrite_s, 'login': False, 'login_s': None}
+
+
+def fetch_event(url, timer, filepath=None, error=None):
+    """ Return fetch_pdf event with the phase timings of timer. """
+    event = {'event': 'fetch_pdf', 'time': time.time(), 'url': url, 'filepath': filepath,
+             'ok': bool(filepath), 'elapsed_s': timer.elapsed, 'phases': dict(timer.phases)}
+    if error is not None:
+        event['error'] = repr(error)
+    return event
+
+
+def get_metrics(config):
+    """ Return Metrics, with a JsonLinesSink hook if config key 'ezclient_metrics_file' is set. """
+    metrics = Metrics()
+    if config.get('ezclient_metrics_file'):
+        metrics.add_hook(JsonLinesSink(config['ezclient_metrics_file']))
+    return metrics
+
+
+def percentile(values, p):
+    """ Return the p'th percentile (0-100) of values (nearest rank), or None if values is empty. """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(events):
+    """ Return summary dict of request and fetch_pdf events. """
+    requests = [event for event in events if event.get('event') == 'request']
+    fetches = [event for event in events if event.get('event') == 'fetch_pdf']
+    phases = dict.fromkeys(PHASES, 0.0)
+    for event in fetches:
+        for phase, seconds in event.get('phases', {}).items():
+            phases[phase] = phases.get(phase, 0.0) + seconds
+    ttfb = [event['ttfb_s'] for event in requests if event.get('ttfb_s') is not None]
+    elapsed = [event['elapsed_s'] for event in fetches]
+    return {
+        'requests': len(requests),
+        'request_errors': sum(1 for event in requests if event.get('error')),
+        'login_redirects': sum(1 for event in requests if event.get('login')),
+        'bytes': sum(event.get('bytes') or 0 for event in requests),
+        'ttfb_p50_s': percentile(ttfb, 50),
+        'ttfb_p99_s': percentile(ttfb, 99),
+        'fetches': len(fetches),
+        'fetches_ok': sum(1 for event in fetches if event.get('ok')),
+        'fetch_p50_s': percentile(elapsed, 50),
+        'fetch_p99_s': percentile(elapsed, 99),
+        'phases': phases,
+    }
+
+
+def main(argv=None):
+    """ Summarize a JSON-lines metrics file. """
+    parser = argparse.ArgumentParser(description="Summarize ezfetcher metrics (JSON-lines file).")
+    parser.add_argument('filepath', help="Metrics file (ezclient_metrics_file).")
+    argns = parser.parse_args(argv)
+    with open(os.path.expanduser(argns.filepath)) as fd:
+        events = [json.loads(line) for line in fd if line.strip()]
+    summary = summarize(events)
+    phases = summary.pop('phases')
+    for key, value in summary.items():
+        print("%-16s %s" % (key + ":", "%.3f" % value if isinstance(value, float) else value))
+    total = sum(phases.values())
+    print("Time per phase (all fetches):")
+    for phase, seconds in phases.items():
+        print("  %-14s %10.3f s  %5.1f %%" % (phase, seconds, 100 * seconds / total if total else 0))
+
+
+if __name__ == '__main__':
+    main()
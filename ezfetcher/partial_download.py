@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Resumable downloads.
+
+A download from url is streamed to a persistent '.<hash>.part' file in the download
+directory, with a '.part.json' sidecar holding the response validators (ETag,
+Last-Modified) and the expected total length. If the download is interrupted, the
+next attempt asks for the rest of the file with
+    Range: bytes=<size of part file>-
+    If-Range: <etag or last-modified>
+    Accept-Encoding: identity
+and appends to the part file if the server responds with 206 Partial Content.
+If the file has changed on the server (or the server does not support ranges),
+the server responds with the complete file and the download starts over.
+Byte ranges and lengths refer to the encoded body, so only responses without a
+Content-Encoding are resumable (see is_resumable).
+Part files that have not been written to for <max_age> seconds (config 'pdf_partial_max_age',
+default 7 days) are removed, see remove_stale_parts.
+
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+
+CONTENT_RANGE_REGEX = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+# Part files (and save_file's temporary files) are named '.<PART_NAME_DIGITS hex digits>.part':
+PART_NAME_DIGITS = 20
+PART_FILE_REGEX = re.compile(r"^\.[0-9a-f]{%s}\.part(?:\.json)?$" % PART_NAME_DIGITS)
+CLEANUP_MARKER = ".ezfetcher_parts_cleaned"
+
+
+def parse_content_range(content_range):
+    """ Parse Content-Range header, returning (start, end, total) (total is None if unknown). """
+    m = CONTENT_RANGE_REGEX.match(content_range or '')
+    if not m:
+        return None
+    start, end, total = m.groups()
+    return int(start), int(end), (int(total) if total != '*' else None)
+
+
+def part_filename(hexdigits):
+    """ Return part file name for PART_NAME_DIGITS hex digits. """
+    return ".%s.part" % hexdigits
+
+
+def is_resumable(response):
+    """ Whether response can be written to (or appended to) a part file, i.e. is not content-encoded. """
+    return response.headers.get('Content-Encoding', 'identity').strip().lower() in ('', 'identity')
+
+
+def bytes_received(response, default):
+    """ Number of (encoded) body bytes read from response, or <default> if not known. """
+    tell = getattr(getattr(response, 'raw', None), 'tell', None)
+    try:
+        return tell() if tell is not None else default
+    except (OSError, ValueError):
+        return default
+
+
+class PartialDownload(object):
+    """
+    A persisted, possibly partial, download of url to <directory>/.<hash>.part,
+    with validators in a .part.json sidecar file.
+    """
+
+    def __init__(self, directory, url):
+        self.url = url
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        self.path = os.path.join(directory, part_filename(digest[:PART_NAME_DIGITS]))
+        self.info_path = self.path + ".json"
+
+    @property
+    def size(self):
+        """ Number of bytes downloaded so far. """
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def load_info(self):
+        """ Return sidecar info dict (url, etag, last_modified, content_length), or None. """
+        try:
+            with open(self.info_path) as fd:
+                return json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_info(self, headers, content_length):
+        """ Save validators from response headers and the expected total length to the sidecar file. """
+        info = {'url': self.url, 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'),
+                'content_length': content_length}
+        with open(self.info_path, 'w') as fd:
+            json.dump(info, fd)
+
+    @property
+    def expected_length(self):
+        """ Expected total length of the download (or None if unknown). """
+        info = self.load_info()
+        return info.get('content_length') if info else None
+
+    def resume_headers(self):
+        """
+        Return Range/If-Range request headers to resume the download (empty dict if not resumable).
+        Accept-Encoding: identity is included, since ranges of an encoded body cannot be appended.
+        """
+        size = self.size
+        info = self.load_info()
+        if not size or not info:
+            return {}
+        # Weak etags cannot be used with If-Range:
+        etag = info.get('etag')
+        validator = etag if etag and not etag.startswith('W/') else info.get('last_modified')
+        if not validator:
+            return {}
+        return {'Range': 'bytes=%s-' % size, 'If-Range': validator, 'Accept-Encoding': 'identity'}
+
+    def open(self, response, digesttype='md5'):
+        """
+        Open the part file for writing the body of response.
+        For a 206 response continuing the part file, the part file is opened for appending,
+        otherwise the part file is (re-)created. The expected total length is taken from
+        Content-Range (206) or Content-Length (200).
+        Returns (file object, digest object updated with existing bytes, number of existing bytes).
+        """
+        m = hashlib.new(digesttype)
+        if response.status_code == 206:
+            content_range = parse_content_range(response.headers.get('Content-Range'))
+            info = self.load_info()
+            if not content_range or content_range[0] != self.size or info is None:
+                raise ValueError("Content-Range %s does not continue part file %s (%s bytes)"
+                                 % (response.headers.get('Content-Range'), self.path, self.size))
+            total = content_range[2] if content_range[2] is not None else info.get('content_length')
+            self.save_info(response.headers, total)
+            with open(self.path, 'rb') as fd:
+                for chunk in iter(lambda: fd.read(1024*1024), b''):
+                    m.update(chunk)
+            logger.info("Resuming download of %s at byte %s", self.url, content_range[0])
+            return open(self.path, 'ab'), m, content_range[0]
+        content_length = response.headers.get('Content-Length')
+        self.save_info(response.headers, int(content_length) if content_length else None)
+        return open(self.path, 'wb'), m, 0
+
+    def finish(self):
+        """ Remove sidecar file after the part file has been moved into place. """
+        if os.path.exists(self.info_path):
+            os.remove(self.info_path)
+
+    def discard(self):
+        """ Remove part file and sidecar. """
+        for path in (self.path, self.info_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def remove_stale_parts(directory, max_age, interval=24*3600):
+    """
+    Remove part files (and sidecars) in directory not modified for max_age seconds, i.e. downloads
+    that were never resumed. The directory is only listed once per <interval> seconds (tracked
+    with the mtime of a marker file). Returns the number of files removed.
+    """
+    if not max_age:
+        return 0
+    marker = os.path.join(directory, CLEANUP_MARKER)
+    now = time.time()
+    try:
+        if now - os.path.getmtime(marker) < interval:
+            return 0
+    except OSError:
+        pass
+    try:
+        with open(marker, 'a'):
+            os.utime(marker)
+        entries = list(os.scandir(directory))
+    except OSError:
+        return 0
+    n = 0
+    for entry in entries:
+        if not PART_FILE_REGEX.match(entry.name):
+            continue
+        try:
+            if now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+                n += 1
+        except OSError:
+            pass
+    if n:
+        logger.info("Removed %s stale part files from %s", n, directory)
+    return n
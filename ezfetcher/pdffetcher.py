@@ -27,12 +27,17 @@ Fetch PDF from web page using ezproxy.
 
 
 import os
-#import tempfile
-import webbrowser
+import sys
+import json
+import time
+import base64
+import hashlib
+import secrets
 import re
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 #import yaml
 #import requests
-import argparse
 #import urllib
 from urllib.parse import urlparse, urljoin
 #from six import string_types
@@ -46,11 +51,24 @@ logger = logging.getLogger(__name__)
 #    from .lib.cookiesnatcher.chrome_extract import get_chrome_cookies
 #except ImportError as e:
 #    logger.warning("ezfetcher.pdffetcher: %s - cookie_snatch_from will not function.", e)
-from .utils import get_config, init_logging
-from .utils import filehexdigest, calc_checksum
+from .utils import get_config, init_logging, get_pdf_download_dir, open_pdf
+from .utils import filehexdigest, write_chunks, read_urls, DEFAULT_DIGEST
 #from .url_proxy_utils import proxy_url_rewrite
 #from .errors import LoginRedirectException
 from .ezclient import EzClient
+from .errors import FetchFailed, http_failure
+from .digest_index import get_digest_index
+from .link_extractor import extract_high_signal_href
+from .partial_download import PartialDownload, remove_stale_parts, is_resumable, bytes_received
+from .partial_download import part_filename, PART_NAME_DIGITS
+from .resolution_cache import get_resolution_cache, resolution_keys, requested_url, deproxy_url, fresh_pdf_path
+from .resolution_cache import pdf_url_key
+from .metrics import PhaseTimer, fetch_event
+from .content_sniff import sniff_response, needs_sniffing, TailTracker
+from .coalesce import canonical_key, get_single_flight
+from .unique_filename import allocate_filename, get_filename_allocator
+# The command line interface lives in the (fast-starting) cli module:
+from .cli import get_argparser, get_args, main
 
 
 def default_selector_prompt(cands):
@@ -64,6 +82,25 @@ def default_selector_prompt(cands):
     return idx
 
 
+def first_candidate_selector(cands):
+    """
+    Non-interactive selector, used in batch mode (worker threads, the daemon, etc. cannot prompt):
+    selects the first candidate.
+    """
+    logger.warning("Multiple PDF href candidates found, using the first: %s", ", ".join(cands))
+    return 0
+
+
+def get_href_selector(config):
+    """
+    Return the selector_callback for get_pdf_href given by config 'pdf_href_select':
+    "prompt" (default) asks the user, "first" selects the first candidate.
+    """
+    if config.get('pdf_href_select', 'prompt') == 'first':
+        return first_candidate_selector
+    return default_selector_prompt
+
+
 
 #def request(url):
 #    """
@@ -106,6 +143,24 @@ def get_pdf_href(html, pdf_href_regex, selector_callback=None):
     return cands[index]
 
 
+def extract_pdf_href(response, pdf_href_regex, selector_callback=None, chunk_size=16*1024):
+    """
+    Extract pdf url from a html response, reading the response in chunks.
+    High-signal sources (citation_pdf_url meta tags and pdf alternate links) are
+    checked first, and reading stops as soon as one is found. Otherwise the complete
+    html is decoded and searched with get_pdf_href() using pdf_href_regex.
+    """
+    href, extractor = extract_high_signal_href(response, chunk_size)
+    if href:
+        print("Returning high-signal pdf href: %s" % href)
+        return href
+    try:
+        html = extractor.data.decode(response.encoding or 'utf-8', errors='replace')
+    except LookupError:
+        html = extractor.data.decode('utf-8', errors='replace')
+    return get_pdf_href(html, pdf_href_regex, selector_callback)
+
+
 def resolve_pdf_href(html_url, pdf_href):
     """ Reference function, follows pdf_href from a html_url. """
     # Note: Needs to be updated if pages make use of the BASE element.
@@ -114,23 +169,46 @@ def resolve_pdf_href(html_url, pdf_href):
 
 
 def save_file(response, filepath, overwrite="check_digest",
-              metadata=None, filename_fmt=None):
+              metadata=None, filename_fmt=None, chunk_size=64*1024, digest_index=None, partial=None, timer=None,
+              check_pdf=False, digesttype=None):
     """
     Save the content from <response> to <filepath>.
     If filepath is a directory, save to a file in filepath,
     using the basename from the response URL.
-    If <ensure_unique> is True, existing files will not be overwritten.
-    Instead, a new, unique, filename is generated. If this fails,
+    The response body is streamed in chunks of <chunk_size> bytes to a temporary
+    file in the target directory while the digest is calculated. The temporary file
+    is then atomically renamed into place, so memory use does not depend on file size
+    (use stream=True when requesting the response).
     Overwrite controls behaviour if file already exists:
      a) "check_digest" (default) will calculate checksum/digest of response and existing file.
         If they are identical, the existing file's path is returned.
+        Otherwise, a new, unique, filename is generated.
      b) "never" or False: Never overwrite, create unique new filename instead.
-     c) "
-
+     c) Any other true value: Overwrite existing file.
+    Except with c), the filename is reserved atomically (see unique_filename.allocate_filename),
+    so concurrent downloads to the same filename never clobber each other.
+    If a DigestIndex is given as <digest_index>, digests of existing files are looked up
+    in the index instead of re-hashing the files, and with "check_digest", if the
+    same pdf already exists under another name, the existing file's path is returned.
+    If a PartialDownload is given as <partial>, its part file is used instead of a temporary
+    file, and is kept if the download fails, so it can be resumed later (a 206 response
+    is appended to the part file). The completed file is checked against the expected
+    length and, if the server provides it, Content-MD5.
+    If the response body has already been streamed to a temporary file in the target directory
+    (response.body_path, see async_ezclient.FetchedResponse), that file is hashed and renamed into place.
+    If a metrics.PhaseTimer is given as <timer>, time is added to its download, hash and save phases.
+    If check_pdf is True, the file must end with the pdf %%EOF marker (within the last 1024 bytes),
+    otherwise it is considered truncated (or not a pdf) and is not saved.
+    Digests are calculated with hashlib algorithm <digesttype> (default: the digest index's algorithm, or md5).
+    Returns the path of the saved file. Raises FetchFailed if the response was empty, incomplete
+    (retryable; with <partial>, the part file is kept for resuming) or not a pdf.
     """
     if overwrite is None:
         overwrite = "check_digest"
-    r_checksum = calc_checksum(response.content)
+    if digest_index is not None:
+        digesttype = digest_index.algorithm
+    elif digesttype is None:
+        digesttype = DEFAULT_DIGEST
     if os.path.isdir(filepath):
         fname = urlparse(response.url).path.rsplit('/', 1)[-1]
         if filename_fmt is None:
@@ -139,54 +217,156 @@ def save_file(response, filepath, overwrite="check_digest",
             generate_filename(filename_fmt, metadata)
     elif not os.path.isdir(os.path.dirname(filepath)):
         raise ValueError("filepath in non-existing directory: %s " % filepath)
-    if os.path.exists(filepath):
-        if overwrite.lower() == "check_digest":
-            f_checksum = filehexdigest(filepath)
-            if r_checksum == f_checksum:
-                # Response pdf is same as the one on disk:
-                print("Checksum of pdf response MATCHES checksum of existing pdf on disk:\n%s\n  %s\n  %s\n" % \
-                      (filepath, r_checksum, f_checksum))
-                return filepath
-            else:
-                print("Checksum of pdf response DIFFER FROM checksum of existing pdf on disk:\n%s\n  %s\n  %s\n" % \
-                      (filepath, r_checksum, f_checksum))
-                overwrite = False
-        if not overwrite or overwrite == "never":
-            filepath = get_unique_filename(filepath)
-    print("Saving %s to file %s" % (response.url, filepath))
-    with open(filepath, 'wb') as fd:
-        fd.write(response.content) # maybe iter_content() ?
+    # Stream response to a temporary (or part) file in the same directory (so we can rename atomically):
+    spooled = getattr(response, 'body_path', None)
+    if partial is not None:
+        fd, m, offset = partial.open(response, digesttype)
+        tmppath = partial.path
+    elif spooled and os.path.dirname(spooled) == os.path.dirname(filepath):
+        # Body is already on disk; just hash it (and check the pdf trailer), then rename it:
+        fd, m, offset = open(os.devnull, 'wb'), hashlib.new(digesttype), 0
+        tmppath = spooled
+    else:
+        tmpfd, tmppath = make_temp_file(os.path.dirname(filepath))
+        fd, m, offset = os.fdopen(tmpfd, 'wb'), hashlib.new(digesttype), 0
+
+    def discard():
+        """ Remove temporary/part file. """
+        if partial is not None:
+            partial.discard()
+        elif os.path.exists(tmppath):
+            os.remove(tmppath)
+
+    try:
+        chunks = response.iter_content(chunk_size)
+        if check_pdf:
+            chunks = TailTracker(chunks)
+        with fd:
+            r_checksum, nbytes = write_chunks(chunks, fd, m=m, timer=timer)
+        save_start = time.perf_counter()
+        nbytes += offset
+        if not nbytes:
+            discard()
+            raise FetchFailed("Response from %s is empty" % response.url, retryable=True)
+        if partial is not None:
+            # Content-Length/Content-Range count the bytes on the wire, not the decoded bytes:
+            received = offset + bytes_received(response, nbytes - offset)
+            if partial.expected_length and received != partial.expected_length:
+                raise FetchFailed("Incomplete download of %s (%s of %s bytes); keeping %s for resume" % (
+                    response.url, received, partial.expected_length, partial.path), retryable=True)
+            content_md5 = response.headers.get('Content-MD5')
+            if content_md5 and digesttype == 'md5' and response.status_code == 200 \
+                    and base64.b64encode(bytes.fromhex(r_checksum)).decode() != content_md5:
+                discard()
+                raise FetchFailed("Digest of %s does not match Content-MD5 %s" % (response.url, content_md5),
+                                  retryable=True)
+        if check_pdf and not chunks.has_pdf_eof():
+            if partial is not None and not partial.expected_length:
+                raise FetchFailed("Pdf from %s does not end with %%%%EOF (truncated?); keeping %s for resume"
+                                  % (response.url, partial.path), retryable=True)
+            discard()
+            raise FetchFailed("Response from %s does not end with %%%%EOF (truncated, or not a pdf)" % response.url)
+        check_digest = isinstance(overwrite, str) and overwrite.lower() == "check_digest"
+        if check_digest and digest_index is not None:
+            existing = digest_index.find_by_digest(r_checksum)
+            if existing:
+                print("Pdf response is identical to existing pdf on disk: %s" % existing[0])
+                discard()
+                return existing[0]
+        if os.path.exists(filepath):
+            if check_digest:
+                if digest_index is not None:
+                    f_checksum = digest_index.get_digest(filepath)
+                else:
+                    f_checksum = filehexdigest(filepath, digesttype)
+                if r_checksum == f_checksum:
+                    # Response pdf is same as the one on disk:
+                    print("Checksum of pdf response MATCHES checksum of existing pdf on disk:\n%s\n  %s\n  %s\n" % \
+                          (filepath, r_checksum, f_checksum))
+                    discard()
+                    return filepath
+                else:
+                    print("Checksum of pdf response DIFFER FROM checksum of existing pdf on disk:\n%s\n  %s\n  %s\n" % \
+                          (filepath, r_checksum, f_checksum))
+                    overwrite = False
+        reserved = not overwrite or overwrite == "never" or check_digest
+        if reserved:
+            # Atomically reserve filepath (or the next free "name (i).pdf"), so concurrent saves never clobber:
+            filepath = allocate_filename(filepath)
+        print("Saving %s (%s bytes) to file %s" % (response.url, nbytes, filepath))
+        try:
+            os.replace(tmppath, filepath)
+        except BaseException:
+            if reserved:
+                get_filename_allocator().release(filepath)
+            raise
+        if partial is not None:
+            partial.finish()
+        if digest_index is not None:
+            digest_index.add(filepath, r_checksum)
+        if timer is not None:
+            timer.add('save', time.perf_counter() - save_start)
+    except BaseException:
+        # Keep part files for resuming, but not temporary files:
+        if partial is None and os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+    finally:
+        response.close()
     return filepath
 
+def make_temp_file(directory, max_tries=100):
+    """
+    Create a new, uniquely named, temporary '.<random>.part' file in directory, returning (fd, path).
+    The name matches partial_download.PART_FILE_REGEX, so files left by a crash are removed as stale parts.
+    Unlike tempfile.mkstemp (mode 0600), the file gets the normal permissions (0666 minus umask),
+    which are kept when it is renamed into place.
+    """
+    for _ in range(max_tries):
+        path = os.path.join(directory, part_filename(secrets.token_hex(PART_NAME_DIGITS // 2)))
+        try:
+            return os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, 'O_BINARY', 0), 0o666), path
+        except FileExistsError:
+            continue
+    raise FileExistsError("Could not create a temporary file in %s" % directory)
+
+
 def generate_filename(filename_fmt, metadata):
     """
     """
     raise NotImplementedError("generate_filename not implemented; will implement when needed...")
 
 def get_unique_filename(filename, max_iterations=1000, unique_fmt="{fnroot} ({i}){ext}"):
-    """ Returns a unique filename based on <filename> and unique_fmt. """
-    if not os.path.exists(filename):
-        return filename
-    fnroot, ext = os.path.splitext(filename)
-    logging.debug("%s already exists; Making new using fnroot=%s, ext=%s, unique_fmt=%s",
-                  filename, fnroot, ext, unique_fmt)
-    for i in range(1, max_iterations):
-        fpath = unique_fmt.format(fnroot=fnroot, i=i, ext=ext)
-        if not os.path.exists(fpath):
-            return fpath
-    raise FileExistsError("%s already exists (an so does %s similarly-named files)" % (filename, max_iterations))
-
+    """
+    Returns a unique filename based on <filename> and unique_fmt.
+    The name is not reserved; use unique_filename.allocate_filename for that.
+    """
+    return get_filename_allocator(unique_fmt, max_iterations).allocate(filename, reserve=False)
 
 
-def get_pdf_response(url, session, pdf_href_regex, recursions=4, r=None):
+def get_pdf_response(url, session, pdf_href_regex, recursions=4, r=None, request_headers=None, timer=None,
+                     sniff=True, selector_callback=None):
     """
     Traverse url and responses recursively to get a PDF.
+    <request_headers> is an optional function returning extra headers for each url requested,
+    e.g. conditional request headers (in which case a 304 response may be returned).
+    If a metrics.PhaseTimer is given as <timer>, request time is added to its 'landing' phase
+    for html responses and to 'download' for pdf responses, and time spent reading and parsing
+    landing pages is added to 'extract'.
+    If <sniff> is True, responses not labelled as html are only trusted if the body starts with %PDF-
+    (see content_sniff). Mislabelled html is searched for the pdf link; anything else is aborted
+    (closed, after reading only the first chunk).
+    Raises FetchFailed if no pdf is found (not a pdf, no pdf link, still on the login page, ...).
+    <selector_callback> selects between multiple pdf links, see get_pdf_href.
     """
     if recursions < 1:
-        print("Recursions maxed out, aborting... - ", recursions)
-        return None
+        raise FetchFailed("Too many landing pages (recursions maxed out) before reaching a pdf: %s" % url)
+    request_start = time.perf_counter()
     if r is None:
-        r = session.get(url)  # response object
+        headers = request_headers(url) if request_headers else None
+        # Stream, so a pdf body is only downloaded when it is saved:
+        r = session.get(url, stream=True, headers=headers)  # response object
+    request_time = time.perf_counter() - request_start
     # There might be redirects, even for pdf requests, e.g. if the cookies has expired.
     # You can usually check this from the history..
     # r.history
@@ -194,27 +374,100 @@ def get_pdf_response(url, session, pdf_href_regex, recursions=4, r=None):
     #    # We've shifted domain. Should only happen if login is invalid
     #    # Edit: No; ezclient is in charge of proxy driven url rewriting.
     #    raise LoginRedirectException("Redirected to %s" % urlparse(r.url).netloc)
-    if 'html' in r.headers['Content-Type']:
+    content_type = r.headers.get('Content-Type', '')
+    kind = 'html' if 'html' in content_type else 'pdf'
+    if kind == 'pdf' and sniff and needs_sniffing(r):
+        sniff_start = time.perf_counter()
+        kind = sniff_response(r)
+        request_time += time.perf_counter() - sniff_start
+        if kind == 'other':
+            r.close()
+            if timer is not None:
+                timer.add('download', request_time)
+            raise FetchFailed("Response from %s (Content-Type: %s) is not a pdf" % (r.url, content_type))
+    if kind == 'html':
         print("Response is html, trying to extract pdf url...")
-        pdf_href = get_pdf_href(html=r.text, pdf_href_regex=pdf_href_regex)
+        extract_start = time.perf_counter()
+        pdf_href = extract_pdf_href(r, pdf_href_regex=pdf_href_regex, selector_callback=selector_callback)
+        if timer is not None:
+            timer.add('landing', request_time)
+            timer.add('extract', time.perf_counter() - extract_start)
         if not pdf_href:
-            print("No pdf href found in html.")
-            return None
+            is_login_redirect = getattr(session, 'is_login_redirect', None)
+            if is_login_redirect is not None and is_login_redirect(r):
+                raise FetchFailed("Login failed, still on the login page: %s" % r.url, retryable=True)
+            if not r:
+                raise http_failure(r)
+            raise FetchFailed("No pdf link found in html from %s" % r.url)
         url = resolve_pdf_href(url, pdf_href)
         print("New PDF URL:", url)
         # Recurse:
-        return get_pdf_response(url, session, pdf_href_regex, recursions=recursions-1)
+        return get_pdf_response(url, session, pdf_href_regex, recursions=recursions-1,
+                                request_headers=request_headers, timer=timer, sniff=sniff,
+                                selector_callback=selector_callback)
     else:
         # Assume we have a pdf:
+        if timer is not None:
+            timer.add('download', request_time)
         return r
 
 
 
-def fetch_pdf(url, config, ezclient=None, headers=None, cookies=None, r=None, metadata=None):
+def is_pdf_response(response):
+    """ Whether response is a successful, non-html response. """
+    return bool(response) and 'html' not in response.headers.get('Content-Type', '')
+
+
+def resolve_pdf_response(url, ezclient, pdf_href_regex, config, resolution_cache=None, metadata=None, r=None,
+                         request_headers=None, timer=None):
+    """
+    Get pdf response for landing page url, using resolution_cache (if given) to skip
+    the landing page for urls that have already been resolved. If the cached pdf url
+    fails, the entry is invalidated and the full get_pdf_response recursion is used.
+    Successful resolutions are added to the cache.
+    Unless config 'pdf_sniff_content' is False, pdf responses are checked with content sniffing.
+    Multiple pdf links are selected between as given by config 'pdf_href_select' (see get_href_selector).
+    """
+    sniff = config.get('pdf_sniff_content', True)
+    selector = get_href_selector(config)
+    if resolution_cache is None or r is not None:
+        return get_pdf_response(url, ezclient, pdf_href_regex, r=r, request_headers=request_headers, timer=timer,
+                                sniff=sniff, selector_callback=selector)
+    keys = resolution_keys(url, config, metadata)
+    cached_url = resolution_cache.get(keys)
+    if cached_url:
+        print("Using cached pdf url:", cached_url)
+        headers = request_headers(cached_url) if request_headers else None
+        request_start = time.perf_counter()
+        response = ezclient.get(cached_url, stream=True, headers=headers)
+        if timer is not None:
+            timer.add('download' if is_pdf_response(response) else 'landing', time.perf_counter() - request_start)
+        if is_pdf_response(response) and not (sniff and needs_sniffing(response) and sniff_response(response) != 'pdf'):
+            return response
+        print("Cached pdf url failed (%s), resolving from landing page..." % response)
+        response.close()
+        resolution_cache.invalidate(keys)
+    response = get_pdf_response(url, ezclient, pdf_href_regex, request_headers=request_headers, timer=timer,
+                                sniff=sniff, selector_callback=selector)
+    if is_pdf_response(response):
+        resolution_cache.put(keys, deproxy_url(requested_url(response), config))
+    return response
+
+
+def fetch_pdf(url, config, ezclient=None, headers=None, cookies=None, r=None, metadata=None,
+              digest_index=None, resolution_cache=None, progress=None, raise_failures=False):
     """
     Fetch pdf from url.
     You can provide *either* a client to use, OR headers/cookies OR neither.
     But headers/cookies will not be used if client is given.
+    If <digest_index> is not given, the index configured with 'pdf_digest_index' (if any) is used.
+    Likewise, if <resolution_cache> is not given, the cache configured with 'pdf_resolution_cache'
+    (if any) is used.
+    A 'fetch_pdf' event with the time spent per phase is emitted to the client's metrics hooks.
+    <progress> is passed on to fetch_and_save_pdf.
+    A client created here (if ezclient is not given) is closed before returning.
+    Returns the path of the saved pdf, or None if no pdf could be fetched; with raise_failures=True,
+    FetchFailed is raised instead, with the reason (and whether trying again later may succeed).
     """
     print("(fetch_pdf) url:", url)
     # When using ezclient, proxy_url_rewrite is automatically applied:
@@ -229,89 +482,266 @@ def fetch_pdf(url, config, ezclient=None, headers=None, cookies=None, r=None, me
     #        print("Browser cookies:", browser_cookies)
     #        cookies.update(browser_cookies)
 
-    if ezclient is None:
-        ezclient = EzClient(config, headers=headers, cookies=cookies)
-        if config.get('cookies_snatch_from'):
-            ezclient.snatch_chrome_cookie()
+    close_client = ezclient is None
+    if close_client:
+        ezclient = get_ezclient(config, headers=headers, cookies=cookies)
+
+    close_index, close_cache = digest_index is None, resolution_cache is None
+    if digest_index is None:
+        digest_index = get_digest_index(config)
+    if resolution_cache is None:
+        resolution_cache = get_resolution_cache(config)
+    timer = PhaseTimer()
+    filepath = None
+    try:
+        filepath = fetch_and_save_pdf(url, config, ezclient, r=r, metadata=metadata, digest_index=digest_index,
+                                      resolution_cache=resolution_cache, timer=timer, progress=progress)
+    except Exception as e:
+        if ezclient.metrics.hooks:
+            ezclient.metrics.emit(fetch_event(url, timer, error=e))
+        if raise_failures or not isinstance(e, FetchFailed):
+            raise
+        print("Failed to get pdf from url %s: %s" % (url, e))
+    else:
+        if ezclient.metrics.hooks:
+            ezclient.metrics.emit(fetch_event(url, timer, filepath))
+    finally:
+        if close_index and digest_index is not None:
+            digest_index.close()
+        if close_cache and resolution_cache is not None:
+            resolution_cache.close()
+        if close_client:
+            ezclient.close()
+    if not filepath:
+        return
+    open_pdf(filepath, config)
+    return filepath
+
 
+def fetch_and_save_pdf(url, config, ezclient, r=None, metadata=None, digest_index=None, resolution_cache=None,
+                       timer=None, progress=None):
+    """
+    Get pdf response for url and save it to the pdf download dir. Returns the saved filepath.
+    Time spent per phase is added to <timer> (a metrics.PhaseTimer), if given.
+    If digest_index is given (and config 'pdf_conditional_get' is not False), the validators
+    of saved pdfs are stored, and used to make conditional requests for the same pdf later.
+    A 304 Not Modified response returns the path of the existing file without downloading it.
+    If config 'pdf_max_age' is set, a pdf saved or re-validated less than pdf_max_age seconds ago
+    is returned without contacting the server at all.
+    If given, progress('downloading', pdf_url) is called when the pdf url has been resolved
+    (used by the job queue to record job state).
+    Raises FetchFailed if no pdf could be fetched.
+    """
     pdf_href_regex = config.get('pdf_href_regex')
+    savedir = get_pdf_download_dir(config)
+    conditional = digest_index is not None and config.get('pdf_conditional_get', True)
+    resume = config.get('pdf_resume_downloads', True)
+    if resume:
+        remove_stale_parts(savedir, config.get('pdf_partial_max_age', 7*24*3600))
+    if r is None:
+        filepath = fresh_pdf_path(url, config, digest_index, resolution_cache, metadata)
+        if filepath:
+            print("Pdf was downloaded less than %s seconds ago: %s" % (config['pdf_max_age'], filepath))
+            return filepath
+
+    def request_headers(pdf_url):
+        """ Return conditional and/or range request headers for pdf_url. """
+        key = pdf_url_key(pdf_url, config)
+        headers = {}
+        if conditional:
+            headers.update(digest_index.conditional_headers(key))
+        if resume:
+            headers.update(PartialDownload(savedir, key).resume_headers())
+        return headers
+
     # Pass in existing response if you already have it:
-    response = get_pdf_response(url, ezclient, pdf_href_regex, r=r)
+    response = resolve_pdf_response(url, ezclient, pdf_href_regex, config, resolution_cache,
+                                    metadata=metadata, r=r, request_headers=request_headers, timer=timer)
+    if response is not None and (response.status_code == 416
+                                 or response.status_code == 206 and not is_resumable(response)):
+        # Range not satisfiable (or an encoded range, which cannot be appended); discard the part file and start over:
+        print("Could not resume download of %s, starting over..." % response.url)
+        response.close()
+        PartialDownload(savedir, pdf_url_key(requested_url(response), config)).discard()
+        response = ezclient.get(requested_url(response), stream=True)
+        if config.get('pdf_sniff_content', True) and needs_sniffing(response) and sniff_response(response) != 'pdf':
+            response.close()
+            raise FetchFailed("Response from %s is not a pdf" % response.url)
+    if response is None:
+        raise FetchFailed("No pdf found at %s" % url)
     if not response:
-        print("Failed to get pdf from url %s. get_pdf_response returned: %s" % (url, response))
-        return
-
-    print("Response with content type:", response.headers['Content-Type'])
+        response.close()
+        raise http_failure(response)
+
+    # Must be the same key as in request_headers():
+    validators_key = pdf_url_key(requested_url(response), config)
+    if progress is not None:
+        progress('downloading', validators_key)
+    if response.status_code == 304:
+        validators = digest_index.get_validators(validators_key) if digest_index is not None else None
+        response.close()
+        if validators:
+            print("Pdf not modified since last download:", validators['path'])
+            digest_index.mark_validated(validators_key)
+            return validators['path']
+        raise FetchFailed("Got 304 Not Modified for %s, but no matching file on disk" % response.url)
+
+    print("Response with content type:", response.headers.get('Content-Type'))
     # We have a pdf in our response:
     logger.info("Response from %s is: %s", response.url, response)
-    if response and response.content:
-        logger.info("Response with %s bytes obtained from %s", len(response.content), response.url)
-        logger.info("config.get('pdf_download_dir'): %s", config.get('pdf_download_dir'))
-        savedir = os.path.expanduser(config.get('pdf_download_dir', os.path.join('~', 'Downloads')))
-        savedir = os.path.normpath(savedir)
-        # Done: If filename already exists, do checksum calculation to detect identical file.
-        filepath = save_file(response, savedir, overwrite=config.get('pdf_overwrite', 'check_digest'),
-                             metadata=metadata)
-        open_pdf = config.get('pdf_open_after_download')
-        if open_pdf == "ask":
-            ok = input("Open pdf in browser? [yes/no] ")
-            open_pdf = (bool(ok) and ok[0].lower() == 'y')
-        if open_pdf:
-            webbrowser.open(filepath)
-        return filepath
-
-
-
-
-def get_argparser():
-    """ Get argument parser. """
-    parser = argparse.ArgumentParser()
-    parser.add_argument('url', help="The URL to download pdf from.")
-    parser.add_argument('--pdf_download_dir', help="Download pdf to this directory.")
-    parser.add_argument('--proxy_url_fmt',
-                        help="How to proxy rewrite the url. E.g. 'http://{netloc}.lib.university.edu/{path}")
-    parser.add_argument('--open_pdf', dest='pdf_open_after_download', action="store_true", default=None,
-                        help="Open pdf after download.")
-    parser.add_argument('--no-open_pdf', action="store_false", dest="pdf_open_after_download",
-                        help="Do not open pdf after download.")
-    parser.add_argument('--cookies_snatch_from', help="Snatch cookies from this browser (only Chrome supported).")
-    parser.add_argument('--cookie_snatch_keys', nargs='*', metavar="KEY", help="Download pdf to this directory.")
-    parser.add_argument('--cookie_snatch_domain', help="Domain to extract browser cookies for.")
-
-    parser.add_argument('--configfile', help="Load this config file.")
-
-    # testing and logging config:
-    parser.add_argument('--loglevel', help="Logging level.")
-    parser.add_argument('--testing', action="store_true", help="Enable testing mode.")
-
-    return parser
-
-
-def get_args(parser=None, argv=None):
-    """ Get args from command line. """
-    if parser is None:
-        parser = get_argparser()
-    return parser.parse_args(argv)
-
-
-def main(argv=None, extras=None):
-    """ Invoked from command line or tests... """
-    argns = get_args(None, argv) # get_args(parser, argv)
-    print("argns.__dict__:", argns.__dict__)
-    kwargs = {k: v for k, v in argns.__dict__.items() if v is not None}
-    if extras:
-        kwargs.update(extras)
-    url = kwargs.pop('url')
-    print("kwargs: ", kwargs)
-    config = get_config(kwargs, kwargs.pop('configfile', None))
-    print("config: ", config)
-    init_logging(kwargs)
-
-    if url == 'test':
-        test(kwargs)
-        return
+    logger.info("Response with Content-Length %s obtained from %s",
+                response.headers.get('Content-Length'), response.url)
+    logger.info("config.get('pdf_download_dir'): %s", config.get('pdf_download_dir'))
+    # Encoded (e.g. gzip) responses are saved to a temporary file instead of a (resumable) part file:
+    partial = PartialDownload(savedir, validators_key) if resume and is_resumable(response) else None
+    # Done: If filename already exists, do checksum calculation to detect identical file.
+    filepath = save_file(response, savedir, overwrite=config.get('pdf_overwrite', 'check_digest'),
+                         metadata=metadata, chunk_size=config.get('pdf_download_chunk_size', 64*1024),
+                         digest_index=digest_index, partial=partial, timer=timer,
+                         check_pdf=config.get('pdf_sniff_content', True), digesttype=config.get('pdf_digest_algorithm'))
+    if filepath and digest_index is not None:
+        digest_index.set_validators(validators_key, filepath, response.headers)
+    return filepath
+
 
-    fetch_pdf(url, config)
+def get_ezclient(config, headers=None, cookies=None):
+    """ Create a new EzClient from config, snatching browser cookies if configured to do so. """
+    ezclient = EzClient(config, headers=headers, cookies=cookies)
+    if config.get('cookies_snatch_from'):
+        ezclient.snatch_chrome_cookie()
+    return ezclient
+
+
+def fetch_manifest_entry(url, config, ezclient, metadata=None, digest_index=None, resolution_cache=None,
+                         inflight=None):
+    """
+    Fetch pdf from url with fetch_pdf, returning a manifest entry (see fetch_pdfs).
+    Exceptions are caught and reported in the entry (for 'failed' entries, the FetchFailed reason).
+    If inflight (a SingleFlight) is given, a fetch of the same article (see coalesce.canonical_key)
+    that is already in flight is shared; the entry then has 'duplicate_of': <url fetched>.
+    """
+    start = time.perf_counter()
+    if inflight is not None:
+        entry, shared = inflight.do(canonical_key(url, config, metadata), fetch_manifest_entry, url, config,
+                                    ezclient, metadata=metadata, digest_index=digest_index,
+                                    resolution_cache=resolution_cache)
+        return duplicate_entry(entry, url, start) if shared else entry
+    try:
+        filepath = fetch_pdf(url, config, ezclient=ezclient, metadata=metadata, digest_index=digest_index,
+                             resolution_cache=resolution_cache, raise_failures=True)
+    except FetchFailed as e:
+        return {'url': url, 'status': 'failed', 'filepath': None, 'error': e.reason, 'duplicate_of': None,
+                'elapsed': time.perf_counter() - start}
+    except Exception as e:  # pylint: disable=W0703
+        logger.exception("Error fetching pdf from %s", url)
+        return {'url': url, 'status': 'error', 'filepath': None, 'error': repr(e), 'duplicate_of': None,
+                'elapsed': time.perf_counter() - start}
+    return {'url': url, 'status': 'ok' if filepath else 'failed', 'filepath': filepath, 'error': None,
+            'duplicate_of': None, 'elapsed': time.perf_counter() - start}
+
+
+def duplicate_entry(entry, url, start):
+    """ Return manifest entry for url, a duplicate of the url fetched for entry; start is its perf_counter(). """
+    return dict(entry, url=url, duplicate_of=entry['url'], elapsed=time.perf_counter() - start)
+
+
+def fetch_pdfs(urls, config, ezclient=None, max_workers=None, headers=None, cookies=None):
+    """
+    Fetch pdfs from multiple urls concurrently using a thread pool.
+    All workers share the same EzClient, i.e. the same authenticated session
+    (and connection pool), so cookies and login are only loaded once.
+    Urls for the same article (same DOI, or the same url up to proxy, www/mobile host
+    and tracking parameters) are only fetched once, unless config 'pdf_coalesce_duplicates' is False.
+    Returns a manifest list with one entry per url (in the same order as urls):
+        {'url': <url>, 'status': 'ok'|'failed'|'error', 'filepath': <path or None>, 'error': <str or None>,
+         'duplicate_of': <url actually fetched, for duplicates, else None>, 'elapsed': <seconds>}
+    """
+    urls = list(urls)
+    if max_workers is None:
+        max_workers = config.get('pdf_batch_workers', 4)
+    close_client = ezclient is None
+    if close_client:
+        ezclient = get_ezclient(config, headers=headers, cookies=cookies)
+    # Never prompt (to open pdfs or to select a pdf link) from the worker threads:
+    config = dict(config, pdf_open_after_download=False, pdf_href_select='first')
+    digest_index = get_digest_index(config)
+    resolution_cache = get_resolution_cache(config)
+    inflight = get_single_flight(config, remember=True)
+
+    def fetch_one(url):
+        """ Fetch a single url, returning a manifest entry. """
+        return fetch_manifest_entry(url, config, ezclient, digest_index=digest_index,
+                                    resolution_cache=resolution_cache, inflight=inflight)
+
+    logger.info("Fetching %s urls using %s workers", len(urls), max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            manifest = list(executor.map(fetch_one, urls))
+    finally:
+        if digest_index is not None:
+            digest_index.close()
+        if resolution_cache is not None:
+            resolution_cache.close()
+        if close_client:
+            ezclient.close()
+    if inflight is not None and inflight.coalesced:
+        logger.info("%s duplicate urls were not fetched again", inflight.coalesced)
+    return manifest
+
+
+def save_manifest(manifest, filepath=None):
+    """ Write batch manifest as json to filepath, or to stdout if filepath is None or '-'. """
+    if filepath is None or filepath == '-':
+        json.dump(manifest, sys.stdout, indent=2)
+        print()
+    else:
+        with open(os.path.expanduser(filepath), 'w') as fd:
+            json.dump(manifest, fd, indent=2)
+        logger.info("Manifest with %s entries written to %s", len(manifest), filepath)
+
+
+def main_batch(config, batchfile, manifest_filepath=None, queue_filepath=None):
+    """
+    Fetch all urls listed in batchfile ('-' to read from stdin) and save the manifest.
+    If queue_filepath is given, the urls are added to that durable job queue (see job_queue),
+    and all jobs not yet done are fetched; batchfile can be None to just resume the queue.
+    If the manifest is written to stdout, progress messages are printed to stderr instead,
+    so the manifest can be piped to e.g. jq.
+    """
+    urls = []
+    if batchfile == '-':
+        urls = read_urls(sys.stdin)
+    elif batchfile:
+        with open(os.path.expanduser(batchfile)) as fd:
+            urls = read_urls(fd)
+    if queue_filepath:
+        from .job_queue import JobQueue, run_queue, print_counts
+        with JobQueue(queue_filepath) as queue:
+            with progress_output(manifest_filepath):
+                if urls:
+                    print("%s new urls added to queue %s." % (queue.add(urls), queue_filepath))
+                counts = run_queue(queue, config)
+                print_counts(counts)
+            if manifest_filepath:
+                save_manifest(queue.manifest(), manifest_filepath)
+        return counts
+    with progress_output(manifest_filepath):
+        if config.get('pdf_batch_async'):
+            from .async_ezclient import run_batch
+            manifest = run_batch(urls, config)
+        else:
+            manifest = fetch_pdfs(urls, config)
+        n_ok = sum(1 for entry in manifest if entry['status'] == 'ok')
+        print("Batch done: %s of %s pdfs fetched." % (n_ok, len(manifest)))
+    save_manifest(manifest, manifest_filepath)
+    return manifest
+
+
+def progress_output(manifest_filepath):
+    """ Context redirecting progress prints to stderr if the manifest goes to stdout (None or '-'). """
+    if manifest_filepath is None or manifest_filepath == '-':
+        return contextlib.redirect_stdout(sys.stderr)
+    return contextlib.nullcontext()
 
 
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Persistent (sqlite) cache of landing page -> pdf url resolutions.
+
+Keys are de-proxied landing page urls, and 'doi:<doi>' when the DOI is known,
+so the cache can be shared between users at different institutions.
+Entries expire after <ttl> seconds, and the least recently used entries are
+evicted when the cache holds more than <max_entries> entries.
+
+Enable with config:
+    pdf_resolution_cache: ~/.cache/ezfetcher/resolutions.sqlite   (or True for this default path)
+    pdf_resolution_cache_ttl: 2592000     # seconds (30 days)
+    pdf_resolution_cache_size: 100000     # max number of entries
+
+"""
+
+import os
+import time
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+from .url_proxy_utils import get_proxy_rewriter, doi_from_url
+
+DEFAULT_CACHE_FILEPATH = os.path.join('~', '.cache', 'ezfetcher', 'resolutions.sqlite')
+
+
+class ResolutionCache(object):
+    """
+    Persistent landing-page -> pdf url cache with TTL and LRU eviction.
+    Can be shared between threads.
+    """
+
+    def __init__(self, filepath, ttl=30*24*3600, max_entries=100000):
+        self.filepath = os.path.expanduser(filepath)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filepath, timeout=30, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS resolved ("
+                              "key TEXT PRIMARY KEY, pdf_url TEXT, created REAL, last_used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS resolved_last_used ON resolved (last_used)")
+
+    def close(self):
+        """ Close the database connection. """
+        self.conn.close()
+
+    def get(self, keys):
+        """ Return cached pdf url for the first of keys with an unexpired entry, or None. """
+        now = time.time()
+        with self._lock, self.conn:
+            for key in keys:
+                row = self.conn.execute("SELECT pdf_url, created FROM resolved WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    continue
+                if self.ttl and row[1] < now - self.ttl:
+                    self.conn.execute("DELETE FROM resolved WHERE key = ?", (key,))
+                    continue
+                self.conn.execute("UPDATE resolved SET last_used = ? WHERE key = ?", (now, key))
+                return row[0]
+        return None
+
+    def put(self, keys, pdf_url):
+        """ Cache pdf_url under all keys, evicting least recently used entries if the cache is full. """
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO resolved (key, pdf_url, created, last_used) "
+                                  "VALUES (?, ?, ?, ?)", [(key, pdf_url, now, now) for key in keys])
+            if self.max_entries:
+                n_entries = self.conn.execute("SELECT COUNT(*) FROM resolved").fetchone()[0]
+                if n_entries > self.max_entries:
+                    self.conn.execute("DELETE FROM resolved WHERE key IN "
+                                      "(SELECT key FROM resolved ORDER BY last_used LIMIT ?)",
+                                      (n_entries - self.max_entries,))
+
+    def invalidate(self, keys):
+        """ Remove entries for keys. """
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM resolved WHERE key = ?", [(key,) for key in keys])
+
+
+def get_resolution_cache(config):
+    """
+    Return ResolutionCache for the path given by config key 'pdf_resolution_cache',
+    or None if not configured. If the value is True, the default path is used.
+    """
+    filepath = config.get('pdf_resolution_cache')
+    if not filepath:
+        return None
+    if filepath is True:
+        filepath = DEFAULT_CACHE_FILEPATH
+    filepath = os.path.expanduser(filepath)
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    return ResolutionCache(filepath, ttl=config.get('pdf_resolution_cache_ttl', 30*24*3600),
+                           max_entries=config.get('pdf_resolution_cache_size', 100000))
+
+
+def deproxy_url(url, config):
+    """ Return url with the proxy rewrite (if any) of config['proxy_url_fmt'] reversed. """
+    if config.get('proxy_url_fmt'):
+        return get_proxy_rewriter(config['proxy_url_fmt']).deproxy(url)
+    return url
+
+
+def pdf_url_key(url, config):
+    """
+    Return the key under which validators and part files of pdf url are stored: the url as it
+    is requested through the proxy, de-proxied. This is the same for the proxied and the plain
+    url (the proxy rewrite may drop e.g. the scheme or query, so deproxy_url alone is not).
+    """
+    if config.get('proxy_url_fmt'):
+        rewriter = get_proxy_rewriter(config['proxy_url_fmt'])
+        return rewriter.deproxy(rewriter.rewrite(url))
+    return url
+
+
+def resolution_keys(url, config, metadata=None):
+    """ Return list of cache keys for landing page url: 'doi:<doi>' (if known) and the de-proxied url. """
+    keys = []
+    doi = (metadata or {}).get('doi') or doi_from_url(url)
+    if doi:
+        keys.append('doi:' + doi.lower())
+    keys.append(deproxy_url(url, config))
+    return keys
+
+
+def requested_url(response):
+    """
+    Return the url that was requested to get response (i.e. before any redirects). EzClient.get records
+    it on the response, since after a login the history starts with the login flow's requests.
+    """
+    url = getattr(response, 'requested_url', None)
+    if url:
+        return url
+    if not response.history:
+        return response.url
+    first = response.history[0]
+    return getattr(first, 'url', first)
+
+
+def fresh_pdf_path(url, config, digest_index, resolution_cache=None, metadata=None):
+    """
+    Return path of the pdf saved from url (a landing page resolved by resolution_cache, or the pdf url
+    itself), if it was saved or re-validated less than config 'pdf_max_age' seconds ago, otherwise None.
+    This needs no network access.
+    """
+    max_age = config.get('pdf_max_age')
+    if not max_age or digest_index is None:
+        return None
+    pdf_urls = [pdf_url_key(url, config)]
+    if resolution_cache is not None:
+        cached_url = resolution_cache.get(resolution_keys(url, config, metadata))
+        if cached_url:
+            pdf_urls.insert(0, pdf_url_key(cached_url, config))
+    for pdf_url in pdf_urls:
+        filepath = digest_index.fresh_path(pdf_url, max_age)
+        if filepath:
+            return filepath
+    return None
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Retries with jittered exponential backoff, and per-host circuit breakers.
+
+A RetryPolicy decides whether a failed request (connection error, timeout or a
+retryable status such as 502/503) should be retried, and how long to wait first,
+honoring the server's Retry-After header.
+
+A CircuitBreaker tracks consecutive failures per host. After <failure_threshold>
+failures the circuit opens, and requests to that host fail immediately with
+CircuitOpenError for <reset_timeout> seconds. Then a single trial request is let
+through (half-open); if it succeeds the circuit closes again.
+
+Config:
+    ezclient_retries: {max_retries: 2, backoff: 0.5, max_backoff: 30, statuses: [429, 500, 502, 503, 504]}
+    ezclient_circuit_breaker: {failure_threshold: 5, reset_timeout: 60}
+
+"""
+
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+import logging
+logger = logging.getLogger(__name__)
+
+from .errors import CircuitOpenError
+
+
+class RetryPolicy(object):
+    """ When and how long to wait before retrying a request. """
+
+    def __init__(self, max_retries=2, backoff=0.5, max_backoff=30, statuses=(429, 500, 502, 503, 504),
+                 max_retry_after=120):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = frozenset(statuses)
+        self.max_retry_after = max_retry_after
+
+    def is_retryable_status(self, status_code):
+        """ Whether a response with status_code should be retried. """
+        return status_code in self.statuses
+
+    def delay(self, attempt, response=None):
+        """
+        Return seconds to wait before retry number <attempt> (0-based).
+        Uses the response's Retry-After header if present (capped at max_retry_after),
+        otherwise a random ("full jitter") delay up to backoff * 2**attempt (capped at max_backoff).
+        """
+        retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+
+def parse_retry_after(value):
+    """ Parse Retry-After header (seconds or HTTP-date) to seconds, or None. """
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker(object):
+    """ Per-host circuit breaker. Thread-safe. """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = {}      # host -> number of consecutive failures
+        self.opened_at = {}     # host -> time the circuit was opened
+        self.trial = set()      # hosts with a half-open trial request in flight
+        self._lock = threading.Lock()
+
+    def check(self, host):
+        """ Raise CircuitOpenError if requests to host should fail fast. """
+        with self._lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is None:
+                return
+            if time.monotonic() - opened_at < self.reset_timeout or host in self.trial:
+                raise CircuitOpenError("Circuit open for %s after %s consecutive failures"
+                                       % (host, self.failures.get(host)))
+            # Half-open: let one trial request through.
+            self.trial.add(host)
+
+    def record_success(self, host):
+        """ Record successful request to host, closing the circuit. """
+        with self._lock:
+            self.failures.pop(host, None)
+            if self.opened_at.pop(host, None) is not None:
+                logger.info("Circuit for %s closed again.", host)
+            self.trial.discard(host)
+
+    def record_failure(self, host):
+        """ Record failed request to host, opening the circuit if the failure threshold is reached. """
+        with self._lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if host in self.trial or self.failures[host] >= self.failure_threshold:
+                if host not in self.opened_at or host in self.trial:
+                    logger.warning("Opening circuit for %s after %s consecutive failures.",
+                                   host, self.failures[host])
+                self.opened_at[host] = time.monotonic()
+            self.trial.discard(host)
+
+    def release(self, host):
+        """ Release the half-open trial slot of host (if any) without recording an outcome, e.g. on Ctrl-C. """
+        with self._lock:
+            self.trial.discard(host)
+
+
+def get_retry_policy(config):
+    """ Return RetryPolicy from config key 'ezclient_retries' (default: 2 retries), or None if disabled. """
+    kwargs = config.get('ezclient_retries', {})
+    if kwargs is False:
+        return None
+    return RetryPolicy(**(kwargs or {}))
+
+
+def get_circuit_breaker(config):
+    """ Return CircuitBreaker from config key 'ezclient_circuit_breaker', or None if disabled. """
+    kwargs = config.get('ezclient_circuit_breaker', {})
+    if kwargs is False:
+        return None
+    return CircuitBreaker(**(kwargs or {}))
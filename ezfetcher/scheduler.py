@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Per-host request scheduling, to stay within what publishers (and the ezproxy) allow.
+
+Each host gets a token bucket (requests per second, with a burst size) and a
+maximum number of concurrent requests. The host is taken from the de-proxied url,
+so limits are per publisher even though all requests go to the same proxy.
+
+The limits apply to both EzClient and AsyncEzClient (which awaits the same token
+buckets with acquire_async; its concurrency slots are asyncio semaphores).
+
+Config example:
+    ezclient_rate_limits:
+      default: {rate: 5, burst: 5, max_concurrent: 8}
+      nature.com: {rate: 1, max_concurrent: 2}      # Also applies to www.nature.com, etc.
+
+"""
+
+import time
+import threading
+import weakref
+from urllib.parse import urlparse
+import logging
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing <rate> acquisitions per second on average,
+    and bursts of up to <burst> acquisitions.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """ Take a token if one is available. Returns 0 if a token was taken, else the seconds until one is. """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """ Take a token, sleeping until one is available. Returns the time waited (seconds). """
+        waited = 0
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self):
+        """ Take a token, awaiting asyncio.sleep until one is available. Returns the time waited (seconds). """
+        import asyncio
+        waited = 0
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+
+class HostLimiter(object):
+    """ Rate and concurrency limits for a single host. """
+
+    def __init__(self, rate=None, burst=None, max_concurrent=None):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_concurrent = max_concurrent
+        self.semaphore = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self.async_semaphore = None     # Created by acquire_async (on the running event loop)
+
+    def acquire(self):
+        """ Wait for a concurrency slot and a rate token. """
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def release(self):
+        """ Release concurrency slot. """
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    async def acquire_async(self):
+        """ Await a concurrency slot and a rate token (for use from an event loop). """
+        if self.max_concurrent:
+            if self.async_semaphore is None:
+                import asyncio
+                self.async_semaphore = asyncio.Semaphore(self.max_concurrent)
+            await self.async_semaphore.acquire()
+        if self.bucket is not None:
+            try:
+                await self.bucket.acquire_async()
+            except BaseException:
+                self.release_async()
+                raise
+
+    def release_async(self):
+        """ Release concurrency slot taken with acquire_async. """
+        if self.async_semaphore is not None:
+            self.async_semaphore.release()
+
+
+class SlotRelease(object):
+    """ Callable that releases a HostLimiter slot exactly once. """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.released = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self.released:
+                return
+            self.released = True
+        self.limiter.release()
+
+
+class HostScheduler(object):
+    """
+    Schedules requests according to per-host limits.
+    <limits> is a dict of host -> {'rate': requests/sec, 'burst': int, 'max_concurrent': int};
+    the special 'default' entry applies to hosts not listed. A host entry also applies
+    to subdomains, e.g. 'nature.com' applies to 'www.nature.com'.
+    <deproxy> is an optional function to de-proxy urls before taking the host.
+    """
+
+    def __init__(self, limits=None, deproxy=None):
+        limits = dict(limits or {})
+        self.default = limits.pop('default', None)
+        self.limits = {host.lower(): kwargs for host, kwargs in limits.items()}
+        self.deproxy = deproxy
+        self.limiters = {}
+        self._lock = threading.Lock()
+
+    def host_key(self, url):
+        """ Return the host that url is limited by (the most specific configured host, or the netloc). """
+        if self.deproxy is not None:
+            url = self.deproxy(url)
+        netloc = urlparse(url).netloc.lower()
+        parts = netloc.split('.')
+        for i in range(len(parts)):
+            candidate = '.'.join(parts[i:])
+            if candidate in self.limits:
+                return candidate
+        return netloc
+
+    def get_limiter(self, host):
+        """ Return (lazily created) HostLimiter for host. """
+        with self._lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(**(self.limits.get(host) or self.default or {}))
+            return self.limiters[host]
+
+    def acquire(self, url):
+        """
+        Wait until a request to url is allowed. Returns a release function,
+        which must be called when the request is done.
+        """
+        host = self.host_key(url)
+        limiter = self.get_limiter(host)
+        start = time.monotonic()
+        limiter.acquire()
+        waited = time.monotonic() - start
+        if waited > 0.01:
+            logger.debug("Waited %.2f s for request slot for %s", waited, host)
+        return SlotRelease(limiter)
+
+    async def acquire_async(self, url):
+        """
+        Await until a request to url is allowed (for use from an event loop).
+        Returns a release function, which must be called when the request is done.
+        """
+        host = self.host_key(url)
+        limiter = self.get_limiter(host)
+        start = time.monotonic()
+        await limiter.acquire_async()
+        waited = time.monotonic() - start
+        if waited > 0.01:
+            logger.debug("Waited %.2f s for request slot for %s", waited, host)
+        return limiter.release_async
+
+    def request(self, url, send):
+        """
+        Send a request to url with send() (returning a response) within the limits for the host.
+        For streamed responses, the slot is held until the response is closed (or garbage collected).
+        """
+        release = self.acquire(url)
+        try:
+            response = send()
+        except BaseException:
+            release()
+            raise
+        if response.raw is None or response._content_consumed:  # pylint: disable=W0212
+            release()
+        else:
+            # Use a weak reference, so the response does not reference itself:
+            response_ref = weakref.ref(response)
+
+            def close_and_release():
+                """ Close response and release request slot. """
+                try:
+                    r = response_ref()
+                    if r is not None:
+                        type(r).close(r)
+                finally:
+                    release()
+            response.close = close_and_release
+            weakref.finalize(response, release)
+        return response
+
+
+def get_scheduler(config, deproxy=None):
+    """ Return HostScheduler from config key 'ezclient_rate_limits', or None if not configured. """
+    limits = config.get('ezclient_rate_limits')
+    if not limits:
+        return None
+    return HostScheduler(limits, deproxy=deproxy)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Proactive, background re-login before the EzProxy session expires.
+
+Without this, EzClient only notices that the session has expired when a request is
+redirected to the login host, and the whole login flow (several SSO round trips)
+then runs on the critical path of that request.
+
+The SessionRefresher estimates when the session expires: the earliest expiry of the
+proxy's cookies, or <session_ttl> seconds after the last login, whichever comes first.
+<margin> seconds before that, a background thread logs in again using a *separate*
+requests session (so requests in flight keep using the current, still valid, cookies),
+and then swaps the new cookies into the EzClient session.
+
+The login adaptor cannot prompt from a background thread, so this requires the
+login config to have 'prompt: never' (and username/password), e.g.:
+    ezclient_login_config:
+      AU_lib: {prompt: never, username: ..., password: ...}
+    ezclient_session_refresh: {session_ttl: 7200, margin: 300}
+
+The login is triggered by requesting <url> (default: the last url requested through the proxy).
+Refreshes are at least <min_interval> seconds apart (default: retry_interval), also if the new
+session is estimated to expire within <margin> seconds.
+
+"""
+
+import time
+import threading
+from urllib.parse import urlparse
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SessionRefresher(object):
+    """
+    Tracks session age and cookie expiry of an EzClient, and logs in again in a
+    background thread <margin> seconds before the session expires.
+    """
+
+    def __init__(self, ezclient, session_ttl=7200, margin=300, url=None, retry_interval=60, min_interval=None):
+        self.ezclient = ezclient
+        self.session_ttl = session_ttl
+        self.margin = margin
+        self.url = url
+        self.retry_interval = retry_interval
+        self.min_interval = retry_interval if min_interval is None else min_interval
+        self.last_refresh = 0       # time.time() of the last refresh attempt
+        self.logged_in = None       # time.time() of the last login
+        self.last_url = None        # Last (de-proxied) url requested through the proxy
+        self.refreshes = 0
+        self.next_attempt = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def cookie_expiry(self):
+        """ Return the earliest expiry time of the proxy's (non-session, unexpired) cookies, or None. """
+        rewriter = self.ezclient.proxy_rewriter
+        if rewriter is None or not rewriter.netloc_suffix:
+            return None
+        domain = urlparse("//" + rewriter.netloc_suffix.lstrip('.')).hostname
+        now = time.time()
+        expiries = [cookie.expires for cookie in list(self.ezclient.cookies)
+                    if cookie.expires and cookie.expires > now and cookie.domain.lstrip('.').endswith(domain)]
+        return min(expiries) if expiries else None
+
+    def expires_at(self):
+        """ Return the estimated time the session expires, or None if unknown. """
+        candidates = [self.cookie_expiry()]
+        if self.logged_in is not None and self.session_ttl:
+            candidates.append(self.logged_in + self.session_ttl)
+        candidates = [t for t in candidates if t is not None]
+        return min(candidates) if candidates else None
+
+    def login_done(self):
+        """ Record that the client has (just) logged in. """
+        with self._condition:
+            self.logged_in = time.time()
+            self.next_attempt = 0
+            self._condition.notify_all()
+        self.start()
+
+    def seen(self, url):
+        """ Record (de-proxied) url requested through the proxy. """
+        self.last_url = url
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        """ Start the background thread (if not already started). """
+        with self._condition:
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self.run, name="ezclient-session-refresh", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread. """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def run(self):
+        """ Background thread: Sleep until <margin> seconds before the session expires, then refresh it. """
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                expires = self.expires_at()
+                if expires is None:
+                    self._condition.wait()
+                    continue
+                delay = max(expires - self.margin, self.next_attempt,
+                            self.last_refresh + self.min_interval) - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+            self.last_refresh = time.time()
+            if not self.refresh():
+                self.next_attempt = time.time() + self.retry_interval
+
+    def refresh(self):
+        """ Log in with a separate session, and swap the new cookies into the client session. Returns success. """
+        ezclient = self.ezclient
+        url = self.url or self.last_url
+        if ezclient.login_adaptor is None or not url:
+            logger.debug("Cannot refresh session: No login adaptor or url to log in with.")
+            return False
+        if (ezclient.login_config or {}).get('prompt') != 'never':
+            logger.warning("Background session refresh requires login config with 'prompt: never'; disabling it.")
+            self.stop()
+            return False
+        from requests import Session
+        start = time.perf_counter()
+        session = Session()
+        session.headers.update(ezclient.session.headers)
+        ok = False
+        try:
+            timeout = tuple(ezclient.timeout) if isinstance(ezclient.timeout, list) else ezclient.timeout
+            r = session.get(ezclient.ensure_proxy(url), timeout=timeout)
+            if ezclient.is_login_redirect(r):
+                r = ezclient.login_adaptor(session, r.url, True, r=r, config=ezclient.login_config)
+                ok = bool(r) and not ezclient.is_login_redirect(r)
+            else:
+                logger.warning("Session refresh: %s was not redirected to the login page (%s)", url, r.url)
+        except Exception:  # pylint: disable=W0703
+            logger.exception("Error refreshing session in the background")
+        finally:
+            session.close()
+        elapsed = time.perf_counter() - start
+        if ezclient.metrics.hooks:
+            ezclient.metrics.emit({'event': 'session_refresh', 'time': time.time(), 'url': url, 'ok': ok,
+                                   'elapsed_s': elapsed})
+        if not ok:
+            logger.warning("Background session refresh failed, retrying in %s s", self.retry_interval)
+            return False
+        with ezclient._login_lock:  # pylint: disable=W0212
+            ezclient.cookies.update(session.cookies)
+            ezclient.login_generation += 1
+        if ezclient.config.get('cookies_persist_after_login', True) and ezclient.cookies_filepath:
+            ezclient.save_cookies()
+        self.refreshes += 1
+        logger.info("Session refreshed in the background in %.2f s", elapsed)
+        self.login_done()
+        expires = self.expires_at()
+        if expires is not None and expires - self.margin < time.time():
+            logger.warning("The refreshed session expires within %s s; next refresh in %s s.",
+                           self.margin, self.min_interval)
+        return True
+
+
+def get_session_refresher(ezclient, config):
+    """ Return SessionRefresher from config key 'ezclient_session_refresh', or None if not configured. """
+    kwargs = config.get('ezclient_session_refresh')
+    if not kwargs:
+        return None
+    return SessionRefresher(ezclient, **(kwargs if isinstance(kwargs, dict) else {}))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Race-free allocation of unique filenames, "name.pdf", "name (1).pdf", "name (2).pdf", ...
+
+Instead of probing "name (1).pdf", "name (2).pdf", ... with os.path.exists() (one round
+trip each on a network filesystem), the directory is listed once, and the next free
+suffix for each name is kept in memory, so allocating a name is O(1).
+
+The name is reserved by creating the (empty) file with O_CREAT | O_EXCL, which is atomic
+(also on NFS v3+ and SMB): if another thread or process got there first, we simply take
+the next suffix. The caller then atomically replaces the reserved file with the complete
+file (os.replace), so concurrent downloads, even from parallel batch runs, never clobber
+each other. If saving fails, the reservation is removed again (see FilenameAllocator.release).
+Names are only reserved for the moment it takes to move the download into place, so an empty
+file older than RESERVATION_MAX_AGE seconds is a reservation left behind by a crashed process;
+it is taken over instead of blocking the name forever.
+
+Usage:
+    filepath = allocate_filename("~/Downloads/nature04586.pdf")   # Reserved; replace it with the download
+    os.replace(tmppath, filepath)
+
+"""
+
+import os
+import re
+import time
+import string
+import threading
+from functools import lru_cache
+import logging
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_UNIQUE_FMT = "{fnroot} ({i}){ext}"
+RESERVATION_MAX_AGE = 300
+
+
+def unique_fmt_regex(unique_fmt):
+    """ Return regex matching paths made with unique_fmt, with groups fnroot, i and ext. """
+    patterns = {'fnroot': r'(?P<fnroot>.+)', 'i': r'(?P<i>\d+)', 'ext': r'(?P<ext>(?:\.[^./\\]*)?)'}
+    regex = ''
+    for literal, field, _, _ in string.Formatter().parse(unique_fmt):
+        regex += re.escape(literal)
+        if field is not None:
+            regex += patterns[field]
+    return re.compile(regex, flags=re.DOTALL)
+
+
+class FilenameAllocator(object):
+    """
+    Allocates unique filenames, using a cached per-directory listing to find the next free suffix.
+    Can be shared between threads.
+    """
+
+    def __init__(self, unique_fmt=DEFAULT_UNIQUE_FMT, max_iterations=1000):
+        self.unique_fmt = unique_fmt
+        self.max_iterations = max_iterations
+        self.regex = unique_fmt_regex(unique_fmt)
+        self._next = {}         # (fnroot, ext) -> next suffix to try
+        self._listed = set()    # Directories already listed
+        self._lock = threading.Lock()
+
+    def list_directory(self, directory):
+        """ Record the highest suffix in use for every name in directory (once per directory). """
+        if directory in self._listed:
+            return
+        self._listed.add(directory)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            m = self.regex.fullmatch(os.path.join(directory, entry.name))
+            if m:
+                key = (m.group('fnroot'), m.group('ext'))
+                self._next[key] = max(self._next.get(key, 1), int(m.group('i')) + 1)
+
+    def claim(self, filepath, reserve=True):
+        """
+        Whether filepath is free; if reserve is True, it is atomically created (empty) if it is.
+        A stale reservation (see remove_stale_reservation) counts as free when reserving.
+        """
+        if not reserve:
+            return not os.path.lexists(filepath)
+        for _ in range(2):
+            try:
+                os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            except FileExistsError:
+                if not remove_stale_reservation(filepath):
+                    return False
+            else:
+                return True
+        return False
+
+    def allocate(self, filepath, reserve=True):
+        """
+        Return filepath if it is free, otherwise filepath with the next free suffix (see unique_fmt).
+        If reserve is True, the returned path has been created as an empty file, so no other
+        thread or process can get the same name; replace it with the actual file (or release it).
+        Without reserve, this is a plain lookup: the next suffix to try is only advanced by reservations.
+        """
+        if self.claim(filepath, reserve):
+            return filepath
+        fnroot, ext = os.path.splitext(filepath)
+        key = (fnroot, ext)
+        with self._lock:
+            self.list_directory(os.path.dirname(filepath))
+            i = self._next.get(key, 1)
+            for i in range(i, i + self.max_iterations):
+                candidate = self.unique_fmt.format(fnroot=fnroot, i=i, ext=ext)
+                if self.claim(candidate, reserve):
+                    if reserve:
+                        self._next[key] = i + 1
+                    logger.debug("%s already exists; allocated %s", filepath, candidate)
+                    return candidate
+        raise FileExistsError("%s already exists (and so do %s similarly-named files)"
+                              % (filepath, self.max_iterations))
+
+    def release(self, filepath):
+        """ Remove a reserved (still empty) file, e.g. if saving to it failed. """
+        try:
+            if os.path.getsize(filepath) == 0:
+                os.remove(filepath)
+        except OSError:
+            pass
+
+
+def is_stale_reservation(stat, now=None):
+    """ Whether stat is of an empty file older than RESERVATION_MAX_AGE (a reservation left behind by a crash). """
+    return stat.st_size == 0 and stat.st_mtime < (now or time.time()) - RESERVATION_MAX_AGE
+
+
+def remove_stale_reservation(filepath):
+    """
+    Remove filepath if it is a stale reservation (see is_stale_reservation). Returns True if it was removed.
+    The file is first renamed (atomic, so only one process takes it over) and checked again, in case
+    it was replaced in the meantime, in which case it is put back.
+    """
+    try:
+        if not is_stale_reservation(os.stat(filepath)):
+            return False
+        tombpath = "%s.%s.stale" % (filepath, os.getpid())
+        os.rename(filepath, tombpath)
+    except OSError:
+        return False
+    try:
+        if is_stale_reservation(os.stat(tombpath)):
+            logger.info("Removing reservation left behind by a crashed download: %s", filepath)
+            return True
+        # Not ours to remove; put it back (unless the name has been taken again meanwhile):
+        try:
+            os.link(tombpath, filepath)
+        except OSError:
+            logger.warning("Could not restore %s (moved to %s)", filepath, tombpath)
+            tombpath = None
+        return False
+    finally:
+        if tombpath is not None:
+            try:
+                os.remove(tombpath)
+            except OSError:
+                pass
+
+
+@lru_cache(maxsize=16)
+def get_filename_allocator(unique_fmt=DEFAULT_UNIQUE_FMT, max_iterations=1000):
+    """ Return (shared) FilenameAllocator for unique_fmt. """
+    return FilenameAllocator(unique_fmt, max_iterations)
+
+
+def allocate_filename(filepath, unique_fmt=DEFAULT_UNIQUE_FMT, reserve=True):
+    """ Allocate (and reserve) a unique filename based on filepath, see FilenameAllocator.allocate. """
+    return get_filename_allocator(unique_fmt).allocate(filepath, reserve=reserve)
@@ -19,8 +19,145 @@
 
 
 import re
-from urllib.parse import urlparse
+import sys
+import string
+import argparse
+from functools import lru_cache
+from urllib.parse import urlparse, urlunparse, unquote, parse_qsl, urlencode
+import logging
+logger = logging.getLogger(__name__)
 
+URL_FIELDS = ('scheme', 'netloc', 'path', 'params', 'query', 'fragment')
+# Regex for each proxy_url_fmt field, bounded by url delimiters, so adjacent fields
+# (e.g. "{scheme}://{netloc}{path}") are split where urlparse would split them:
+URL_FIELD_PATTERNS = {
+    'scheme': r'[A-Za-z][A-Za-z0-9+.-]*',
+    'netloc': r'[^/?#]*',
+    'path': r'[^?#]*',
+    'params': r'[^?#]*',
+    'query': r'[^#]*',
+    'fragment': r'.*',
+}
+# Scheme given literally in a proxy_url_fmt without {scheme}, e.g. "...?url=http://{netloc}{path}":
+FMT_SCHEME_REGEX = re.compile(r"(?<![A-Za-z0-9+.-])([A-Za-z][A-Za-z0-9+.-]*)://\{netloc\}")
+DOI_URL_REGEX = re.compile(r"^(?:https?://)?(?:dx\.)?doi\.org/(10\.\d{4,9}/[^\s?#]+)", flags=re.IGNORECASE)
+# Publisher urls with the DOI in the path, e.g. /doi/abs/10.1021/..., /doi/pdf/10.1002/..., /article/10.1007/...
+DOI_PATH_REGEX = re.compile(r"/(?:doi|article|chapter)/(?:(?:abs|full|pdf|epdf|pdfdirect|book)/)?"
+                            r"(10\.\d{4,9}/[^\s?#;]+?)/?$", flags=re.IGNORECASE)
+# Query parameters that only track the click, and never select the content:
+TRACKING_PARAMS = frozenset(('fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', '_ga', '_gl',
+                             'igshid', 'ref_src', 'wt.mc_id'))
+TRACKING_PREFIXES = ('utm_', 'pk_', 'hsa_')
+# Host prefixes of www/mobile variants of the same site:
+HOST_VARIANT_PREFIXES = ('www.', 'm.', 'mobile.')
+SESSION_PATH_PARAM_REGEX = re.compile(r";(?:jsessionid|sid)=[^/?#]*", flags=re.IGNORECASE)
+
+
+class ProxyRewriter(object):
+    """
+    Proxy url rewriter, compiled once from a proxy_url_fmt, e.g.
+        https://{netloc}.ez.statsbiblioteket.dk:2048{path}
+    Provides (LRU-cached) is_proxied(), rewrite() and deproxy() methods,
+    as well as bulk rewrite_many() and deproxy_many() methods.
+    """
+
+    def __init__(self, proxy_url_fmt, cache_size=65536):
+        self.proxy_url_fmt = proxy_url_fmt
+        # We only consider the scheme://netloc/path part when matching:
+        match_fmt = proxy_url_fmt.split(";")[0].split("#")[0]
+        self.match_regex = re.compile(self._fmt_to_regex(match_fmt, named=False))
+        self.deproxy_regex = re.compile(self._fmt_to_regex(proxy_url_fmt, named=True) + "$")
+        # Scheme of the original urls, if a prefix proxy_url_fmt has it as a literal (for host-rewriting
+        # formats, e.g. "https://{netloc}.ez...", the leading scheme is the proxy's, not the original's):
+        fmt_schemes = [m.group(1) for m in FMT_SCHEME_REGEX.finditer(proxy_url_fmt) if m.start() > 0]
+        self.fmt_scheme = fmt_schemes[-1].lower() if fmt_schemes and "{scheme}" not in proxy_url_fmt else None
+        # Host (suffix) of proxied urls, e.g. '.ez.statsbiblioteket.dk:2048' for host-rewriting proxies:
+        netloc_fmt = re.split(r"[/?#]|\{path\}|\{query\}", proxy_url_fmt.split("://", 1)[-1])[0]
+        self.netloc_suffix = netloc_fmt.replace("{netloc}", "")
+        self.is_proxied = lru_cache(maxsize=cache_size)(self._is_proxied)
+        self.rewrite = lru_cache(maxsize=cache_size)(self._rewrite)
+        self.deproxy = lru_cache(maxsize=cache_size)(self._deproxy)
+
+    def __repr__(self):
+        return "ProxyRewriter(%r)" % self.proxy_url_fmt
+
+    @staticmethod
+    def _fmt_to_regex(fmt, named=True):
+        """
+        Convert proxy url format to regex. Literal parts are escaped, and format fields
+        are replaced by the patterns in URL_FIELD_PATTERNS (named groups if <named> is True).
+        A trailing {path} also takes any query and fragment (a proxied url found in a page
+        can have them even if proxy_url_fmt does not); unknown fields are wildcards.
+        """
+        parts = list(string.Formatter().parse(fmt))
+        n_fields = sum(1 for _, field, _, _ in parts if field is not None)
+        regex, seen, i = "", set(), 0
+        for literal, field, _, _ in parts:
+            regex += re.escape(literal)
+            if field is None:
+                continue
+            i += 1
+            if field == 'path' and i == n_fields:
+                wildcard = r'.*'
+            else:
+                wildcard = URL_FIELD_PATTERNS.get(field, ".*" if i == n_fields else ".*?")
+            if not named:
+                regex += wildcard
+            elif field in seen:
+                regex += "(?P=%s)" % field
+            else:
+                regex += "(?P<%s>%s)" % (field, wildcard)
+                seen.add(field)
+        return regex
+
+    def _is_proxied(self, url):
+        """ Returns true if url includes the ezproxy part. """
+        url = url.split(";")[0].split("#")[0]
+        return self.match_regex.match(url) is not None
+
+    def _rewrite(self, url):
+        """ Apply proxy rewrite format to url (unless url is already proxied). """
+        if self.is_proxied(url):
+            logger.debug("Url is already proxied: %s", url)
+            return url
+        parsed = urlparse(url)
+        if not parsed.netloc:
+            parsed = urlparse("http://"+url)
+        rewritten = self.proxy_url_fmt.format(**parsed._asdict())
+        logger.debug("Rewrote %s -> %s", url, rewritten)
+        return rewritten
+
+    def _deproxy(self, url, default_scheme=None):
+        """
+        Reverse of rewrite(): Return the original (non-proxied) url for a proxied url.
+        Urls that are not proxied are returned unchanged.
+        If proxy_url_fmt does not include {scheme}, <default_scheme> (if given), the scheme given
+        literally before {netloc} in proxy_url_fmt, or else the scheme of the proxied url is used.
+        """
+        m = self.deproxy_regex.match(url)
+        if not m:
+            return url
+        fields = dict.fromkeys(URL_FIELDS, '')
+        fields.update(m.groupdict())
+        if not fields['scheme']:
+            fields['scheme'] = default_scheme or self.fmt_scheme or urlparse(url).scheme or 'http'
+        return urlunparse(tuple(fields[key] for key in URL_FIELDS))
+
+    def rewrite_many(self, urls):
+        """ Rewrite a list of urls in a single pass. """
+        rewrite = self.rewrite
+        return [rewrite(url) for url in urls]
+
+    def deproxy_many(self, urls):
+        """ De-proxy a list of urls in a single pass. """
+        deproxy = self.deproxy
+        return [deproxy(url) for url in urls]
+
+
+@lru_cache(maxsize=64)
+def get_proxy_rewriter(proxy_url_fmt):
+    """ Return (cached) ProxyRewriter for proxy_url_fmt. """
+    return ProxyRewriter(proxy_url_fmt)
 
 
 def proxy_url_rewrite(url, proxy_url_fmt):
@@ -29,18 +166,7 @@ def proxy_url_rewrite(url, proxy_url_fmt):
     Rewritten with:
     proxy_url_fmt.format(**parsed._asdict())
     """
-    print("(proxy_url_rewrite) url:", url)
-    if url_is_proxied(url, proxy_url_fmt):
-        print("Url is already proxied...")
-        return url
-    parsed = urlparse(url)
-    if not parsed.netloc:
-        url = "http://"+url
-        parsed = urlparse(url)
-    print("Parsed url:", parsed._asdict())
-    rewritten = proxy_url_fmt.format(**parsed._asdict())
-    print("Rewritten URL: ", rewritten)
-    return rewritten
+    return get_proxy_rewriter(proxy_url_fmt).rewrite(url)
 
 
 def url_is_proxied(url, proxy_url_fmt):
@@ -55,12 +181,66 @@ def url_is_proxied(url, proxy_url_fmt):
      => http://www.nature.com.ez.statsbiblioteket.dk:2048/nature/journal/v440/n7082/full/nature04586.html?
 
     """
-    # We only consider the scheme://netloc/path part:
-    url = url.split(";")[0].split("#")[0]
-    proxy_url_fmt = proxy_url_fmt.split(";")[0].split("#")[0]
-    wildcards = dict.fromkeys('scheme netloc path params query fragment'.split(), '.*')
-    regex = proxy_url_fmt.format(**wildcards)
-    if re.match(regex, url):
-        return True
-    else:
-        return False
+    return get_proxy_rewriter(proxy_url_fmt).is_proxied(url)
+
+
+def url_deproxy(url, proxy_url_fmt):
+    """ Return the original (non-proxied) url for a url rewritten with proxy_url_fmt. """
+    return get_proxy_rewriter(proxy_url_fmt).deproxy(url)
+
+
+def doi_from_url(url):
+    """ Return the DOI of a doi.org url, e.g. 'https://doi.org/10.1038/nature04586', or None. """
+    m = DOI_URL_REGEX.match(unquote(url))
+    return m.group(1) if m else None
+
+
+def doi_from_path(url):
+    """ Return the DOI in the path of a publisher url, e.g. 'https://pubs.acs.org/doi/abs/10.1021/ja01234', or None. """
+    m = DOI_PATH_REGEX.search(unquote(urlparse(url).path))
+    return m.group(1) if m else None
+
+
+def canonical_url(url, tracking_params=()):
+    """
+    Return url normalized so variants of the same page compare equal: scheme and fragment
+    dropped, host lower-cased without www./m./mobile. prefix and default port, session ids
+    and trailing slash removed from the path, and tracking query parameters (utm_*, fbclid, etc.,
+    and <tracking_params>) removed, the rest sorted. Returns e.g. '//nature.com/articles/nature04586'.
+    """
+    parsed = urlparse(url if '//' in url else '//' + url)
+    host = (parsed.hostname or '').rstrip('.')
+    for prefix in HOST_VARIANT_PREFIXES:
+        if host.startswith(prefix) and host.count('.') > 1:
+            host = host[len(prefix):]
+            break
+    try:
+        port = parsed.port
+    except ValueError:
+        port = None
+    if port and port not in (80, 443):
+        host = "%s:%s" % (host, port)
+    path = SESSION_PATH_PARAM_REGEX.sub('', parsed.path)
+    if parsed.params and not SESSION_PATH_PARAM_REGEX.match(';' + parsed.params):
+        path += ';' + parsed.params
+    path = path.rstrip('/') or '/'
+    drop = TRACKING_PARAMS.union(param.lower() for param in tracking_params)
+    query = sorted((key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+                   if key.lower() not in drop and not key.lower().startswith(TRACKING_PREFIXES))
+    return "//" + host + path + ("?" + urlencode(query) if query else "")
+
+
+def main(argv=None):
+    """ Rewrite (or de-proxy) urls read from stdin, one per line, writing them to stdout. """
+    parser = argparse.ArgumentParser(description="Bulk proxy-rewrite or de-proxy urls from stdin.")
+    parser.add_argument('proxy_url_fmt', help="Proxy url format, e.g. 'https://{netloc}.lib.university.edu{path}'")
+    parser.add_argument('--deproxy', action="store_true", help="Reverse the rewrite (de-proxy urls).")
+    argns = parser.parse_args(argv)
+    rewriter = ProxyRewriter(argns.proxy_url_fmt)
+    urls = [line.strip() for line in sys.stdin if line.strip()]
+    urls = rewriter.deproxy_many(urls) if argns.deproxy else rewriter.rewrite_many(urls)
+    sys.stdout.write("\n".join(urls) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -21,9 +21,8 @@
 
 
 import os
-import yaml
+import time
 import argparse
-import getpass
 #from six import string_types
 import logging
 logger = logging.getLogger(__name__)
@@ -33,20 +32,76 @@ import hashlib
 LIBDIR = os.path.dirname(os.path.realpath(__file__))
 
 
-def filehexdigest(filepath, digesttype='md5'):
+DEFAULT_DIGEST = 'md5'
+# Read files in 1 MiB blocks: few syscalls (and network round trips), and hashlib releases the GIL for large updates.
+FILE_CHUNK_SIZE = 1024*1024
+
+
+def filehexdigest(filepath, digesttype=DEFAULT_DIGEST, chunk_size=FILE_CHUNK_SIZE, use_mmap=False):
     """
-    Returns hex digest of file in filepath.
-    Mostly for reference, since this is so short.
+    Returns hex digest of file in filepath, using hashlib algorithm <digesttype>
+    (e.g. 'md5', 'sha256', 'blake2b').
+    The file is read in blocks of chunk_size bytes into a single, reused buffer. If use_mmap is True,
+    the file is memory-mapped instead, and hashed in one update (usually faster on local disks).
     """
     m = hashlib.new(digesttype) # generic; can also be e.g. hashlib.md5()
     with open(filepath, 'rb') as fd:
-        # md5 sum default is 128 = 2**7-bytes digest block. However, file read is faster for e.g. 8 kb blocks.
-        # http://stackoverflow.com/questions/1131220/get-md5-hash-of-big-files-in-python
-        for chunk in iter(lambda: fd.read(128*m.block_size), b''):
-            m.update(chunk)
+        if use_mmap:
+            import mmap
+            try:
+                with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    m.update(mm)
+                return m.hexdigest()
+            except ValueError:
+                # Empty files cannot be mapped:
+                pass
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        for n in iter(lambda: fd.readinto(buf), 0):
+            m.update(view[:n])
     return m.hexdigest()
 
-def calc_checksum(bytearr, digesttype='md5'):
+def write_chunks(chunks, fd, digesttype=DEFAULT_DIGEST, m=None, timer=None):
+    """
+    Write an iterable of byte chunks to file object fd, updating the digest incrementally.
+    If a digest object <m> is given, it is updated instead of creating a new one.
+    If a metrics.PhaseTimer is given as <timer>, time spent getting chunks, hashing and
+    writing is added to its 'download', 'hash' and 'save' phases.
+    Returns (hexdigest, number of bytes written).
+    """
+    if m is None:
+        m = hashlib.new(digesttype)
+    nbytes = 0
+    if timer is None:
+        for chunk in chunks:
+            if chunk:
+                m.update(chunk)
+                fd.write(chunk)
+                nbytes += len(chunk)
+        return m.hexdigest(), nbytes
+    clock = time.perf_counter
+    download = hashing = writing = 0
+    t0 = clock()
+    for chunk in chunks:
+        t1 = clock()
+        download += t1 - t0
+        if chunk:
+            m.update(chunk)
+            t2 = clock()
+            hashing += t2 - t1
+            fd.write(chunk)
+            nbytes += len(chunk)
+            t0 = clock()
+            writing += t0 - t2
+        else:
+            t0 = t1
+    download += clock() - t0
+    timer.add('download', download)
+    timer.add('hash', hashing)
+    timer.add('save', writing)
+    return m.hexdigest(), nbytes
+
+def calc_checksum(bytearr, digesttype=DEFAULT_DIGEST):
     """
     Calculate checksum of in-memory bytearray.
     Mostly for reference, since this is so short.
@@ -58,6 +113,7 @@ def calc_checksum(bytearr, digesttype='md5'):
 
 def credentials_prompt(user='', password=''):
     """ Simple method to prompt for user credentials. """
+    import getpass
     if not user:
         user = getpass.getuser()
     user = input("User: [%s]" % user) or user
@@ -79,20 +135,45 @@ def load_config(filepath=None):
         filepath = os.path.expanduser("~/.config/ezfetcher/ezfetcher.yaml")
     filepath = os.path.normpath(filepath)
     try:
-        config = yaml.load(open(filepath))
-        logger.debug("Config with %s keys loaded from file: %s", len(config), filepath)
-        return config
+        fd = open(filepath)
     except FileNotFoundError:
         logger.debug("Config file not found: %s, returning empty dict...", filepath)
         return {}
+    # yaml is only imported when there is a config file to load:
+    import yaml
+    with fd:
+        config = yaml.safe_load(fd) or {}
+    logger.debug("Config with %s keys loaded from file: %s", len(config), filepath)
+    return config
 
 def save_config(config, filepath=None):
     """ Save config to file. """
     if filepath is None:
         filepath = os.path.expanduser("~/.ezfetcher.yaml")
-    yaml.dump(config, open(filepath, 'w'))
+    import yaml
+    with open(filepath, 'w') as fd:
+        yaml.dump(config, fd)
     logger.debug("Config with %s keys dumped to file: %s", len(config), filepath)
 
+def get_pdf_download_dir(config):
+    """ Return the (normalized, user-expanded) pdf download directory from config. """
+    savedir = os.path.expanduser(config.get('pdf_download_dir', os.path.join('~', 'Downloads')))
+    return os.path.normpath(savedir)
+
+def open_pdf(filepath, config):
+    """ Open pdf in browser if config key 'pdf_open_after_download' is true (or "ask" and the user says yes). """
+    open_pdf = config.get('pdf_open_after_download')
+    if open_pdf == "ask":
+        ok = input("Open pdf in browser? [yes/no] ")
+        open_pdf = (bool(ok) and ok[0].lower() == 'y')
+    if open_pdf:
+        import webbrowser
+        webbrowser.open(filepath)
+
+def read_urls(fd):
+    """ Read urls from file object, one per line. Blank lines and lines starting with '#' are skipped. """
+    return [line.strip() for line in fd if line.strip() and not line.strip().startswith('#')]
+
 def get_config(args=None, config_fpath=None):
     """ Get config, merging args with persistent config. """
     # Load config:
@@ -131,4 +212,4 @@ def init_logging(args=None):#, prefix="EzFetcher"):
                         # filename='example.log',
                         #)
     logger.info("Logging system initialized with loglevel %s", loglevel)
-    print("args:", args)
+    logger.debug("args: %s", args)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Shared fixtures: a local http server with a landing page and a pdf.
+
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+PDF = b"%PDF-1.4\n" + b"0" * 10000 + b"\n%%EOF\n"
+LANDING_PAGE = b'<html><body><a href="/a.pdf">A</a> <a href="/b.pdf">B</a></body></html>'
+NO_LINK_PAGE = b'<html><body>No pdf here.</body></html>'
+
+
+class PdfRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves /landing.html (with two pdf links), /nolink.html (without) and any /<name>.pdf.
+    Paths under /unavailable-once/ get 503 Service Unavailable the first time they are requested.
+    """
+    unavailable_served = set()
+
+    def log_message(self, *args):   # pylint: disable=W0221
+        pass
+
+    def do_GET(self):   # pylint: disable=C0111
+        if self.path.startswith('/unavailable-once/') and self.path not in self.unavailable_served:
+            self.unavailable_served.add(self.path)
+            self.send_error(503)
+            return
+        if self.path == '/landing.html':
+            body, content_type = LANDING_PAGE, 'text/html'
+        elif self.path == '/nolink.html':
+            body, content_type = NO_LINK_PAGE, 'text/html'
+        elif self.path.endswith('.pdf'):
+            body, content_type = PDF, 'application/pdf'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def pdf_server():
+    """ Yield the base url of a local http server with PdfRequestHandler. """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PdfRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%s" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetch_env(tmp_path, monkeypatch):
+    """ Isolate HOME (config, cookies, caches) in tmp_path; returns the download directory. """
+    monkeypatch.setenv('HOME', str(tmp_path))
+    download_dir = tmp_path / "Downloads"
+    download_dir.mkdir()
+    return download_dir
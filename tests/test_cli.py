@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Tests of the command line interface.
+
+"""
+
+import json
+
+from ezfetcher.cli import main
+
+
+def test_batch_manifest_on_stdout_is_json(pdf_server, fetch_env, tmp_path, capsys):
+    batchfile = tmp_path / "urls.txt"
+    batchfile.write_text("%s/landing.html\n%s/c.pdf\n" % (pdf_server, pdf_server))
+    main(['--batch', str(batchfile), '--pdf_download_dir', str(fetch_env), '--no-open_pdf',
+          '--configfile', str(tmp_path / "no-config.yaml")])
+    manifest = json.loads(capsys.readouterr().out)
+    assert [entry['status'] for entry in manifest] == ['ok', 'ok']
+    # Multiple pdf links on the landing page: the first is used, without prompting.
+    assert manifest[0]['filepath'] == str(fetch_env / "a.pdf")
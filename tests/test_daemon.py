@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Tests of the fetch daemon client.
+
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from ezfetcher.cli import main
+from ezfetcher.daemon import DaemonClient, DaemonError
+
+
+class BrokenDaemonHandler(BaseHTTPRequestHandler):
+    """ Something else (or a stale daemon) listening on the daemon port: answers with a non-json error page. """
+
+    def log_message(self, *args):   # pylint: disable=W0221
+        pass
+
+    def do_POST(self):   # pylint: disable=C0111
+        self.send_error(500)
+
+    do_GET = do_POST
+
+
+@pytest.fixture
+def broken_daemon():
+    """ Yield the port of a local http server with BrokenDaemonHandler. """
+    server = HTTPServer(('127.0.0.1', 0), BrokenDaemonHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_broken_daemon_raises_daemon_error(broken_daemon):
+    client = DaemonClient(('tcp', ('127.0.0.1', broken_daemon)), timeout=10)
+    with pytest.raises(DaemonError):
+        client.status()
+    assert not client.is_running()
+
+
+def test_cli_falls_back_to_in_process_fetch(broken_daemon, pdf_server, fetch_env, tmp_path, capsys):
+    configfile = tmp_path / "config.yaml"
+    configfile.write_text("use_daemon: True\ndaemon_port: %s\ndaemon_token_file: %s\n"
+                          % (broken_daemon, tmp_path / "daemon.token"))
+    filepath = main(["%s/c.pdf" % pdf_server, '--pdf_download_dir', str(fetch_env), '--no-open_pdf',
+                     '--configfile', str(configfile)])
+    assert "fetching in-process" in capsys.readouterr().out
+    assert filepath == str(fetch_env / "c.pdf")
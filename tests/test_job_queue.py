@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Tests of the batch job queue.
+
+"""
+
+from ezfetcher.utils import get_config
+from ezfetcher.job_queue import JobQueue, run_queue, DONE, FAILED, PENDING
+
+
+def queue_config(download_dir, tmp_path, **kwargs):
+    """ Config for fetching from the local test server, without client-side retries. """
+    config = get_config(dict(pdf_download_dir=str(download_dir), open_pdf=False, ezclient_retries=False,
+                             ezclient_circuit_breaker=False, pdf_batch_workers=2, **kwargs),
+                        config_fpath=str(tmp_path / "no-config.yaml"))
+    return config
+
+
+def test_failed_jobs_record_the_reason(pdf_server, fetch_env, tmp_path):
+    urls = ["%s/nolink.html" % pdf_server, "%s/missing.html" % pdf_server, "%s/a.pdf" % pdf_server]
+    with JobQueue(str(tmp_path / "queue.sqlite")) as queue:
+        queue.add(urls)
+        run_queue(queue, queue_config(fetch_env, tmp_path, pdf_queue_retry_delay=0))
+        jobs = {job['url']: job for job in queue.manifest()}
+    assert jobs[urls[0]]['state'] == FAILED
+    assert "No pdf link found" in jobs[urls[0]]['error']
+    assert jobs[urls[1]]['state'] == FAILED
+    assert "HTTP 404" in jobs[urls[1]]['error']
+    # Permanent failures are not retried:
+    assert jobs[urls[1]]['attempts'] == 1
+    assert jobs[urls[2]]['state'] == DONE
+
+
+def test_transient_failures_are_retried(pdf_server, fetch_env, tmp_path):
+    url = "%s/unavailable-once/c.pdf" % pdf_server
+    with JobQueue(str(tmp_path / "queue.sqlite")) as queue:
+        queue.add([url])
+        counts = run_queue(queue, queue_config(fetch_env, tmp_path, pdf_queue_retry_delay=0))
+        job, = queue.manifest()
+    assert counts[DONE] == 1
+    assert job['attempts'] == 2
+    assert job['filepath'] == str(fetch_env / "c.pdf")
+
+
+def test_retries_wait_for_the_retry_delay(tmp_path):
+    with JobQueue(str(tmp_path / "queue.sqlite")) as queue:
+        queue.add(["http://example.org/a.pdf"])
+        job_id, _ = queue.claim()
+        assert queue.fail(job_id, "HTTP 503", retryable=True, max_attempts=2, retry_delay=60)
+        assert queue.claim() is None
+        assert 50 < queue.next_retry() <= 60
+        assert queue.counts()[PENDING] == 1
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Tests of fetching pdfs.
+
+"""
+
+import json
+
+import pytest
+
+from ezfetcher import metrics
+from ezfetcher.utils import get_config
+from ezfetcher.pdffetcher import fetch_pdf, fetch_pdfs
+
+
+@pytest.fixture
+def metrics_sinks(monkeypatch):
+    """ Record the JsonLinesSink instances that are created. """
+    sinks = []
+    init = metrics.JsonLinesSink.__init__
+
+    def recording_init(self, filepath):
+        init(self, filepath)
+        sinks.append(self)
+
+    monkeypatch.setattr(metrics.JsonLinesSink, '__init__', recording_init)
+    return sinks
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_metrics_file_is_closed(pdf_server, fetch_env, tmp_path, metrics_sinks, batch):
+    metrics_file = tmp_path / "metrics.jsonl"
+    config = get_config(dict(pdf_download_dir=str(fetch_env), pdf_open_after_download=False,
+                             ezclient_metrics_file=str(metrics_file)),
+                        config_fpath=str(tmp_path / "no-config.yaml"))
+    url = "%s/c.pdf" % pdf_server
+    if batch:
+        fetch_pdfs([url], config)
+    else:
+        fetch_pdf(url, config)
+    assert metrics_sinks and all(sink.fd.closed for sink in metrics_sinks)
+    events = [json.loads(line) for line in metrics_file.read_text().splitlines()]
+    assert 'fetch_pdf' in [event['event'] for event in events]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Tests of unique filename allocation.
+
+"""
+
+import os
+import time
+
+from ezfetcher.unique_filename import FilenameAllocator, RESERVATION_MAX_AGE
+
+
+def test_lookup_does_not_advance_the_suffix(tmp_path):
+    allocator = FilenameAllocator()
+    (tmp_path / "a.pdf").write_bytes(b"pdf")
+    path = str(tmp_path / "a.pdf")
+    assert allocator.allocate(path, reserve=False) == str(tmp_path / "a (1).pdf")
+    assert allocator.allocate(path, reserve=False) == str(tmp_path / "a (1).pdf")
+    assert allocator.allocate(path) == str(tmp_path / "a (1).pdf")
+    assert allocator.allocate(path, reserve=False) == str(tmp_path / "a (2).pdf")
+
+
+def test_release_removes_the_reservation(tmp_path):
+    allocator = FilenameAllocator()
+    path = allocator.allocate(str(tmp_path / "a.pdf"))
+    assert os.path.exists(path)
+    allocator.release(path)
+    assert not os.path.exists(path)
+
+
+def test_stale_reservation_is_taken_over(tmp_path):
+    allocator = FilenameAllocator()
+    stale, fresh, pdf = (tmp_path / "stale.pdf"), (tmp_path / "fresh.pdf"), (tmp_path / "old.pdf")
+    stale.write_bytes(b"")
+    fresh.write_bytes(b"")
+    pdf.write_bytes(b"pdf")
+    old = time.time() - RESERVATION_MAX_AGE - 10
+    for path in (stale, pdf):
+        os.utime(str(path), (old, old))
+    assert allocator.allocate(str(stale)) == str(stale)
+    assert allocator.allocate(str(fresh)) == str(tmp_path / "fresh (1).pdf")
+    assert allocator.allocate(str(pdf)) == str(tmp_path / "old (1).pdf")
+    assert pdf.read_bytes() == b"pdf"
+    assert sorted(os.listdir(str(tmp_path))) == ["fresh (1).pdf", "fresh.pdf", "old (1).pdf", "old.pdf", "stale.pdf"]
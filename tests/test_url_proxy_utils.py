@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 Rasmus Sorensen, rasmusscholer@gmail.com <scholer.github.io>
+
+##    This program is free software: you can redistribute it and/or modify
+##    it under the terms of the GNU General Public License as published by
+##    the Free Software Foundation, either version 3 of the License, or
+##    (at your option) any later version.
+##
+##    This program is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+
+# pylint: disable=C0103,W0142
+
+
+"""
+
+Tests of ProxyRewriter rewrite/deproxy round trips.
+
+"""
+
+from urllib.parse import urlparse
+
+import pytest
+
+from ezfetcher.url_proxy_utils import ProxyRewriter
+
+
+ROUND_TRIPS = [
+    # Prefix proxies:
+    ("https://login.ezproxy.lib.edu/login?url={scheme}://{netloc}{path}", "https://pubs.acs.org/doi/10.1021/ja1"),
+    ("https://login.ezproxy.lib.edu/login?url={scheme}://{netloc}{path}", "http://pubs.acs.org/doi/10.1021/ja1"),
+    ("https://login.ezproxy.lib.edu/login?url=http://{netloc}/{path}", "http://pubs.acs.org/doi/10.1021/ja1"),
+    ("https://login.ezproxy.lib.edu/login?url={scheme}://{netloc}{path}?{query}",
+     "https://www.nature.com/articles/nature04586.pdf?origin=ppub"),
+    # Host-rewriting proxies:
+    ("https://{netloc}.ez.statsbiblioteket.dk:2048{path}", "https://www.nature.com/nature/journal/v440/n7082/pdf/x.pdf"),
+    ("https://{netloc}.ez.statsbiblioteket.dk:2048{path}?{query}", "https://www.nature.com/x.pdf?a=1&b=2"),
+]
+
+
+@pytest.mark.parametrize("proxy_url_fmt, url", ROUND_TRIPS)
+def test_rewrite_deproxy_round_trip(proxy_url_fmt, url):
+    rewriter = ProxyRewriter(proxy_url_fmt)
+    proxied = rewriter.rewrite(url)
+    assert rewriter.is_proxied(proxied)
+    assert not rewriter.is_proxied(url)
+    assert rewriter.deproxy(proxied) == url
+
+
+def test_adjacent_netloc_path_fields():
+    rewriter = ProxyRewriter("https://login.ezproxy.lib.edu/login?url={scheme}://{netloc}{path}")
+    deproxied = rewriter.deproxy("https://login.ezproxy.lib.edu/login?url=https://pubs.acs.org/doi/10.1021/ja1")
+    assert urlparse(deproxied).netloc == "pubs.acs.org"
+    assert urlparse(deproxied).path == "/doi/10.1021/ja1"
+
+
+def test_deproxy_uses_scheme_literal_of_prefix_format():
+    rewriter = ProxyRewriter("https://login.ezproxy.lib.edu/login?url=http://{netloc}/{path}")
+    assert rewriter.deproxy("https://login.ezproxy.lib.edu/login?url=http://pubs.acs.org/doi/x").startswith("http://")
+
+
+def test_deproxy_keeps_query_of_proxied_page_url():
+    rewriter = ProxyRewriter("https://{netloc}.ez.statsbiblioteket.dk:2048{path}")
+    assert (rewriter.deproxy("https://www.nature.com.ez.statsbiblioteket.dk:2048/a/b.pdf?x=1")
+            == "https://www.nature.com/a/b.pdf?x=1")
+
+
+def test_deproxy_leaves_other_urls_unchanged():
+    rewriter = ProxyRewriter("https://{netloc}.ez.statsbiblioteket.dk:2048{path}")
+    assert rewriter.deproxy("https://pubs.acs.org/doi/x") == "https://pubs.acs.org/doi/x"